@@ -22,22 +22,28 @@
 # https://github.com/sipa/bips/blob/bip-bech32m/bip-bech32m.mediawiki
 
 """Reference implementation for Bech32m and segwit addresses."""
-from typing import List, Optional, Tuple
-from helper import bytes32
+from typing import Dict, Iterable, List, Optional, Tuple
+from helper import bytes32, LRUCache
 
 
 CHARSET = "qpzry9x8gf2tvdw0s3jn54khce6mua7l"
+CHARSET_REVERSE: Dict[str, int] = {c: i for i, c in enumerate(CHARSET)}
 
+GENERATOR = [0x3B6A57B2, 0x26508E6D, 0x1EA119FA, 0x3D4233DD, 0x2A1462B3]
+# POLYMOD_TABLE[top] is the xor of the generators selected by the 5 bits shifted out of the checksum,
+# so each symbol costs one lookup instead of 5 conditional xors
+POLYMOD_TABLE = [0] * 32
+for top in range(32):
+    for i in range(5):
+        if (top >> i) & 1:
+            POLYMOD_TABLE[top] ^= GENERATOR[i]
 
-def bech32_polymod(values: List[int]) -> int:
+
+def bech32_polymod(values: Iterable[int], chk: int = 1) -> int:
     """Internal function that computes the Bech32 checksum."""
-    generator = [0x3B6A57B2, 0x26508E6D, 0x1EA119FA, 0x3D4233DD, 0x2A1462B3]
-    chk = 1
+    table = POLYMOD_TABLE
     for value in values:
-        top = chk >> 25
-        chk = (chk & 0x1FFFFFF) << 5 ^ value
-        for i in range(5):
-            chk ^= generator[i] if ((top >> i) & 1) else 0
+        chk = ((chk & 0x1FFFFFF) << 5 ^ value) ^ table[chk >> 25]
     return chk
 
 
@@ -46,16 +52,28 @@ def bech32_hrp_expand(hrp: str) -> List[int]:
     return [ord(x) >> 5 for x in hrp] + [0] + [ord(x) & 31 for x in hrp]
 
 
+hrp_polymod_cache: Dict[str, int] = {}
+
+
+def bech32_hrp_polymod(hrp: str) -> int:
+    """Checksum state after the expanded HRP; every address with the same prefix starts from it."""
+    chk = hrp_polymod_cache.get(hrp)
+    if chk is None:
+        chk = bech32_polymod(bech32_hrp_expand(hrp))
+        if len(hrp_polymod_cache) < 1024:
+            hrp_polymod_cache[hrp] = chk
+    return chk
+
+
 M = 0x2BC830A3
 
 
 def bech32_verify_checksum(hrp: str, data: List[int]) -> bool:
-    return bech32_polymod(bech32_hrp_expand(hrp) + data) == M
+    return bech32_polymod(data, bech32_hrp_polymod(hrp)) == M
 
 
 def bech32_create_checksum(hrp: str, data: List[int]) -> List[int]:
-    values = bech32_hrp_expand(hrp) + data
-    polymod = bech32_polymod(values + [0, 0, 0, 0, 0, 0]) ^ M
+    polymod = bech32_polymod(data + [0, 0, 0, 0, 0, 0], bech32_hrp_polymod(hrp)) ^ M
     return [(polymod >> 5 * (5 - i)) & 31 for i in range(6)]
 
 
@@ -67,16 +85,17 @@ def bech32_encode(hrp: str, data: List[int]) -> str:
 
 def bech32_decode(bech: str) -> Tuple[Optional[str], Optional[List[int]]]:
     """Validate a Bech32 string, and determine HRP and data."""
-    if (any(ord(x) < 33 or ord(x) > 126 for x in bech)) or (bech.lower() != bech and bech.upper() != bech):
+    if bech == "" or min(bech) < "!" or max(bech) > "~" or (bech.lower() != bech and bech.upper() != bech):
         return (None, None)
     bech = bech.lower()
     pos = bech.rfind("1")
     if pos < 1 or pos + 7 > len(bech) or len(bech) > 90:
         return (None, None)
-    if not all(x in CHARSET for x in bech[pos + 1 :]):
+    try:
+        data = [CHARSET_REVERSE[x] for x in bech[pos + 1 :]]
+    except KeyError:
         return (None, None)
     hrp = bech[:pos]
-    data = [CHARSET.find(x) for x in bech[pos + 1 :]]
     if not bech32_verify_checksum(hrp, data):
         return (None, None)
     return hrp, data[:-6]
@@ -105,15 +124,61 @@ def convertbits(data: List[int], frombits: int, tobits: int, pad: bool = True) -
     return ret
 
 
+# Puzzle hashes are always 32 bytes = 52 five-bit groups (the last one padded with 4 zero bits),
+# so they're converted through one big int instead of bit by bit.
+PUZZLE_HASH_GROUPS = 52
+PUZZLE_HASH_PADDING = PUZZLE_HASH_GROUPS * 5 - 256
+GROUP_SHIFTS = [5 * (PUZZLE_HASH_GROUPS - 1 - i) for i in range(PUZZLE_HASH_GROUPS)]
+
+
+def puzzle_hash_to_groups(puzzle_hash: bytes) -> List[int]:
+    n = int.from_bytes(puzzle_hash, "big") << PUZZLE_HASH_PADDING
+    return [(n >> shift) & 31 for shift in GROUP_SHIFTS]
+
+
+def groups_to_puzzle_hash(data: List[int]) -> bytes:
+    n = 0
+    for value in data:
+        n = (n << 5) | value
+    if n & ((1 << PUZZLE_HASH_PADDING) - 1):
+        raise ValueError("Invalid bits")
+    return (n >> PUZZLE_HASH_PADDING).to_bytes(32, "big")
+
+
 def encode_puzzle_hash(puzzle_hash: bytes32, prefix: str) -> str:
-    encoded = bech32_encode(prefix, convertbits(puzzle_hash, 8, 5))
+    if len(puzzle_hash) == 32:
+        data = puzzle_hash_to_groups(puzzle_hash)
+    else:
+        data = convertbits(puzzle_hash, 8, 5)
+    encoded = bech32_encode(prefix, data)
     return encoded
 
 
+# addresses map to puzzle hashes over and over (every contract build decodes three of them)
+ADDRESS_CACHE_SIZE = 4096
+decode_cache = LRUCache(ADDRESS_CACHE_SIZE)
+
+
 def decode_puzzle_hash(address: str) -> bytes32:
+    cached = decode_cache.get(address)
+    if cached is not None:
+        return cached
     hrpgot, data = bech32_decode(address)
     if data is None:
         raise ValueError("Invalid Address")
-    decoded = convertbits(data, 5, 8, False)
-    decoded_bytes = bytes(decoded)
+    if len(data) == PUZZLE_HASH_GROUPS:
+        decoded_bytes = groups_to_puzzle_hash(data)
+    else:
+        decoded_bytes = bytes(convertbits(data, 5, 8, False))
+    decode_cache.put(address, decoded_bytes)
     return decoded_bytes
+
+
+def encode_many(puzzle_hashes: Iterable[bytes32], prefix: str) -> List[str]:
+    """encode_puzzle_hash for many puzzle hashes with the same prefix."""
+    return [encode_puzzle_hash(puzzle_hash, prefix) for puzzle_hash in puzzle_hashes]
+
+
+def decode_many(addresses: Iterable[str]) -> List[bytes32]:
+    """decode_puzzle_hash for many addresses; raises ValueError on the first invalid one."""
+    return [decode_puzzle_hash(address) for address in addresses]
@@ -0,0 +1,78 @@
+# Compares the reference bech32m code (bit-by-bit polymod and convertbits) with the
+# table-driven encode/decode in bech32m.py, with and without the decode cache.
+# Run from the repository root: python -m benchmarks.bech32m
+import argparse
+import os
+import time
+import bech32m
+from bech32m import encode_many, decode_many
+
+
+GENERATOR = [0x3B6A57B2, 0x26508E6D, 0x1EA119FA, 0x3D4233DD, 0x2A1462B3]
+
+
+def oldPolymod(values):
+	chk = 1
+	for value in values:
+		top = chk >> 25
+		chk = (chk & 0x1FFFFFF) << 5 ^ value
+		for i in range(5):
+			chk ^= GENERATOR[i] if ((top >> i) & 1) else 0
+	return chk
+
+
+def oldEncodePuzzleHash(puzzle_hash, prefix):
+	data = bech32m.convertbits(puzzle_hash, 8, 5)
+	polymod = oldPolymod(bech32m.bech32_hrp_expand(prefix) + data + [0, 0, 0, 0, 0, 0]) ^ bech32m.M
+	checksum = [(polymod >> 5 * (5 - i)) & 31 for i in range(6)]
+	return prefix + "1" + "".join([bech32m.CHARSET[d] for d in data + checksum])
+
+
+def oldDecodePuzzleHash(address):
+	pos = address.rfind("1")
+	if not all(x in bech32m.CHARSET for x in address[pos + 1 :]):
+		raise ValueError("Invalid Address")
+	data = [bech32m.CHARSET.find(x) for x in address[pos + 1 :]]
+	if oldPolymod(bech32m.bech32_hrp_expand(address[:pos]) + data) != bech32m.M:
+		raise ValueError("Invalid Address")
+	return bytes(bech32m.convertbits(data[:-6], 5, 8, False))
+
+
+def timed(f):
+	start = time.perf_counter()
+	ret = f()
+	return ret, time.perf_counter() - start
+
+
+def main():
+	parser = argparse.ArgumentParser()
+	parser.add_argument("--count", type=int, default=20000, help="number of puzzle hashes to convert")
+	parser.add_argument("--prefix", default="xch")
+	args = parser.parse_args()
+
+	puzzle_hashes = [os.urandom(32) for _ in range(args.count)]
+
+	old_addresses, old_encode = timed(lambda: [oldEncodePuzzleHash(p, args.prefix) for p in puzzle_hashes])
+	new_addresses, new_encode = timed(lambda: encode_many(puzzle_hashes, args.prefix))
+	assert old_addresses == new_addresses, "old and new addresses differ"
+
+	old_decoded, old_decode = timed(lambda: [oldDecodePuzzleHash(a) for a in old_addresses])
+	bech32m.decode_cache.clear()
+	new_decoded, new_decode = timed(lambda: decode_many(new_addresses))
+	assert old_decoded == new_decoded == puzzle_hashes, "old and new puzzle hashes differ"
+
+	# addresses still in the cache, e.g. a contract's from/to addresses on every rebuild
+	cached_addresses = new_addresses[-bech32m.ADDRESS_CACHE_SIZE:]
+	_, cached_decode = timed(lambda: decode_many(cached_addresses))
+
+	def report(name, old, new, count=args.count):
+		print(f"{name}: old {old / args.count * 1e6:.2f} us, new {new / count * 1e6:.2f} us ({old / args.count / (new / count):.1f}x)")
+
+	report("encode", old_encode, new_encode)
+	report("decode", old_decode, new_decode)
+	report("decode (cached)", old_decode, cached_decode, len(cached_addresses))
+	print(f"{args.count} puzzle hashes verified identical")
+
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,83 @@
+# Compares the old getContractProgram path (compile contract.clvm + compile the
+# curry arguments from source text on every cache miss) with the current one.
+# Run from the repository root: python -m benchmarks.contract_program
+import argparse
+import os
+import time
+from clvm_tools.clvmc import compile_clvm_text
+from clvm_tools.curry import curry
+from bech32m import encode_puzzle_hash
+from contract_helper import getPuzzleHashFromAddress, getContractProgram, programToPuzzleHash, YAKUSWAP_ADDRESS
+import contract_helper
+import puzzle_cache
+
+
+def oldGetContractProgram(secret_hash, total_amount, fee, from_address, to_address, max_block_height):
+	if not secret_hash.startswith("0x"):
+		secret_hash = "0x" + secret_hash
+	amount = str(total_amount - fee)
+	fee = str(fee)
+	max_block_height = str(max_block_height)
+	yakuswap_address = getPuzzleHashFromAddress(YAKUSWAP_ADDRESS)
+	to_address = getPuzzleHashFromAddress(to_address)
+	from_address = getPuzzleHashFromAddress(from_address)
+
+	contract = open("contract.clvm", "r").read()
+	prog_to_curry = compile_clvm_text(contract, [])
+	curry_args = compile_clvm_text(f"(list {secret_hash} {amount} {fee} {from_address} {to_address} {yakuswap_address} {max_block_height})", [])
+	return curry(prog_to_curry, curry_args)[-1]
+
+
+def randomTrade():
+	return (
+		os.urandom(32).hex(),
+		int.from_bytes(os.urandom(5), "big") + 1000,
+		int.from_bytes(os.urandom(1), "big"),
+		encode_puzzle_hash(os.urandom(32), "xch"),
+		encode_puzzle_hash(os.urandom(32), "xch"),
+		int.from_bytes(os.urandom(2), "big"),
+	)
+
+
+def main():
+	parser = argparse.ArgumentParser()
+	parser.add_argument("--trades", type=int, default=2000, help="number of distinct trades for the new path")
+	parser.add_argument("--old-trades", type=int, default=10, help="number of those trades to also run through the old path (it compiles the contract each time, "
+		"about a second per trade); with fewer than --trades, the old path's total is extrapolated from them")
+	args = parser.parse_args()
+
+	# measure compilation, not the on-disk cache
+	puzzle_cache.puzzle_cache_enabled = False
+
+	trades = [randomTrade() for _ in range(args.trades)]
+	old_trades = trades[:min(args.old_trades, len(trades))]
+
+	# the first compile also pays for loading the compiler
+	compile_clvm_text("(list 1)", [])
+
+	start = time.perf_counter()
+	old_programs = [oldGetContractProgram(*t) for t in old_trades]
+	old_elapsed = time.perf_counter() - start
+
+	contract_helper.cache.clear()
+	contract_helper.contract_template = None
+	start = time.perf_counter()
+	new_programs = [getContractProgram(*t) for t in trades]
+	new_elapsed = time.perf_counter() - start
+
+	for old, new in zip(old_programs, new_programs):
+		assert programToPuzzleHash(old) == programToPuzzleHash(new), "old and new programs differ"
+
+	old_per_trade = old_elapsed / max(len(old_trades), 1)
+	new_per_trade = new_elapsed / max(len(trades), 1)
+	print(f"old: {len(old_trades)} trades in {old_elapsed:.3f}s ({old_per_trade * 1000:.3f} ms/trade)")
+	if 0 < len(old_trades) < len(trades):
+		print(f"old: {len(trades)} trades in {old_per_trade * len(trades):.3f}s EXTRAPOLATED from the {len(old_trades)} trades above (run with --old-trades {len(trades)} to measure them all)")
+	print(f"new: {len(trades)} trades in {new_elapsed:.3f}s ({new_per_trade * 1000:.3f} ms/trade)")
+	if len(old_trades) > 0:
+		extrapolated = " (old path extrapolated)" if len(old_trades) < len(trades) else ""
+		print(f"speedup{extrapolated}: {old_per_trade / new_per_trade:.1f}x, {len(old_programs)} programs verified identical")
+
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,39 @@
+# Compares one requests.post per RPC (a new TCP connection and TLS handshake every time)
+# with FullNodeClient's pooled keep-alive session, against a local TLS stub node.
+# Run from the repository root: python -m benchmarks.full_node_client
+import argparse
+import time
+import requests
+from full_node_client import FullNodeClient
+from benchmarks.stub_node import StubNode, makeSslDirectory
+
+
+def main():
+	parser = argparse.ArgumentParser()
+	parser.add_argument("--requests", type=int, default=500)
+	args = parser.parse_args()
+
+	ssl_directory = makeSslDirectory()
+	node = StubNode(ssl_directory).start()
+	client = FullNodeClient(ssl_directory, "127.0.0.1", node.port)
+
+	start = time.perf_counter()
+	for _ in range(args.requests):
+		requests.post(f"{client.API_url}/get_blockchain_state", json={}, cert=(client.cert_path, client.key_path), verify=False).json()
+	old_elapsed = time.perf_counter() - start
+	old_connections = node.connections
+
+	start = time.perf_counter()
+	for _ in range(args.requests):
+		assert client.getBlockchainState() != {}
+	new_elapsed = time.perf_counter() - start
+	new_connections = node.connections - old_connections
+
+	node.shutdown()
+	print(f"requests.post: {args.requests} requests in {old_elapsed:.3f}s ({old_elapsed / args.requests * 1000:.3f} ms/request, {old_connections} handshakes)")
+	print(f"pooled session: {args.requests} requests in {new_elapsed:.3f}s ({new_elapsed / args.requests * 1000:.3f} ms/request, {new_connections} handshakes)")
+	print(f"speedup: {old_elapsed / new_elapsed:.1f}x")
+
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,298 @@
+# A local stand-in for a Chia-fork full node, for load testing the swap engine without real nodes.
+# It serves the RPCs yakuSwap uses over TLS, mines a block every block_time seconds and keeps a
+# mempool whose spends are checked by actually running the puzzle (e.g. the curried contract)
+# and enforcing its CREATE_COIN / ASSERT_FEE / ASSERT_HEIGHT_RELATIVE conditions.
+# Latency, errors and sync flapping can be injected.
+#
+#   python -m benchmarks.node_simulator --block-time 1 --latency 0.02 --error-rate 0.01
+#
+# prints the port and ssl directory to configure as a currency (see Currency.put in main.py).
+import argparse
+import hashlib
+import io
+import json
+import os
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler
+from clvm import run_program, SExp
+from clvm.casts import int_from_bytes, int_to_bytes
+from clvm.operators import OPERATOR_LOOKUP
+from clvm.serialize import sexp_from_stream
+from clvm_tools.sha256tree import sha256tree
+from benchmarks.stub_node import StubNode, makeSslDirectory
+
+CREATE_COIN = 51
+ASSERT_FEE = 52
+ASSERT_HEIGHT_RELATIVE = 82
+MAX_COST = 11000000000
+
+def coinId(coin):
+	return hashlib.sha256(
+		_fromHex(coin["parent_coin_info"]) + _fromHex(coin["puzzle_hash"]) + int_to_bytes(coin["amount"])
+	).digest()
+
+def _fromHex(s):
+	if s.startswith("0x"):
+		s = s[2:]
+	return bytes.fromhex(s)
+
+def _toHex(b):
+	return "0x" + b.hex()
+
+def _programFromHex(s):
+	return sexp_from_stream(io.BytesIO(_fromHex(s)), SExp.to)
+
+
+class SpendError(Exception):
+	pass
+
+
+class SimulatedChain():
+	def __init__(self, start_height=1000, unsynced_ratio=0, seed=None):
+		self.height = start_height
+		self.unsynced_ratio = unsynced_ratio
+		self.synced = True
+		self.random = random.Random(seed)
+		self.coins = {} # coin id -> coin record, in the RPC format
+		self.by_puzzle_hash = {} # puzzle hash -> [coin id]
+		self.spends = {} # coin id -> (puzzle_reveal, solution) hex strings
+		self.mempool = {} # coin id -> (puzzle_reveal, solution, [new coins])
+		self.lock = threading.Lock()
+		self.stats = {"blocks": 0, "push_tx": 0, "rejected_spends": 0, "spends": 0}
+
+	def _addCoin(self, coin):
+		coin_id = coinId(coin)
+		self.coins[coin_id] = {
+			"coin": coin,
+			"coinbase": False,
+			"confirmed_block_index": self.height,
+			"spent": False,
+			"spent_block_index": 0,
+			"timestamp": int(time.time()),
+		}
+		self.by_puzzle_hash.setdefault(_fromHex(coin["puzzle_hash"]), []).append(coin_id)
+		return coin_id
+
+	def createCoin(self, puzzle_hash, amount):
+		# a coin out of thin air, e.g. a user funding a contract address; confirmed at the current height
+		with self.lock:
+			return self._addCoin({
+				"parent_coin_info": _toHex(os.urandom(32)),
+				"puzzle_hash": _toHex(puzzle_hash),
+				"amount": amount,
+			})
+
+	def mineBlock(self):
+		with self.lock:
+			self.height += 1
+			for coin_id, (puzzle_reveal, solution, new_coins) in self.mempool.items():
+				record = self.coins[coin_id]
+				record["spent"] = True
+				record["spent_block_index"] = self.height
+				self.spends[coin_id] = (puzzle_reveal, solution)
+				for coin in new_coins:
+					self._addCoin(coin)
+			self.stats["spends"] += len(self.mempool)
+			self.mempool = {}
+			self.stats["blocks"] += 1
+			self.synced = self.random.random() >= self.unsynced_ratio
+
+	def getBlockchainState(self):
+		with self.lock:
+			return {
+				"blockchain_state": {
+					"peak": {"height": self.height},
+					"sync": {"synced": self.synced, "sync_mode": not self.synced},
+				},
+				"success": True,
+			}
+
+	def getCoinRecords(self, puzzle_hashes, start, include_spent_coins):
+		with self.lock:
+			ret = []
+			for puzzle_hash in puzzle_hashes:
+				for coin_id in self.by_puzzle_hash.get(_fromHex(puzzle_hash), []):
+					record = self.coins[coin_id]
+					if record["confirmed_block_index"] >= start and (include_spent_coins or not record["spent"]):
+						ret.append(record)
+			return ret
+
+	def _checkSpend(self, coin, puzzle_reveal, solution):
+		# returns the coins the spend creates, or raises SpendError
+		coin_id = coinId(coin)
+		record = self.coins.get(coin_id, None)
+		if record is None:
+			raise SpendError("UNKNOWN_UNSPENT")
+		if record["spent"]:
+			raise SpendError("DOUBLE_SPEND")
+		puzzle = _programFromHex(puzzle_reveal)
+		if sha256tree(puzzle) != _fromHex(coin["puzzle_hash"]):
+			raise SpendError("WRONG_PUZZLE_HASH")
+		try:
+			cost, conditions = run_program(puzzle, _programFromHex(solution), OPERATOR_LOOKUP, MAX_COST)
+		except Exception as e:
+			raise SpendError(f"CLVM_ERROR: {e}")
+
+		new_coins = []
+		fee = 0
+		for condition in conditions.as_iter():
+			opcode = int_from_bytes(condition.first().as_atom())
+			args = list(condition.rest().as_iter())
+			if opcode == CREATE_COIN:
+				new_coins.append({
+					"parent_coin_info": _toHex(coin_id),
+					"puzzle_hash": _toHex(args[0].as_atom()),
+					"amount": int_from_bytes(args[1].as_atom()),
+				})
+			elif opcode == ASSERT_FEE:
+				fee += int_from_bytes(args[0].as_atom())
+			elif opcode == ASSERT_HEIGHT_RELATIVE:
+				# the spend would be included in the next block
+				if self.height + 1 - record["confirmed_block_index"] < int_from_bytes(args[0].as_atom()):
+					raise SpendError("ASSERT_HEIGHT_RELATIVE_FAILED")
+		if sum(c["amount"] for c in new_coins) + fee > coin["amount"]:
+			raise SpendError("MINTING_COIN")
+		return new_coins
+
+	def pushTx(self, spend_bundle):
+		with self.lock:
+			self.stats["push_tx"] += 1
+			coin_solutions = spend_bundle.get("coin_solutions", spend_bundle.get("coin_spends", []))
+			try:
+				pending = []
+				for coin_solution in coin_solutions:
+					coin_id = coinId(coin_solution["coin"])
+					if coin_id in self.mempool:
+						if self.mempool[coin_id][:2] == (coin_solution["puzzle_reveal"], coin_solution["solution"]):
+							continue # pushed again while still pending
+						raise SpendError("MEMPOOL_CONFLICT")
+					new_coins = self._checkSpend(coin_solution["coin"], coin_solution["puzzle_reveal"], coin_solution["solution"])
+					pending.append((coin_id, (coin_solution["puzzle_reveal"], coin_solution["solution"], new_coins)))
+			except SpendError as e:
+				self.stats["rejected_spends"] += 1
+				return {"error": str(e), "success": False}
+			self.mempool.update(pending)
+			return {"status": "SUCCESS", "success": True}
+
+	def getPuzzleAndSolution(self, coin_id, height):
+		with self.lock:
+			coin_id = _fromHex(coin_id)
+			spend = self.spends.get(coin_id, None)
+			record = self.coins.get(coin_id, None)
+			if spend is None or record["spent_block_index"] != height:
+				return {"error": "Not found", "success": False}
+			return {
+				"coin_solution": {
+					"coin": record["coin"],
+					"puzzle_reveal": spend[0],
+					"solution": spend[1],
+				},
+				"success": True,
+			}
+
+
+class NodeSimulatorHandler(BaseHTTPRequestHandler):
+	protocol_version = "HTTP/1.1"
+	disable_nagle_algorithm = True
+
+	def do_POST(self):
+		server = self.server
+		data = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+		server.countRequest(self.path)
+
+		if server.latency > 0:
+			time.sleep(server.latency * (0.5 + server.random.random()))
+		if server.random.random() < server.error_rate:
+			return self._respond(500, b"Internal Server Error")
+
+		chain = server.chain
+		if self.path == "/get_blockchain_state":
+			resp = chain.getBlockchainState()
+		elif self.path == "/get_coin_records_by_puzzle_hash":
+			resp = {"coin_records": chain.getCoinRecords([data["puzzle_hash"]], data.get("start", 0), data.get("include_spent_coins", False)), "success": True}
+		elif self.path == "/get_coin_records_by_puzzle_hashes" and server.batch_endpoint:
+			resp = {"coin_records": chain.getCoinRecords(data["puzzle_hashes"], data.get("start", 0), data.get("include_spent_coins", False)), "success": True}
+		elif self.path == "/push_tx":
+			resp = chain.pushTx(data["spend_bundle"])
+		elif self.path == "/get_puzzle_and_solution":
+			resp = chain.getPuzzleAndSolution(data["coin_id"], data["height"])
+		else:
+			return self._respond(404, b"Not Found")
+		self._respond(200, json.dumps(resp).encode())
+
+	def _respond(self, code, body):
+		self.send_response(code)
+		self.send_header("Content-Type", "application/json")
+		self.send_header("Content-Length", str(len(body)))
+		self.end_headers()
+		self.wfile.write(body)
+
+	def log_message(self, format, *args):
+		pass
+
+
+class NodeSimulator(StubNode):
+	def __init__(self, ssl_directory, block_time=1, latency=0, error_rate=0, unsynced_ratio=0, batch_endpoint=True, start_height=1000, seed=None):
+		# block_time=None only mines blocks when mineBlock() is called
+		super().__init__(ssl_directory)
+		self.RequestHandlerClass = NodeSimulatorHandler
+		self.chain = SimulatedChain(start_height, unsynced_ratio, seed)
+		self.block_time = block_time
+		self.latency = latency
+		self.error_rate = error_rate
+		self.batch_endpoint = batch_endpoint
+		self.random = random.Random(seed)
+		self.requests = {}
+		self.requests_lock = threading.Lock()
+		self.stopped = threading.Event()
+
+	def countRequest(self, path):
+		with self.requests_lock:
+			self.requests[path] = self.requests.get(path, 0) + 1
+
+	def mineBlock(self):
+		self.chain.mineBlock()
+
+	def _mine(self):
+		while not self.stopped.wait(self.block_time):
+			self.chain.mineBlock()
+
+	def start(self):
+		super().start()
+		if self.block_time is not None:
+			threading.Thread(target=self._mine, daemon=True).start()
+		return self
+
+	def stop(self):
+		self.stopped.set()
+		self.shutdown()
+		self.server_close()
+
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description="Run a simulated full node")
+	parser.add_argument('--block-time', type=float, default=18.75)
+	parser.add_argument('--latency', type=float, default=0, help="average seconds added to every request")
+	parser.add_argument('--error-rate', type=float, default=0, help="fraction of requests answered with HTTP 500")
+	parser.add_argument('--unsynced-ratio', type=float, default=0, help="fraction of blocks the node reports itself as not synced")
+	parser.add_argument('--no-batch-endpoint', action='store_true', help="behave like forks without /get_coin_records_by_puzzle_hashes")
+	args = parser.parse_args()
+
+	ssl_directory = makeSslDirectory()
+	node = NodeSimulator(
+		ssl_directory,
+		block_time = args.block_time,
+		latency = args.latency,
+		error_rate = args.error_rate,
+		unsynced_ratio = args.unsynced_ratio,
+		batch_endpoint = not args.no_batch_endpoint
+	).start()
+	print(json.dumps({"host": "127.0.0.1", "port": node.port, "ssl_directory": ssl_directory}))
+	try:
+		while True:
+			time.sleep(10)
+			print(json.dumps({"height": node.chain.height, "requests": node.requests, **node.chain.stats}))
+	except KeyboardInterrupt:
+		node.stop()
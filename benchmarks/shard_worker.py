@@ -0,0 +1,24 @@
+# Runs main.py as a trade shard worker (see trade_shards.py) with the engine's asyncio.sleep calls
+# shortened, like benchmarks.suite does in-process. Used by the simulated_swap benchmark with --shards.
+#
+#   python -m benchmarks.shard_worker <time scale> <path to main.py> --trade-shard-worker <address> <index>
+import asyncio
+import runpy
+import sys
+
+
+def main():
+	time_scale = float(sys.argv[1])
+	main_file = sys.argv[2]
+
+	original_sleep = asyncio.sleep
+	async def scaledSleep(delay, result=None):
+		return await original_sleep(delay * time_scale, result)
+	asyncio.sleep = scaledSleep
+
+	sys.argv = [main_file] + sys.argv[3:]
+	runpy.run_path(main_file, run_name="__main__")
+
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,69 @@
+# A minimal TLS full node stand-in for the benchmarks. It answers every RPC with a synced
+# blockchain state and counts accepted connections, i.e. TLS handshakes.
+import json
+import os
+import ssl
+import subprocess
+import tempfile
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+def makeSslDirectory():
+	# same layout FullNodeClient expects: <ssl_directory>/full_node/private_full_node.{crt,key}
+	ssl_directory = tempfile.mkdtemp(prefix="yakuswap-stub-ssl-")
+	os.makedirs(os.path.join(ssl_directory, "full_node"))
+	cert_path = os.path.join(ssl_directory, "full_node/private_full_node.crt")
+	key_path = os.path.join(ssl_directory, "full_node/private_full_node.key")
+	subprocess.run([
+		"openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes", "-days", "1",
+		"-subj", "/CN=127.0.0.1", "-keyout", key_path, "-out", cert_path
+	], check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+	return ssl_directory
+
+
+class StubNodeHandler(BaseHTTPRequestHandler):
+	protocol_version = "HTTP/1.1"
+	disable_nagle_algorithm = True
+
+	def do_POST(self):
+		self.rfile.read(int(self.headers.get("Content-Length", 0)))
+		body = json.dumps({
+			"blockchain_state": {
+				"peak": {"height": 1000},
+				"sync": {"synced": True},
+			},
+			"success": True,
+		}).encode()
+		self.send_response(200)
+		self.send_header("Content-Type", "application/json")
+		self.send_header("Content-Length", str(len(body)))
+		self.end_headers()
+		self.wfile.write(body)
+
+	def log_message(self, format, *args):
+		pass
+
+
+class StubNode(ThreadingHTTPServer):
+	daemon_threads = True
+
+	def __init__(self, ssl_directory):
+		super().__init__(("127.0.0.1", 0), StubNodeHandler)
+		context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+		context.load_cert_chain(
+			os.path.join(ssl_directory, "full_node/private_full_node.crt"),
+			os.path.join(ssl_directory, "full_node/private_full_node.key")
+		)
+		self.socket = context.wrap_socket(self.socket, server_side=True)
+		self.connections = 0
+		self.port = self.server_address[1]
+
+	def get_request(self):
+		request = super().get_request()
+		self.connections += 1
+		return request
+
+	def start(self):
+		threading.Thread(target=self.serve_forever, daemon=True).start()
+		return self
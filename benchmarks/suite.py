@@ -0,0 +1,403 @@
+# End-to-end benchmark suite for the swap hot paths. Runs offline: it works in a temporary
+# directory (its own data.db, puzzle cache and trade logs) and swaps against simulated nodes.
+# Run from the repository root:
+#
+#   python -m benchmarks.suite --output before.json
+#   python -m benchmarks.suite --output after.json --compare before.json
+#
+# --compare exits with status 1 if any benchmark got slower than --threshold (default 25%).
+import argparse
+import asyncio
+import atexit
+import hashlib
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+REPO_DIRECTORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# files the server opens relative to its working directory
+REPO_FILES = ["contract.clvm", "networks.json"]
+
+
+def measure(fn, number, repeat=3):
+	# best of repeat runs, in seconds per call
+	best = None
+	for _ in range(repeat):
+		start = time.perf_counter()
+		for _ in range(number):
+			fn()
+		elapsed = (time.perf_counter() - start) / number
+		best = elapsed if best is None else min(best, elapsed)
+	return best
+
+def result(seconds, ops, **extra):
+	return {"seconds_per_op": seconds, "ops": ops, **extra}
+
+def randomAddress(prefix):
+	from bech32m import encode_puzzle_hash
+	return encode_puzzle_hash(os.urandom(32), prefix)
+
+def randomTrade():
+	return (
+		os.urandom(32).hex(),
+		int.from_bytes(os.urandom(5), "big") + 1000,
+		int.from_bytes(os.urandom(1), "big"),
+		randomAddress("xch"),
+		randomAddress("xch"),
+		int.from_bytes(os.urandom(2), "big"),
+	)
+
+
+def benchContractTemplateCompile(args):
+	import contract_helper
+	contract_helper.contract_template = None
+	start = time.perf_counter()
+	contract_helper.getContractTemplate()
+	return result(time.perf_counter() - start, 1)
+
+def benchContractProgramCold(args):
+	import contract_helper
+	trades = [randomTrade() for _ in range(args.ops)]
+	contract_helper.getContractTemplate()
+	contract_helper.cache.clear()
+	start = time.perf_counter()
+	for trade in trades:
+		contract_helper.getContractProgram(*trade)
+	return result((time.perf_counter() - start) / len(trades), len(trades))
+
+def benchContractProgramWarm(args):
+	import contract_helper
+	trade = randomTrade()
+	contract_helper.getContractProgram(*trade)
+	return result(measure(lambda: contract_helper.getContractProgram(*trade), args.ops * 10), args.ops * 10)
+
+def benchProgramToPuzzleHash(args):
+	import contract_helper
+	from clvm_tools.sha256tree import sha256tree
+	from tree_hash import tree_hasher
+	program = contract_helper.getContractProgram(*randomTrade())
+	# sha256tree hashes the whole tree, tree_hasher only what's outside the remembered template
+	# (a new contract), and programToPuzzleHash is the memoized cost of a program seen before
+	uncached = measure(lambda: sha256tree(program), args.ops)
+	new_program = measure(lambda: tree_hasher.hash(program), args.ops * 10)
+	cached = measure(lambda: contract_helper.programToPuzzleHash(program), args.ops * 10)
+	return result(uncached, args.ops, new_program_seconds_per_op=new_program, cached_seconds_per_op=cached)
+
+def benchContractPuzzleHash(args):
+	import contract_helper
+	contract_helper.getContractTemplateHash()
+	trades = [randomTrade() for _ in range(args.ops)]
+	contract_helper.contract_puzzle_hash_cache.clear()
+	start = time.perf_counter()
+	for trade in trades:
+		contract_helper.getContractPuzzleHash(*trade)
+	return result((time.perf_counter() - start) / len(trades), len(trades))
+
+def benchEncodePuzzleHash(args):
+	from bech32m import encode_puzzle_hash
+	puzzle_hash = os.urandom(32)
+	return result(measure(lambda: encode_puzzle_hash(puzzle_hash, "xch"), args.ops * 10), args.ops * 10)
+
+def benchDecodePuzzleHash(args):
+	from bech32m import decode_puzzle_hash
+	address = randomAddress("xch")
+	return result(measure(lambda: decode_puzzle_hash(address), args.ops * 10), args.ops * 10)
+
+def benchGetSolutionProgram(args):
+	from contract_helper import getSolutionProgram
+	getSolutionProgram("warm up the compiler")
+	return result(measure(lambda: getSolutionProgram("a secret"), args.ops), args.ops)
+
+def benchGetSecretFromSolutionProgram(args):
+	from contract_helper import getSolutionProgram, getSecretFromSolutionProgram
+	solution = getSolutionProgram("a secret").as_bin().hex()
+	return result(measure(lambda: getSecretFromSolutionProgram(solution), args.ops * 10), args.ops * 10)
+
+
+def tradeCurrencyJson(id, prefix, total_amount, max_block_height=1000, min_confirmation_height=2):
+	return {
+		"id": id,
+		"address_prefix": prefix,
+		"fee": 10,
+		"max_block_height": max_block_height,
+		"min_confirmation_height": min_confirmation_height,
+		"from_address": randomAddress(prefix),
+		"to_address": randomAddress(prefix),
+		"total_amount": total_amount,
+	}
+
+def benchTradesListing(args):
+	from bulk_trades import importTrades
+	import main
+	lines = []
+	for i in range(args.listing_rows):
+		lines.append(json.dumps({
+			"type": "trade",
+			"id": f"listing-{i:06}",
+			"trade_currency_one": tradeCurrencyJson(f"listing-{i:06}-1", "xch", 1000000),
+			"trade_currency_two": tradeCurrencyJson(f"listing-{i:06}-2", "xfx", 2000000),
+			"secret_hash": "0x" + os.urandom(32).hex(),
+			"is_buyer": True,
+			"secret": "",
+			"step": i % 3,
+		}))
+	importTrades(lines)
+
+	client = main.app.test_client()
+	def listAll():
+		response = client.get("/api/trades")
+		assert len(response.get_json()["trades"]) >= args.listing_rows
+	def listPage():
+		response = client.get("/api/trades?limit=100&cursor=listing-005000")
+		assert len(response.get_json()["trades"]) == 100
+	return result(measure(listAll, 1), 1, rows=args.listing_rows, page_seconds_per_op=measure(listPage, 20))
+
+
+def benchBulkRoundTrip(args):
+	# trades saved through the API, with null wherever PUT allows it, must come back unchanged from an export and import
+	from bulk_trades import importTrades, exportTrades
+	import main
+	client = main.app.test_client()
+	for i in range(args.round_trip_rows):
+		secret = None if i % 2 == 0 else os.urandom(16).hex()
+		response = client.put(f"/api/trade/round-trip-{i:05}", json={
+			"trade_currency_one": tradeCurrencyJson(f"round-trip-{i:05}-1", "xch", 1000000),
+			"trade_currency_two": tradeCurrencyJson(f"round-trip-{i:05}-2", "xfx", 2000000),
+			"secret_hash": "0x" + os.urandom(32).hex(),
+			"is_buyer": secret is not None,
+			"secret": secret,
+			"step": 0,
+		})
+		assert response.status_code == 200, response.get_data(as_text=True)
+		response = client.put(f"/api/eth/trade/round-trip-eth-{i:05}", json={
+			"trade_currency": tradeCurrencyJson(f"round-trip-eth-{i:05}", "xch", 1000000),
+			"eth_from_address": "0x" + os.urandom(20).hex(),
+			"eth_to_address": "0x" + os.urandom(20).hex(),
+			"total_gwei": 1000000,
+			"secret_hash": "0x" + os.urandom(32).hex(),
+			"is_buyer": secret is not None,
+			"secret": secret,
+			"step": 0,
+			"network": "ropsten",
+			"token": None if i % 3 == 0 else "0x" + os.urandom(20).hex(),
+		})
+		assert response.status_code == 200, response.get_data(as_text=True)
+
+	start = time.perf_counter()
+	exported = list(exportTrades())
+	export_seconds = time.perf_counter() - start
+	start = time.perf_counter()
+	imported = importTrades(exported)
+	import_seconds = time.perf_counter() - start
+	assert imported["invalid"] == 0, imported["errors"]
+	assert list(exportTrades()) == exported, "trades changed in an export and import"
+	return result((export_seconds + import_seconds) / len(exported), len(exported), export_seconds=export_seconds, import_seconds=import_seconds)
+
+def benchSimulatedSwap(args):
+	# buyer and seller sides of each swap run in this process (or in --shards worker processes)
+	# against two simulated chains, with every asyncio.sleep in the engine (fixed waits, height
+	# polling) shortened by --time-scale
+	from benchmarks.node_simulator import NodeSimulator
+	from benchmarks.stub_node import makeSslDirectory
+	from bech32m import decode_puzzle_hash
+	from contract_helper import getContractProgram, programToPuzzleHash
+	from db import engine, currencies, upsert
+	from bulk_trades import importTrades
+	from trade_state import FINISHED, FAILED
+	import main
+
+	ssl_directory = makeSslDirectory()
+	nodes = {}
+	for prefix in ["xch", "xfx"]:
+		nodes[prefix] = NodeSimulator(ssl_directory, block_time=args.block_time).start()
+		with engine.begin() as conn:
+			conn.execute(upsert(currencies, dict(
+				address_prefix = prefix,
+				name = prefix,
+				photo_url = "",
+				units_per_coin = 1000000000000,
+				min_fee = 0,
+				default_max_block_height = 1000,
+				default_min_confirmation_height = 2,
+				host = "127.0.0.1",
+				port = nodes[prefix].port,
+				ssl_directory = ssl_directory
+			)))
+
+	contracts = {} # contract puzzle hash -> (prefix, amount)
+	lines = []
+	trade_ids = []
+	for i in range(args.swaps):
+		secret = os.urandom(16).hex()
+		legs = [tradeCurrencyJson(None, "xch", 1000000), tradeCurrencyJson(None, "xfx", 2000000)]
+		for leg in legs:
+			program = getContractProgram("0x" + hashlib.sha256(secret.encode()).hexdigest(), leg["total_amount"], leg["fee"], leg["from_address"], leg["to_address"], leg["max_block_height"])
+			contracts[programToPuzzleHash(program)] = (leg["address_prefix"], leg["total_amount"] - leg["fee"])
+		for side, is_buyer in [("buyer", True), ("seller", False)]:
+			trade_id = f"swap-{i}-{side}"
+			trade_ids.append(trade_id)
+			lines.append(json.dumps({
+				"type": "trade",
+				"id": trade_id,
+				"trade_currency_one": {**legs[0], "id": f"{trade_id}-1"},
+				"trade_currency_two": {**legs[1], "id": f"{trade_id}-2"},
+				"secret_hash": "0x" + hashlib.sha256(secret.encode()).hexdigest(),
+				"is_buyer": is_buyer,
+				"secret": secret if is_buyer else "",
+				"step": 0,
+			}))
+	importTrades(lines)
+
+	if args.shards > 0:
+		import trade_shards
+		os.environ["PYTHONPATH"] = REPO_DIRECTORY
+		command = [sys.executable, "-m", "benchmarks.shard_worker", str(args.time_scale), os.path.join(REPO_DIRECTORY, "main.py")]
+		main.shard_pool = trade_shards.ShardPool(args.shards, main.trade_registry, command)
+
+	original_sleep = asyncio.sleep
+	async def scaledSleep(delay, result=None):
+		return await original_sleep(delay * args.time_scale, result)
+	asyncio.sleep = scaledSleep
+	try:
+		start = time.perf_counter()
+		states = [main.startTrade(trade_id, main.tradeCode, f"{trade_id}-log.txt") for trade_id in trade_ids]
+		funded = set()
+		while time.perf_counter() - start < args.swap_timeout:
+			for state in states:
+				# plays the humans: fund a contract once its issuer is asked to
+				if state.address is not None and state.message.startswith("Please send"):
+					puzzle_hash = decode_puzzle_hash(state.address)
+					if puzzle_hash not in funded:
+						prefix, amount = contracts[puzzle_hash]
+						nodes[prefix].chain.createCoin(puzzle_hash, amount)
+						funded.add(puzzle_hash)
+			# trades are done once their claim is in the mempool; the swap once it's in a block
+			if all(state.status in (FINISHED, FAILED) for state in states) and sum(node.chain.stats["spends"] for node in nodes.values()) >= 2 * args.swaps:
+				break
+			time.sleep(0.01)
+		elapsed = time.perf_counter() - start
+	finally:
+		asyncio.sleep = original_sleep
+		if main.shard_pool is not None:
+			main.shard_pool.stop()
+			main.shard_pool = None
+
+	finished = sum(1 for state in states if state.status == FINISHED)
+	spends = sum(node.chain.stats["spends"] for node in nodes.values())
+	node_requests = {}
+	for node in nodes.values():
+		for path, count in node.requests.items():
+			node_requests[path] = node_requests.get(path, 0) + count
+		node.stop()
+	if finished != len(states) or spends != 2 * args.swaps:
+		raise Exception(f"only {finished}/{len(states)} trades finished and {spends}/{2 * args.swaps} contracts were claimed")
+	return result(elapsed / args.swaps, args.swaps, total_seconds=elapsed, node_requests=node_requests, time_scale=args.time_scale, block_time=args.block_time, shards=args.shards)
+
+
+BENCHMARKS = [
+	("contract_template_compile", benchContractTemplateCompile),
+	("contract_program_cold", benchContractProgramCold),
+	("contract_program_warm", benchContractProgramWarm),
+	("program_to_puzzle_hash", benchProgramToPuzzleHash),
+	("contract_puzzle_hash", benchContractPuzzleHash),
+	("encode_puzzle_hash", benchEncodePuzzleHash),
+	("decode_puzzle_hash", benchDecodePuzzleHash),
+	("get_solution_program", benchGetSolutionProgram),
+	("get_secret_from_solution_program", benchGetSecretFromSolutionProgram),
+	("trades_listing", benchTradesListing),
+	("bulk_round_trip", benchBulkRoundTrip),
+	("simulated_swap", benchSimulatedSwap),
+]
+
+
+def gitCommit():
+	try:
+		return subprocess.run(["git", "rev-parse", "HEAD"], cwd=REPO_DIRECTORY, capture_output=True, text=True, check=True).stdout.strip()
+	except Exception:
+		return None
+
+def compare(results, baseline, threshold):
+	# returns the names of benchmarks that got slower than threshold (a fraction)
+	regressions = []
+	print(f"{'benchmark':36} {'baseline':>14} {'current':>14} {'change':>9}")
+	for name, current in results.items():
+		before = baseline.get("results", {}).get(name, None)
+		if before is None or "seconds_per_op" not in current:
+			continue
+		change = current["seconds_per_op"] / before["seconds_per_op"] - 1
+		flag = ""
+		if change > threshold:
+			regressions.append(name)
+			flag = "  REGRESSION"
+		print(f"{name:36} {before['seconds_per_op'] * 1e6:12.2f}us {current['seconds_per_op'] * 1e6:12.2f}us {change * 100:+8.1f}%{flag}")
+	return regressions
+
+def main():
+	parser = argparse.ArgumentParser()
+	parser.add_argument("--only", nargs="*", help="names of the benchmarks to run")
+	parser.add_argument("--ops", type=int, default=200, help="iterations for the micro benchmarks")
+	parser.add_argument("--listing-rows", type=int, default=10000)
+	parser.add_argument("--round-trip-rows", type=int, default=500, help="trades and ETH trades saved for bulk_round_trip")
+	parser.add_argument("--swaps", type=int, default=1, help="concurrent simulated swaps")
+	parser.add_argument("--block-time", type=float, default=0.2, help="seconds between simulated blocks")
+	parser.add_argument("--time-scale", type=float, default=0.01, help="factor applied to the engine's asyncio.sleep calls")
+	parser.add_argument("--swap-timeout", type=float, default=120)
+	parser.add_argument("--shards", type=int, default=0, help="run the simulated swaps' trades in this many worker processes")
+	parser.add_argument("--output", help="write the results as JSON to this file")
+	parser.add_argument("--compare", help="results JSON of an earlier run to compare against")
+	parser.add_argument("--threshold", type=float, default=0.25)
+	args = parser.parse_args()
+
+	work_directory = tempfile.mkdtemp(prefix="yakuswap-bench-")
+	# registered first so it runs last, after the trade log writer has flushed
+	atexit.register(shutil.rmtree, work_directory, True)
+	for name in REPO_FILES:
+		shutil.copy(os.path.join(REPO_DIRECTORY, name), work_directory)
+	os.chdir(work_directory)
+	sys.path.insert(0, REPO_DIRECTORY)
+
+	import puzzle_cache
+	# measure the in-process paths, not the on-disk puzzle cache
+	puzzle_cache.puzzle_cache_enabled = False
+
+	results = {}
+	for name, fn in BENCHMARKS:
+		if args.only and name not in args.only:
+			continue
+		try:
+			results[name] = fn(args)
+			print(f"{name}: {json.dumps(results[name])}", file=sys.stderr)
+		except Exception as e:
+			results[name] = {"error": repr(e)}
+			print(f"{name}: failed: {e!r}", file=sys.stderr)
+
+	output = {
+		"commit": gitCommit(),
+		"python": platform.python_version(),
+		"timestamp": time.time(),
+		"results": results,
+	}
+	if args.output is not None:
+		with open(os.path.join(REPO_DIRECTORY, args.output) if not os.path.isabs(args.output) else args.output, "w") as f:
+			json.dump(output, f, indent=4)
+	else:
+		print(json.dumps(output, indent=4))
+
+	failed = [name for name, r in results.items() if "error" in r]
+	if args.compare is not None:
+		path = args.compare if os.path.isabs(args.compare) else os.path.join(REPO_DIRECTORY, args.compare)
+		with open(path, "r") as f:
+			baseline = json.load(f)
+		if len(compare(results, baseline, args.threshold)) > 0:
+			sys.exit(1)
+	if len(failed) > 0:
+		sys.exit(1)
+
+
+if __name__ == "__main__":
+	main()
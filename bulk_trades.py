@@ -0,0 +1,194 @@
+from sqlalchemy import select
+from db import trade_currencies, trades, eth_trades, engine, upsert
+from utils import tradesRowToJson, ethTradesRowToJson, tradeCurrencyColumnsToJson
+import argparse
+import json
+import sys
+
+# Trades are moved between hosts as JSON Lines: one trade per line, in the same shape the
+# /api/trades and /api/eth/trades listings use, plus a "type" of "trade" or "eth_trade".
+IMPORT_CHUNK_SIZE = 500
+EXPORT_CHUNK_SIZE = 500
+# an import keeps going past invalid lines, but only reports the first few
+MAX_REPORTED_ERRORS = 100
+
+TRADE_CURRENCY_FIELDS = {
+	'id': str,
+	'address_prefix': str,
+	'fee': int,
+	'max_block_height': int,
+	'min_confirmation_height': int,
+	'from_address': str,
+	'to_address': str,
+	'total_amount': int,
+}
+
+TRADE_FIELDS = {
+	'id': str,
+	'trade_currency_one': dict,
+	'trade_currency_two': dict,
+	'secret_hash': str,
+	'is_buyer': bool,
+	'secret': str,
+	'step': int,
+}
+
+ETH_TRADE_FIELDS = {
+	'id': str,
+	'trade_currency': dict,
+	'eth_from_address': str,
+	'eth_to_address': str,
+	'total_gwei': int,
+	'secret_hash': str,
+	'is_buyer': bool,
+	'secret': str,
+	'step': int,
+	'network': str,
+	'token': str,
+}
+
+# PUT /api/trade/<id> and /api/eth/trade/<id> accept null for these, so exports can contain it
+NULLABLE_TRADE_FIELDS = {'secret_hash', 'is_buyer', 'secret', 'step'}
+NULLABLE_ETH_TRADE_FIELDS = {'eth_from_address', 'eth_to_address', 'total_gwei', 'secret_hash', 'is_buyer', 'secret', 'step', 'network', 'token'}
+
+
+def joinedTradeCurrencyColumns(alias):
+	return [column.label(f"{alias.name}_{column.name}") for column in alias.c]
+
+def selectTradesWithCurrencies():
+	# returns (select, tc1, tc2); currency columns are labeled tc1_* and tc2_*
+	tc1 = trade_currencies.alias('tc1')
+	tc2 = trade_currencies.alias('tc2')
+	s = select(trades, *joinedTradeCurrencyColumns(tc1), *joinedTradeCurrencyColumns(tc2)).select_from(
+		trades.join(tc1, trades.c.trade_currency_one == tc1.c.id).join(tc2, trades.c.trade_currency_two == tc2.c.id)
+	)
+	return s, tc1, tc2
+
+def selectEthTradesWithCurrencies():
+	# returns (select, tc); currency columns are labeled tc_*
+	tc = trade_currencies.alias('tc')
+	s = select(eth_trades, *joinedTradeCurrencyColumns(tc)).select_from(
+		eth_trades.join(tc, eth_trades.c.trade_currency == tc.c.id)
+	)
+	return s, tc
+
+
+def checkFields(data, fields, name, nullable=()):
+	if not isinstance(data, dict):
+		raise ValueError(f"{name} must be an object")
+	for field, field_type in fields.items():
+		value = data.get(field, None)
+		if value is None and field in nullable:
+			continue
+		# bool is a subclass of int, but true isn't a valid amount
+		if not isinstance(value, field_type) or (field_type is int and isinstance(value, bool)):
+			raise ValueError(f"{name}.{field} must be of type {field_type.__name__}")
+
+def tradeCurrencyValues(data, name):
+	checkFields(data, TRADE_CURRENCY_FIELDS, name)
+	return {field: data[field] for field in TRADE_CURRENCY_FIELDS}
+
+def parseLine(line):
+	# returns (table, row, trade currency rows)
+	data = json.loads(line)
+	if not isinstance(data, dict):
+		raise ValueError("line must be an object")
+	if data.get('type', None) == 'trade':
+		checkFields(data, TRADE_FIELDS, 'trade', NULLABLE_TRADE_FIELDS)
+		currency_rows = [
+			tradeCurrencyValues(data['trade_currency_one'], 'trade_currency_one'),
+			tradeCurrencyValues(data['trade_currency_two'], 'trade_currency_two')
+		]
+		row = {field: data[field] for field in TRADE_FIELDS}
+		row['trade_currency_one'] = currency_rows[0]['id']
+		row['trade_currency_two'] = currency_rows[1]['id']
+		return trades, row, currency_rows
+	if data.get('type', None) == 'eth_trade':
+		checkFields(data, ETH_TRADE_FIELDS, 'eth_trade', NULLABLE_ETH_TRADE_FIELDS)
+		currency_rows = [tradeCurrencyValues(data['trade_currency'], 'trade_currency')]
+		row = {field: data[field] for field in ETH_TRADE_FIELDS}
+		row['trade_currency'] = currency_rows[0]['id']
+		return eth_trades, row, currency_rows
+	raise ValueError("type must be 'trade' or 'eth_trade'")
+
+
+def writeChunk(chunk):
+	# chunk maps table -> rows; currencies go first so trades never point to missing rows
+	with engine.begin() as conn:
+		for table in [trade_currencies, trades, eth_trades]:
+			if len(chunk[table]) > 0:
+				conn.execute(upsert(table), chunk[table])
+
+def importTrades(lines, chunk_size=IMPORT_CHUNK_SIZE):
+	# lines can be any iterable of str or bytes, e.g. an open file or a request stream
+	result = {'trades': 0, 'eth_trades': 0, 'invalid': 0, 'errors': []}
+	chunk = {trade_currencies: [], trades: [], eth_trades: []}
+	chunk_len = 0
+
+	for line_number, line in enumerate(lines, start=1):
+		if len(line.strip()) == 0:
+			continue
+		try:
+			table, row, currency_rows = parseLine(line)
+		except Exception as e:
+			result['invalid'] += 1
+			if len(result['errors']) < MAX_REPORTED_ERRORS:
+				result['errors'].append({'line': line_number, 'error': str(e)})
+			continue
+
+		chunk[trade_currencies] += currency_rows
+		chunk[table].append(row)
+		result[table.name] += 1
+		chunk_len += 1
+		if chunk_len >= chunk_size:
+			writeChunk(chunk)
+			chunk = {trade_currencies: [], trades: [], eth_trades: []}
+			chunk_len = 0
+
+	if chunk_len > 0:
+		writeChunk(chunk)
+	return result
+
+def exportTrades(chunk_size=EXPORT_CHUNK_SIZE):
+	# yields one JSON line per trade, fetching chunk_size rows at a time
+	conn = engine.connect()
+	try:
+		s, tc1, tc2 = selectTradesWithCurrencies()
+		for rows in conn.execute(s.order_by(trades.c.id)).partitions(chunk_size):
+			for row in rows:
+				data = tradesRowToJson(row, tradeCurrencyColumnsToJson(row, 'tc1_'), tradeCurrencyColumnsToJson(row, 'tc2_'))
+				data['type'] = 'trade'
+				yield json.dumps(data) + "\n"
+
+		s, tc = selectEthTradesWithCurrencies()
+		for rows in conn.execute(s.order_by(eth_trades.c.id)).partitions(chunk_size):
+			for row in rows:
+				data = ethTradesRowToJson(row, tradeCurrencyColumnsToJson(row, 'tc_'))
+				data['type'] = 'eth_trade'
+				yield json.dumps(data) + "\n"
+	finally:
+		conn.close()
+
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description="Import or export yakuSwap trades as JSON Lines")
+	subparsers = parser.add_subparsers(dest='command', required=True)
+	import_parser = subparsers.add_parser('import', help="read trades into data.db")
+	import_parser.add_argument('file', nargs='?', default='-', help="JSON Lines file, - for stdin")
+	import_parser.add_argument('--chunk-size', type=int, default=IMPORT_CHUNK_SIZE)
+	export_parser = subparsers.add_parser('export', help="write every trade in data.db")
+	export_parser.add_argument('file', nargs='?', default='-', help="output file, - for stdout")
+	args = parser.parse_args()
+
+	if args.command == 'import':
+		f = sys.stdin if args.file == '-' else open(args.file, "r")
+		with f:
+			result = importTrades(f, args.chunk_size)
+		print(json.dumps(result, indent=4))
+		if result['invalid'] > 0:
+			sys.exit(1)
+	else:
+		f = sys.stdout if args.file == '-' else open(args.file, "w")
+		with f:
+			for line in exportTrades():
+				f.write(line)
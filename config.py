@@ -1,4 +1,25 @@
 try:
 	debug = open(".debug", "r").read().strip().lower() == "true"
 except:
-	debug = False
\ No newline at end of file
+	debug = False
+
+try:
+	puzzle_cache_enabled = open(".puzzle_cache", "r").read().strip().lower() != "false"
+except:
+	puzzle_cache_enabled = True
+
+
+try:
+	auto_resume_enabled = open(".auto_resume", "r").read().strip().lower() != "false"
+except:
+	auto_resume_enabled = True
+
+try:
+	trade_shard_count = int(open(".trade_shards", "r").read().strip())
+except:
+	trade_shard_count = 0
+
+try:
+	connection_status_timeout = float(open(".connection_status_timeout", "r").read().strip())
+except:
+	connection_status_timeout = 3
@@ -1,56 +1,193 @@
 import sys
-import blspy
 import io
+import threading
+import hashlib
+import puzzle_cache
+import metrics
 from bech32m import decode_puzzle_hash, encode_puzzle_hash
-from helper import bytes32
+from helper import bytes32, LRUCache
 from clvm.SExp import SExp
 from clvm.serialize import sexp_from_stream
-from clvm_tools.clvmc import compile_clvm_text
-from clvm_tools.curry import curry
-from clvm_tools.sha256tree import sha256tree
+from clvm.casts import int_to_bytes
+from tree_hash import tree_hasher
 from config import debug
 
 def getPuzzleHashFromAddress(address: str) -> str:
 	return "0x" + decode_puzzle_hash(address).hex()
 
+CONTRACT_CACHE_SIZE = 4096
+
+# argument tuple -> curried contract program
+cache = LRUCache(CONTRACT_CACHE_SIZE)
+# id(program) -> (program, puzzle hash); the program is kept so its id can't be reused while cached
+puzzle_hash_cache = LRUCache(CONTRACT_CACHE_SIZE)
+# (puzzle hash, prefix) -> address
+address_cache = LRUCache(CONTRACT_CACHE_SIZE)
+# argument tuple -> puzzle hash of the curried contract
+contract_puzzle_hash_cache = LRUCache(CONTRACT_CACHE_SIZE)
+
 def getAddressFromPuzzleHash(puzzleHash: bytes32, prefix: str) -> str:
-	return encode_puzzle_hash(puzzleHash, prefix)
+	cache_id = (bytes(puzzleHash), prefix)
+	ret = address_cache.get(cache_id)
+	if ret is None:
+		ret = encode_puzzle_hash(puzzleHash, prefix)
+		address_cache.put(cache_id, ret)
+	return ret
+
+# first, huge thanks to all those who left the yakuswap_address variable unchanged
+# this project was created by a guy in his spare time
+# you can't imagine how much thinking, planning, checking, and testing went into the final application
+# the 0.7% fee motivates me to provide support and continue developing this project
+# so, before changing the line below, please reconsider your position
+YAKUSWAP_ADDRESS = "xch1k6mv3caj73akwp0ygpqhjpat20mu3akc3f6xdrc5ahcqkynl7ejq2z74n3"
+YAKUSWAP_PUZZLE_HASH = decode_puzzle_hash(YAKUSWAP_ADDRESS)
+
+contract_template = None
+contract_template_lock = threading.Lock()
+contract_source_hash = None
+contract_template_hash = None
+
+def getContractTemplate() -> SExp:
+	# contract.clvm only needs to be compiled once per process
+	global contract_template
+	if contract_template is None:
+		with contract_template_lock:
+			if contract_template is None:
+				# the clvm compiler takes a few hundred ms to import, so it's only loaded when needed
+				from clvm_tools.clvmc import compile_clvm_text
+				contract = open("contract.clvm", "r").read()
+				if debug:
+					print(contract)
+				template = compile_clvm_text(contract, [])
+				# every curried contract contains the template, so its hashes are computed once here
+				tree_hasher.remember(template)
+				contract_template = template
+	return contract_template
+
+def getContractTemplateHash() -> bytes:
+	# stored in the persistent cache next to the curried programs, so computing contract
+	# puzzle hashes after a restart doesn't need the clvm compiler either
+	global contract_template_hash
+	if contract_template_hash is None:
+		persistent_cache_id = "template-" + getContractSourceHash().hex()
+		stored = puzzle_cache.getPuzzle(persistent_cache_id)
+		if stored is not None:
+			contract_template_hash = stored[1]
+		else:
+			template = getContractTemplate()
+			template_hash = tree_hasher.hash(template)
+			puzzle_cache.putPuzzle(persistent_cache_id, template.as_bin(), template_hash)
+			contract_template_hash = template_hash
+	return contract_template_hash
+
+def getContractSourceHash() -> bytes:
+	global contract_source_hash
+	if contract_source_hash is None:
+		contract_source_hash = hashlib.sha256(open("contract.clvm", "rb").read()).digest()
+	return contract_source_hash
+
+def getPersistentCacheId(curry_args: list) -> str:
+	return hashlib.sha256(getContractSourceHash() + SExp.to(curry_args).as_bin()).hexdigest()
+
+def curryProgram(program: SExp, args: list) -> SExp:
+	# builds (a (q . program) (c (q . arg1) (c (q . arg2) ... 1))) directly
+	# instead of running the curry program through the clvm interpreter
+	env = SExp.to(1)
+	for arg in reversed(args):
+		env = SExp.to([4, (1, arg), env])
+	return SExp.to([2, (1, program), env])
+
+def _pairHash(left: bytes, right: bytes) -> bytes:
+	return hashlib.sha256(b"\2" + left + right).digest()
+
+NIL_HASH = hashlib.sha256(b"\1").digest()
+QUOTE_HASH = hashlib.sha256(b"\1\1").digest()
+APPLY_HASH = hashlib.sha256(b"\1\2").digest()
+CONS_HASH = hashlib.sha256(b"\1\4").digest()
+
+def _atomHash(arg) -> bytes:
+	# the curry arguments are all atoms; SExp.to would work too but is much slower
+	return hashlib.sha256(b"\1" + (int_to_bytes(arg) if isinstance(arg, int) else bytes(arg))).digest()
 
-cache = {}
+def curryTreeHash(program_hash: bytes, arg_hashes: list) -> bytes32:
+	# the tree hash of curryProgram(program, args), from the hashes of program and args alone
+	env_hash = QUOTE_HASH # the innermost environment is the atom 1
+	for arg_hash in reversed(arg_hashes):
+		quoted_arg = _pairHash(QUOTE_HASH, arg_hash)
+		env_hash = _pairHash(CONS_HASH, _pairHash(quoted_arg, _pairHash(env_hash, NIL_HASH)))
+	quoted_program = _pairHash(QUOTE_HASH, program_hash)
+	return bytes32(_pairHash(APPLY_HASH, _pairHash(quoted_program, _pairHash(env_hash, NIL_HASH))))
+
+def getContractCurryArgs(secret_hash: str, total_amount: int, fee: int, from_address: str, to_address: str, max_block_height: int) -> list:
+	if secret_hash.startswith("0x"):
+		secret_hash = secret_hash[2:]
+
+	return [
+		bytes.fromhex(secret_hash),
+		total_amount - fee,
+		fee,
+		decode_puzzle_hash(from_address),
+		decode_puzzle_hash(to_address),
+		YAKUSWAP_PUZZLE_HASH,
+		max_block_height,
+	]
 
 def getContractProgram(secret_hash: str, total_amount: int, fee: int, from_address: str, to_address: str, max_block_height: int) -> SExp:
-	cache_id = f"{secret_hash}{total_amount}{fee}{from_address}{to_address}{max_block_height}"
-	if not secret_hash.startswith("0x"):
-		secret_hash = "0x" + secret_hash
-	if cache.get(cache_id, -1) != -1:
-		return cache[cache_id]
-
-	amount = str(total_amount - fee)
-	fee = str(fee)
-	max_block_height = str(max_block_height)
-	# first, huge thanks to all those who left the yakuswap_address variable unchanged
-	# this project was created by a guy in his spare time
-	# you can't imagine how much thinking, planning, checking, and testing went into the final application
-	# the 0.7% fee motivates me to provide support and continue developing this project
-	# so, before changing the line below, please reconsider your position
-	yakuswap_address = getPuzzleHashFromAddress("xch1k6mv3caj73akwp0ygpqhjpat20mu3akc3f6xdrc5ahcqkynl7ejq2z74n3")
-	to_address = getPuzzleHashFromAddress(to_address)
-	from_address = getPuzzleHashFromAddress(from_address)
-	
-	contract = open("contract.clvm", "r").read()
-	if debug:
-		print(contract)
-
-	prog_to_curry = compile_clvm_text(contract, []) # .as_bin().hex()
-	curry_args = compile_clvm_text(f"(list {secret_hash} {amount} {fee} {from_address} {to_address} {yakuswap_address} {max_block_height})", [])
-	ret = curry(prog_to_curry, curry_args)[-1]
-	cache[cache_id] = ret
+	cache_id = (secret_hash[2:] if secret_hash.startswith("0x") else secret_hash, total_amount, fee, from_address, to_address, max_block_height)
+	ret = cache.get(cache_id)
+	if ret is not None:
+		return ret
+
+	curry_args = getContractCurryArgs(secret_hash, total_amount, fee, from_address, to_address, max_block_height)
+	persistent_cache_id = getPersistentCacheId(curry_args)
+	stored = puzzle_cache.getPuzzle(persistent_cache_id)
+	if stored is not None:
+		program, puzzle_hash = stored
+		ret = sexp_from_stream(io.BytesIO(program), SExp.to)
+		puzzle_hash_cache.put(id(ret), (ret, puzzle_hash))
+	else:
+		ret = curryProgram(getContractTemplate(), curry_args)
+		puzzle_cache.putPuzzle(persistent_cache_id, ret.as_bin(), programToPuzzleHash(ret))
+	cache.put(cache_id, ret)
+
+	return ret
+
+def getContractPuzzleHash(secret_hash: str, total_amount: int, fee: int, from_address: str, to_address: str, max_block_height: int) -> bytes32:
+	# same as programToPuzzleHash(getContractProgram(...)) without building the program
+	cache_id = (secret_hash[2:] if secret_hash.startswith("0x") else secret_hash, total_amount, fee, from_address, to_address, max_block_height)
+	ret = contract_puzzle_hash_cache.get(cache_id)
+	if ret is not None:
+		return ret
 
+	program = cache.get(cache_id)
+	if program is not None:
+		ret = bytes32(programToPuzzleHash(program))
+	else:
+		curry_args = getContractCurryArgs(secret_hash, total_amount, fee, from_address, to_address, max_block_height)
+		ret = curryTreeHash(getContractTemplateHash(), [_atomHash(arg) for arg in curry_args])
+	contract_puzzle_hash_cache.put(cache_id, ret)
 	return ret
 
+def precacheContract(secret_hash: str, trade_currency: dict) -> None:
+	# called when a trade is saved so that resuming it later finds the program in the persistent cache
+	try:
+		program = getContractProgram(
+			secret_hash,
+			trade_currency['total_amount'],
+			trade_currency['fee'],
+			trade_currency['from_address'],
+			trade_currency['to_address'],
+			trade_currency['max_block_height']
+		)
+		getAddressFromPuzzleHash(programToPuzzleHash(program), trade_currency['address_prefix'])
+	except Exception as e:
+		# the trade itself reports bad addresses or amounts once it runs
+		print(f"Could not precache contract for {secret_hash}: {e!r}")
+
 def getSolutionProgram(secret: str) -> SExp:
 	contract = f"(list \"{secret}\")"
 
+	from clvm_tools.clvmc import compile_clvm_text
 	ret = compile_clvm_text(contract, []) # .as_bin().hex()
 	return ret
 
@@ -64,4 +201,26 @@ def getSecretFromSolutionProgram(program: str) -> str:
 
 
 def programToPuzzleHash(program: SExp) -> bytes32:
-	return sha256tree(program)
+	cached = puzzle_hash_cache.get(id(program))
+	if cached is not None and cached[0] is program:
+		return cached[1]
+
+	ret = tree_hasher.hash(program)
+	puzzle_hash_cache.put(id(program), (program, ret))
+	return ret
+
+def getCacheStats():
+	return {
+		"programs": cache.stats(),
+		"puzzle_hashes": puzzle_hash_cache.stats(),
+		"addresses": address_cache.stats(),
+		"contract_puzzle_hashes": contract_puzzle_hash_cache.stats(),
+	}
+
+def _collectCacheStat(key):
+	return lambda: [((name,), stats[key]) for name, stats in getCacheStats().items()]
+
+metrics.collector("yakuswap_contract_cache_hits_total", "Contract cache hits", "counter", ["cache"], _collectCacheStat("hits"))
+metrics.collector("yakuswap_contract_cache_misses_total", "Contract cache misses", "counter", ["cache"], _collectCacheStat("misses"))
+metrics.collector("yakuswap_contract_cache_evictions_total", "Contract cache evictions", "counter", ["cache"], _collectCacheStat("evictions"))
+metrics.collector("yakuswap_contract_cache_entries", "Entries in the contract caches", "gauge", ["cache"], _collectCacheStat("size"))
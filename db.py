@@ -1,11 +1,62 @@
-from sqlalchemy import create_engine, MetaData, Table, Column, String, ForeignKey, Boolean
+from sqlalchemy import create_engine, event, MetaData, Table, Column, String, ForeignKey, Boolean, Index
+from sqlalchemy.pool import QueuePool
+from sqlalchemy.dialects.sqlite import insert
 from sqlalchemy.dialects.mysql import INTEGER as Integer
 from sqlalchemy.dialects.mysql import BIGINT as BigInteger
 from config import debug
 from pathlib import Path
+import startup_profile
+import metrics
+import time
 import os
 
-engine = create_engine('sqlite:///data.db', echo = debug)
+# how long a connection waits on another writer's lock before sqlite gives up with "database is locked"
+DB_BUSY_TIMEOUT = 30
+# connections kept open between requests. Trades only check one out per query (on the blocking pool,
+# see event_loop.py), so these cover the API's threads and those workers; a burst of requests gets
+# up to DB_POOL_OVERFLOW extra connections, and beyond that waits DB_POOL_TIMEOUT seconds for a free one
+DB_POOL_SIZE = 10
+DB_POOL_OVERFLOW = 4
+DB_POOL_TIMEOUT = 30
+
+engine = create_engine(
+	'sqlite:///data.db',
+	echo = debug,
+	poolclass = QueuePool,
+	pool_size = DB_POOL_SIZE,
+	max_overflow = DB_POOL_OVERFLOW,
+	pool_timeout = DB_POOL_TIMEOUT,
+	connect_args = {'timeout': DB_BUSY_TIMEOUT, 'check_same_thread': False}
+)
+
+@event.listens_for(engine, "connect")
+def setSqlitePragmas(dbapi_connection, connection_record):
+	# WAL lets the API keep reading while trades write their step updates
+	cursor = dbapi_connection.cursor()
+	cursor.execute("PRAGMA journal_mode=WAL")
+	cursor.execute("PRAGMA synchronous=NORMAL")
+	cursor.execute(f"PRAGMA busy_timeout={DB_BUSY_TIMEOUT * 1000}")
+	cursor.close()
+
+query_duration = metrics.histogram("yakuswap_db_query_duration_seconds", "SQLite statement execution time", ["statement"])
+
+@event.listens_for(engine, "before_cursor_execute")
+def startQueryTimer(conn, cursor, statement, parameters, context, executemany):
+	conn.info.setdefault("query_start", []).append(time.perf_counter())
+
+@event.listens_for(engine, "after_cursor_execute")
+def stopQueryTimer(conn, cursor, statement, parameters, context, executemany):
+	# labeled by the first keyword (SELECT, INSERT, ...) to keep the number of series small
+	start = conn.info["query_start"].pop()
+	query_duration.observe(time.perf_counter() - start, statement.lstrip().split(" ", 1)[0].upper())
+
+@event.listens_for(engine, "handle_error")
+def dropQueryTimer(exception_context):
+	# after_cursor_execute isn't called for a statement that raised
+	conn = exception_context.connection
+	if conn is not None and len(conn.info.get("query_start", [])) > 0:
+		conn.info["query_start"].pop()
+
 meta = MetaData()
 
 currencies = Table(
@@ -60,10 +111,75 @@ eth_trades = Table(
 	Column('token', String),
 )
 
-meta.create_all(engine)
+# the contract program cache, see puzzle_cache.py
+puzzles = Table(
+	'puzzles', meta,
+	Column('id', String, primary_key = True),
+	Column('program', String),
+	Column('puzzle_hash', String),
+)
+
+trade_currencies_address_prefix_index = Index('ix_trade_currencies_address_prefix', trade_currencies.c.address_prefix)
+trades_trade_currency_one_index = Index('ix_trades_trade_currency_one', trades.c.trade_currency_one)
+trades_trade_currency_two_index = Index('ix_trades_trade_currency_two', trades.c.trade_currency_two)
+trades_step_index = Index('ix_trades_step', trades.c.step)
+eth_trades_trade_currency_index = Index('ix_eth_trades_trade_currency', eth_trades.c.trade_currency)
+eth_trades_step_index = Index('ix_eth_trades_step', eth_trades.c.step)
+
+def addSecondaryIndexes(conn):
+	# the first migration, so it also creates the tables (and with them these indexes) in a new database
+	meta.create_all(conn)
+	for index in [
+		trade_currencies_address_prefix_index,
+		trades_trade_currency_one_index,
+		trades_trade_currency_two_index,
+		trades_step_index,
+		eth_trades_trade_currency_index,
+		eth_trades_step_index
+	]:
+		index.create(conn, checkfirst = True)
+
+def seedDefaultCurrencies(conn):
+	# existing currencies are left alone, so user edits survive
+	conn.execute(insert(currencies).on_conflict_do_nothing(), default_currencies)
+
+def addPuzzleCache(conn):
+	puzzles.create(conn, checkfirst = True)
+
+# Schema changes, applied in order; the number of applied migrations is stored in sqlite's user_version,
+# so an up-to-date database only costs one PRAGMA at startup. Every migration must be idempotent,
+# and migrations are only ever appended: reordering them changes what existing databases have applied.
+# When adding a currency below, append another seedDefaultCurrencies so existing databases pick it up.
+migrations = [
+	addSecondaryIndexes,
+	seedDefaultCurrencies,
+	addPuzzleCache,
+]
+
+def migrate():
+	with engine.begin() as conn:
+		version = conn.exec_driver_sql("PRAGMA user_version").scalar()
+		for migration in migrations[version:]:
+			migration(conn)
+		if version < len(migrations):
+			conn.exec_driver_sql(f"PRAGMA user_version={len(migrations)}")
 
-conn = engine.connect()
+def upsert(table, values=None):
+	# single INSERT ... ON CONFLICT(primary key) DO UPDATE statement
+	# without values, every column is set and the statement can be executed with a list of rows
+	key = [column.name for column in table.primary_key.columns]
+	st = insert(table)
+	if values is None:
+		names = [column.name for column in table.columns]
+	else:
+		st = st.values(**values)
+		names = list(values)
+	return st.on_conflict_do_update(
+		index_elements = key,
+		set_ = {name: st.excluded[name] for name in names if name not in key}
+	)
 
+default_currencies = []
 
 # Here's how to find the required info for a currency by using its GitHub repos
 # Note: initial-config.yaml is located under {currency-name-lowercase}/util/initial-config.yaml
@@ -78,22 +194,18 @@ def addCurrency(
 	host, # Usually 127.0.0.1
 	port, # Go to initial-config.yaml and look for 'rpc_port' under 'full_node'
 	ssl_directory): # Usually %HOME%/.<NAME>/mainnet/config/ssl - just use the guessSslDirFor(currencyName) function
-	s = currencies.select().where(currencies.c.address_prefix == address_prefix)
-	result = conn.execute(s)
-	if len(result.all()) == 0:
-		ins = currencies.insert().values(
-			address_prefix = address_prefix,
-			name = name,
-			photo_url = photo_url,
-			units_per_coin = units_per_coin,
-			min_fee = min_fee,
-			default_max_block_height = default_max_block_height,
-			default_min_confirmation_height = default_min_confirmation_height,
-			host = host,
-			port = port,
-			ssl_directory = ssl_directory
-		)
-		conn.execute(ins)
+	default_currencies.append(dict(
+		address_prefix = address_prefix,
+		name = name,
+		photo_url = photo_url,
+		units_per_coin = units_per_coin,
+		min_fee = min_fee,
+		default_max_block_height = default_max_block_height,
+		default_min_confirmation_height = default_min_confirmation_height,
+		host = host,
+		port = port,
+		ssl_directory = ssl_directory
+	))
 
 def guessSslDirFor(currencyName):
 	return os.path.join(str(Path.home()), f".{currencyName.lower()}/mainnet/config/ssl")
@@ -125,4 +237,5 @@ addCurrency('cac', 'Cactus', 'https://raw.githubusercontent.com/Cactus-Network/c
 addCurrency('cans', 'Cannabis', 'https://raw.githubusercontent.com/CannabisChain/cannabis-blockchain-gui/main/src/assets/img/cannabis_circle.png', 1000000000000, 1, 192, 32, '127.0.0.1', 5540, guessSslDirFor("Cannabis"))
 addCurrency('xmz', 'Maize', 'https://raw.githubusercontent.com/Maize-Network/maize-blockchain/main/maize-blockchain-gui/src/assets/img/chia_circle.svg', 1000000000000, 1, 192, 32, '127.0.0.1', 8655, guessSslDirFor("Maize"))
 
-conn.close()
\ No newline at end of file
+with startup_profile.phase("db migrations"):
+	migrate()
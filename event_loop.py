@@ -0,0 +1,49 @@
+import asyncio
+import threading
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+# The trade engine runs every swap as a coroutine on this single event loop, which lives in
+# its own thread. Flask request threads talk to it through submit() and call().
+loop = None
+loop_lock = threading.Lock()
+# blocking work (database, clvm compilation, file I/O) runs on this bounded pool, which is also
+# the loop's default executor, instead of on threads started per request
+BLOCKING_WORKERS = 8
+executor = ThreadPoolExecutor(max_workers=BLOCKING_WORKERS, thread_name_prefix="blocking")
+# work nobody waits for, like precaching contracts, runs one job at a time on its own thread,
+# so a burst of it never queues the trades' database calls behind it
+background_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="background")
+
+def getLoop():
+	global loop
+	with loop_lock:
+		if loop is None:
+			loop = asyncio.new_event_loop()
+			loop.set_default_executor(executor)
+			threading.Thread(target=loop.run_forever, daemon=True).start()
+		return loop
+
+def _reportException(future):
+	if not future.cancelled() and future.exception() is not None:
+		traceback.print_exception(type(future.exception()), future.exception(), future.exception().__traceback__)
+
+def submit(coro):
+	# schedules coro on the loop from any thread and returns a concurrent.futures.Future
+	future = asyncio.run_coroutine_threadsafe(coro, getLoop())
+	future.add_done_callback(_reportException)
+	return future
+
+def call(fn, *args):
+	# runs a plain function on the loop thread, e.g. to wake a waiting coroutine
+	getLoop().call_soon_threadsafe(fn, *args)
+
+async def inExecutor(fn, *args):
+	# awaits fn on the blocking pool from a coroutine, so it doesn't stall every other trade on the loop
+	return await asyncio.get_running_loop().run_in_executor(None, fn, *args)
+
+def runInBackground(fn, *args):
+	# runs fn on the background thread from any thread and returns a concurrent.futures.Future
+	future = background_executor.submit(fn, *args)
+	future.add_done_callback(_reportException)
+	return future
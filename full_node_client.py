@@ -1,37 +1,83 @@
 import requests
+from requests.adapters import HTTPAdapter
 import urllib3
 import os
 from helper import bytes32
 import time
+import threading
+import asyncio
+import atexit
+import ssl
+import json
+import metrics
 from config import debug
 
 urllib3.disable_warnings()
 
+SESSION_POOL_SIZE = 10
+CONNECT_TIMEOUT = 5
+READ_TIMEOUT = 30
+SESSION_CLOSE_TIMEOUT = 5
+COIN_RECORD_BATCH_SIZE = 100
+COIN_RECORD_BATCH_DELAY = 0.05
+# after a node answers 404 for the batch endpoint, it's tried again after this many seconds (the node may be upgraded)
+COIN_RECORD_BATCH_REPROBE_DELAY = 600
+
+rpc_duration = metrics.histogram("yakuswap_node_rpc_duration_seconds", "Full node RPC latency, failed requests included", ["endpoint"])
+rpc_failures = metrics.counter("yakuswap_node_rpc_failures_total", "Full node RPCs that failed or didn't return JSON", ["endpoint"])
+
+# One keep-alive session per node, shared by every FullNodeClient pointing at it,
+# so the TLS handshake with the client certificate is only done once per pooled connection.
+sessions = {}
+sessions_lock = threading.Lock()
+
+def getSession(ssl_directory, host, port, pool_size=SESSION_POOL_SIZE):
+	key = (ssl_directory, host, port)
+	with sessions_lock:
+		session = sessions.get(key, None)
+		if session is None:
+			session = requests.Session()
+			session.cert = (
+				os.path.join(ssl_directory, 'full_node/private_full_node.crt'),
+				os.path.join(ssl_directory, 'full_node/private_full_node.key')
+			)
+			adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+			session.mount("https://", adapter)
+			sessions[key] = session
+		return session
+
 class FullNodeClient():
-	def __init__(self, ssl_directory, host, port, logfile=None):
+	def __init__(self, ssl_directory, host, port, logfile=None, timeout=(CONNECT_TIMEOUT, READ_TIMEOUT), pool_size=SESSION_POOL_SIZE):
 		self.cert_path = os.path.join(ssl_directory, 'full_node/private_full_node.crt')
 		self.key_path = os.path.join(ssl_directory, 'full_node/private_full_node.key')
 		self.host = host
 		self.port = port
 		self.API_url = f"https://{host}:{port}"
 		self.logfile = logfile
+		self.timeout = timeout
+		self.session = getSession(ssl_directory, host, port, pool_size)
 
 	def _makeRequest(self, endpoint, data):
 		url = f"{self.API_url}{endpoint}"
 		if debug:
 			print(url)
-		if self.logfile is not None:
-			self.logfile.write(f"Request to {endpoint}, data: {data}\n")
-			self.logfile.flush()
+		start = time.perf_counter()
 		try:
-			r = requests.post(url, json=data, cert=(self.cert_path, self.key_path), verify=False)
+			# verify is passed per request because REQUESTS_CA_BUNDLE would override session.verify
+			r = self.session.post(url, json=data, verify=False, timeout=self.timeout)
 			if debug:
 				print(endpoint, data, r.text)
+			# one log record per request, written once it's done
 			if self.logfile is not None:
 				self.logfile.write(f"Request to {endpoint}, data: {data}, response: {r.text}\n")
-				self.logfile.flush()
-			return r.json()
-		except:
+			ret = r.json()
+			rpc_duration.observe(time.perf_counter() - start, endpoint)
+			return ret
+		except Exception as e:
+			rpc_duration.observe(time.perf_counter() - start, endpoint)
+			rpc_failures.inc(endpoint)
+			if self.logfile is not None:
+				self.logfile.write(f"Request to {endpoint}, data: {data}, failed: {e!r}\n")
 			return {}
 
 	def getBlockchainState(self):
@@ -85,4 +131,339 @@ class FullNodeClient():
 			})
 		if resp == {} or resp.get("coin_solution", -1) == -1:
 			return False
-		return resp["coin_solution"]["solution"]
\ No newline at end of file
+		return resp["coin_solution"]["solution"]
+
+# Async variant used by the trade engine, which runs every swap as a coroutine on one event loop
+# (see event_loop.py). Sessions are per node and per loop, since aiohttp sessions can't be shared across loops.
+async_sessions = {}
+
+def getAsyncSession(ssl_directory, host, port, timeout=(CONNECT_TIMEOUT, READ_TIMEOUT), pool_size=SESSION_POOL_SIZE):
+	loop = asyncio.get_running_loop()
+	key = (loop, ssl_directory, host, port)
+	session = async_sessions.get(key, None)
+	if session is None or session.closed:
+		import aiohttp # imported on first use to keep it off the startup path
+		ssl_context = ssl.create_default_context()
+		ssl_context.check_hostname = False
+		ssl_context.verify_mode = ssl.CERT_NONE
+		ssl_context.load_cert_chain(
+			os.path.join(ssl_directory, 'full_node/private_full_node.crt'),
+			os.path.join(ssl_directory, 'full_node/private_full_node.key')
+		)
+		session = aiohttp.ClientSession(
+			connector=aiohttp.TCPConnector(ssl=ssl_context, limit=pool_size),
+			timeout=aiohttp.ClientTimeout(sock_connect=timeout[0], sock_read=timeout[1])
+		)
+		async_sessions[key] = session
+	return session
+
+def closeAsyncSessions():
+	# aiohttp complains about sessions that are never closed; each one is closed on its own loop
+	for key, session in list(async_sessions.items()):
+		loop = key[0]
+		if session.closed or loop.is_closed() or not loop.is_running():
+			continue
+		try:
+			asyncio.run_coroutine_threadsafe(session.close(), loop).result(SESSION_CLOSE_TIMEOUT)
+		except Exception as e:
+			print(f"Could not close the session for {key[2]}:{key[3]}: {e!r}")
+	async_sessions.clear()
+
+atexit.register(closeAsyncSessions)
+
+class EndpointNotFound(Exception):
+	pass
+
+class AsyncFullNodeClient():
+	def __init__(self, ssl_directory, host, port, logfile=None, timeout=(CONNECT_TIMEOUT, READ_TIMEOUT), pool_size=SESSION_POOL_SIZE):
+		self.ssl_directory = ssl_directory
+		self.host = host
+		self.port = port
+		self.API_url = f"https://{host}:{port}"
+		self.logfile = logfile
+		self.timeout = timeout
+		self.pool_size = pool_size
+
+	async def _makeRequest(self, endpoint, data):
+		return (await self._request(endpoint, data))[1]
+
+	async def _request(self, endpoint, data):
+		# (HTTP status or None if there was no response, parsed response or {} on any failure)
+		url = f"{self.API_url}{endpoint}"
+		if debug:
+			print(url)
+		start = time.perf_counter()
+		status = None
+		# Exception, not a bare except, so that cancelling the trade coroutine still works
+		try:
+			session = getAsyncSession(self.ssl_directory, self.host, self.port, self.timeout, self.pool_size)
+			async with session.post(url, json=data) as r:
+				status = r.status
+				text = await r.text()
+			if debug:
+				print(endpoint, data, text)
+			# one log record per request, written once it's done
+			if self.logfile is not None:
+				self.logfile.write(f"Request to {endpoint}, data: {data}, response: {text}\n")
+			ret = json.loads(text)
+			rpc_duration.observe(time.perf_counter() - start, endpoint)
+			return status, ret
+		except Exception as e:
+			rpc_duration.observe(time.perf_counter() - start, endpoint)
+			rpc_failures.inc(endpoint)
+			if self.logfile is not None:
+				self.logfile.write(f"Request to {endpoint}, data: {data}, failed: {e!r}\n")
+			return status, {}
+
+	async def getBlockchainState(self):
+		return await self._makeRequest("/get_blockchain_state", {})
+
+	async def getBlockchainHeight(self):
+		r = await self._makeRequest("/get_blockchain_state", {})
+		while r == {} or r['blockchain_state']['sync']['synced'] == False or r['blockchain_state']['peak']['height'] == 0:
+			await asyncio.sleep(20)
+			r = await self._makeRequest("/get_blockchain_state", {})
+		return r['blockchain_state']['peak']['height']
+
+	async def getCoinRecordsByPuzzleHash(self, puzzleHash, start, include_spent_coins = False):
+		# None if the request failed
+		result = await self._makeRequest("/get_coin_records_by_puzzle_hash", {
+			"include_spent_coins": include_spent_coins,
+			"puzzle_hash": puzzleHash,
+			"start": start,
+		})
+		if result == {} or result.get("coin_records", None) is None:
+			return None
+		return result['coin_records']
+
+	async def getCoinRecordsByPuzzleHashes(self, puzzleHashes, start, include_spent_coins = False):
+		# None if the request failed; raises EndpointNotFound if the node doesn't have the batch endpoint
+		status, result = await self._request("/get_coin_records_by_puzzle_hashes", {
+			"include_spent_coins": include_spent_coins,
+			"puzzle_hashes": puzzleHashes,
+			"start": start,
+		})
+		if status == 404:
+			raise EndpointNotFound("/get_coin_records_by_puzzle_hashes")
+		if result == {} or result.get("coin_records", None) is None:
+			return None
+		return result['coin_records']
+
+	async def getContractCoinRecord(self, puzzleHash, start, include_spent_coins = False, amount = None):
+		# lookups are batched with those of every other trade on this node (see CoinRecordBatcher)
+		# if amount is given, a coin with that amount is preferred over the others with the same puzzle hash
+		# returns False if there is no such coin, and None if the node couldn't be reached
+		if debug:
+			print(f"Searching for puzzle hash: {puzzleHash}")
+		batcher = getCoinRecordBatcher(self.ssl_directory, self.host, self.port)
+		coin_records = await batcher.getCoinRecords(puzzleHash, start, include_spent_coins)
+		if self.logfile is not None:
+			self.logfile.write(f"Coin records for {puzzleHash}: {coin_records}\n")
+		if coin_records is None:
+			return None
+		if len(coin_records) == 0:
+			return False
+		if amount is not None:
+			for coin_record in coin_records:
+				if coin_record["coin"]["amount"] == amount:
+					return coin_record
+		return coin_records[0]
+
+	async def pushTransaction(self, puzzle, solution, coin):
+		resp = await self._makeRequest("/push_tx", {
+			"spend_bundle": {
+				"coin_solutions": [{
+					"coin": coin,
+					"puzzle_reveal": puzzle,
+					"solution": solution,
+				}],
+				"aggregated_signature": "0xc00000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000", 
+			}
+		})
+		if resp == {} or not resp["success"]:
+			return False
+		if resp["status"] == "SUCCESS":
+			return True
+		return "pending"
+
+	async def getCoinSolution(self, coinId, height):
+		resp = await self._makeRequest("/get_puzzle_and_solution", {
+				"coin_id": coinId,
+				"height": height,
+			})
+		if resp == {} or resp.get("coin_solution", -1) == -1:
+			return False
+		return resp["coin_solution"]["solution"]
+
+# One HeightWatcher per node polls /get_blockchain_state for every trade on that chain.
+# Trade coroutines wait for its height-change event instead of polling the node themselves.
+# Watchers belong to the trade engine's event loop.
+class HeightWatcher():
+	def __init__(self, ssl_directory, host, port, poll_interval=10, idle_timeout=300):
+		self.client = AsyncFullNodeClient(ssl_directory, host, port)
+		self.poll_interval = poll_interval
+		self.idle_timeout = idle_timeout
+		self.changed = asyncio.Event()
+		self.height = 0
+		self.synced = False
+		self.last_used = time.time()
+		self.task = None
+
+	def _ensureRunning(self):
+		self.last_used = time.time()
+		if self.task is None or self.task.done():
+			self.task = asyncio.ensure_future(self._run())
+
+	def _notify(self):
+		self.changed.set()
+		self.changed = asyncio.Event()
+
+	def _update(self, r):
+		if r == {} or not r['blockchain_state']['sync']['synced']:
+			self.synced = False
+		else:
+			height = r['blockchain_state']['peak']['height']
+			self.synced = height != 0
+			if self.synced and height != self.height:
+				self.height = height
+				self._notify()
+
+	async def _run(self):
+		while time.time() - self.last_used <= self.idle_timeout:
+			try:
+				self._update(await self.client.getBlockchainState())
+			except Exception as e:
+				# e.g. an error response without blockchain_state; the next poll tries again
+				self.synced = False
+				print(f"Unexpected blockchain state from {self.client.API_url}: {e!r}")
+			await asyncio.sleep(self.poll_interval)
+
+	async def _waitForChange(self, timeout):
+		try:
+			await asyncio.wait_for(self.changed.wait(), timeout)
+		except asyncio.TimeoutError:
+			pass
+		self.last_used = time.time()
+
+	async def getHeight(self):
+		# waits until the node is synced, like FullNodeClient.getBlockchainHeight
+		self._ensureRunning()
+		while not self.synced:
+			await self._waitForChange(self.poll_interval)
+			self._ensureRunning()
+		return self.height
+
+	async def waitForNewHeight(self, height, timeout=None):
+		# returns as soon as the synced peak is above height, or the current height after timeout seconds
+		# (an unsynced node is always waited for)
+		deadline = None if timeout is None else time.time() + timeout
+		self._ensureRunning()
+		while not self.synced or self.height <= height:
+			remaining = self.poll_interval
+			if deadline is not None and self.synced:
+				remaining = min(remaining, deadline - time.time())
+				if remaining <= 0:
+					break
+			await self._waitForChange(remaining)
+			# restarts the poller if it stopped, e.g. after being idle
+			self._ensureRunning()
+		return self.height
+
+
+height_watchers = {}
+
+def getHeightWatcher(ssl_directory, host, port):
+	key = (asyncio.get_running_loop(), ssl_directory, host, port)
+	watcher = height_watchers.get(key, None)
+	if watcher is None:
+		watcher = HeightWatcher(ssl_directory, host, port)
+		height_watchers[key] = watcher
+	return watcher
+
+
+def _normalizePuzzleHash(puzzleHash):
+	puzzleHash = puzzleHash.lower()
+	if puzzleHash.startswith("0x"):
+		puzzleHash = puzzleHash[2:]
+	return puzzleHash
+
+# Collects the coin record lookups every trade on a node makes within batch_delay seconds
+# (they mostly wake up together, on a new block) and answers them with
+# /get_coin_records_by_puzzle_hashes calls of at most batch_size puzzle hashes.
+# Forks without that endpoint get one /get_coin_records_by_puzzle_hash call per puzzle hash instead;
+# a batch that fails for any other reason falls back to those calls for that batch only.
+class CoinRecordBatcher():
+	def __init__(self, ssl_directory, host, port, batch_size=COIN_RECORD_BATCH_SIZE, batch_delay=COIN_RECORD_BATCH_DELAY):
+		self.client = AsyncFullNodeClient(ssl_directory, host, port)
+		self.batch_size = batch_size
+		self.batch_delay = batch_delay
+		self.batch_unsupported_until = 0
+		self.pending = {}
+		self.flush_task = None
+
+	async def getCoinRecords(self, puzzleHash, start, include_spent_coins = False):
+		# all coin records for puzzleHash, [] if there are none, or None if the node couldn't be reached
+		future = asyncio.get_running_loop().create_future()
+		self.pending.setdefault(include_spent_coins, []).append((_normalizePuzzleHash(puzzleHash), start, future))
+		if self.flush_task is None:
+			self.flush_task = asyncio.ensure_future(self._flush())
+		return await future
+
+	async def _flush(self):
+		await asyncio.sleep(self.batch_delay)
+		pending = self.pending
+		self.pending = {}
+		self.flush_task = None
+
+		for include_spent_coins, lookups in pending.items():
+			for i in range(0, len(lookups), self.batch_size):
+				batch = lookups[i:i + self.batch_size]
+				try:
+					coin_records = await self._lookup(batch, include_spent_coins)
+				except Exception:
+					coin_records = {}
+				for puzzleHash, start, future in batch:
+					if not future.done():
+						future.set_result(coin_records.get(puzzleHash, None))
+
+	async def _lookup(self, batch, include_spent_coins):
+		starts = {}
+		for puzzleHash, start, future in batch:
+			starts[puzzleHash] = min(start, starts.get(puzzleHash, start))
+
+		coin_records = None
+		if time.time() >= self.batch_unsupported_until:
+			try:
+				coin_records = await self.client.getCoinRecordsByPuzzleHashes(
+					["0x" + puzzleHash for puzzleHash in starts.keys()],
+					min(starts.values()),
+					include_spent_coins
+				)
+			except EndpointNotFound:
+				self.batch_unsupported_until = time.time() + COIN_RECORD_BATCH_REPROBE_DELAY
+
+		failed = set()
+		if coin_records is None:
+			results = await asyncio.gather(*[
+				self.client.getCoinRecordsByPuzzleHash("0x" + puzzleHash, start, include_spent_coins)
+				for puzzleHash, start in starts.items()
+			])
+			failed = set(puzzleHash for puzzleHash, result in zip(starts.keys(), results) if result is None)
+			coin_records = [coin_record for result in results if result is not None for coin_record in result]
+
+		# puzzle hashes left out of the answer are the ones whose lookup failed
+		ret = dict((puzzleHash, []) for puzzleHash in starts.keys() if puzzleHash not in failed)
+		for coin_record in coin_records:
+			ret.setdefault(_normalizePuzzleHash(coin_record["coin"]["puzzle_hash"]), []).append(coin_record)
+		return ret
+
+
+coin_record_batchers = {}
+
+def getCoinRecordBatcher(ssl_directory, host, port):
+	key = (asyncio.get_running_loop(), ssl_directory, host, port)
+	batcher = coin_record_batchers.get(key, None)
+	if batcher is None:
+		batcher = CoinRecordBatcher(ssl_directory, host, port)
+		coin_record_batchers[key] = batcher
+	return batcher
@@ -1,4 +1,6 @@
 import io
+import threading
+from collections import OrderedDict
 from typing import Any, BinaryIO
 
 def hexstr_to_bytes(input_str: str) -> bytes:
@@ -63,4 +65,48 @@ def make_sized_bytes(size: int):
 
     return type(name, (bytes,), namespace)
 
-bytes32 = make_sized_bytes(32)
\ No newline at end of file
+bytes32 = make_sized_bytes(32)
+
+
+class LRUCache():
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, default=None):
+        with self.lock:
+            if key not in self.entries:
+                self.misses += 1
+                return default
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return self.entries[key]
+
+    def put(self, key, value):
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def stats(self):
+        with self.lock:
+            return {
+                "size": len(self.entries),
+                "max_size": self.max_size,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
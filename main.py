@@ -1,29 +1,50 @@
-from flask import Flask, send_from_directory
+import sys
+import startup_profile
+if __name__ == '__main__' and '--profile-startup' in sys.argv:
+	startup_profile.install()
+
+from flask import Flask, send_from_directory, Response, request, stream_with_context
 from flask_cors import CORS
-from flask_restful import Resource, Api, reqparse, abort
-from config import debug
-from db import currencies, trade_currencies, trades, eth_trades, engine
+from flask_restful import Resource, Api, reqparse, abort, inputs
+from sqlalchemy import or_
+from config import debug, auto_resume_enabled, trade_shard_count, connection_status_timeout
+from db import currencies, trade_currencies, trades, eth_trades, engine, upsert
 from utils import *
-from contract_helper import getAddressFromPuzzleHash, getContractProgram, programToPuzzleHash, getSolutionProgram, getSecretFromSolutionProgram
-from full_node_client import FullNodeClient
+from contract_helper import getAddressFromPuzzleHash, getContractProgram, getContractPuzzleHash, programToPuzzleHash, getSolutionProgram, getSecretFromSolutionProgram, precacheContract
+from bulk_trades import selectTradesWithCurrencies, selectEthTradesWithCurrencies, importTrades, exportTrades
+from full_node_client import AsyncFullNodeClient, getHeightWatcher
 from helper import bytes32
 from clvm.casts import int_from_bytes, int_to_bytes
 from math import ceil
 from eth_thing import *
 import random
-import blspy
 import threading
+import asyncio
 import time
+import event_loop
+from trade_state import TradeRegistry, RUNNING, FINISHED, FAILED
+from trade_scheduler import ResumeScheduler
+from trade_log import getTradeLog
+import trade_shards
+import metrics
+import os
 import json
+from collections import OrderedDict
 
 app = Flask("yakuSwap")
 cors = CORS(app, resources={r"/api/*": {"origins": "*"}})
 api = Api(app)
 
+# imported on the first std_hash call, to keep it off the startup path
+blspy = None
+
 def std_hash(b) -> bytes32:
     """
     The standard hash used in many places.
     """
+    global blspy
+    if blspy is None:
+        import blspy
     return bytes32(blspy.Util.hash256(bytes(b)))
 
 
@@ -47,56 +68,149 @@ class Currencies(Resource):
 		return {'currencies': res}
 
 
+# Every configured node is probed at once on the trade engine's loop, each with its own deadline
+# (.connection_status_timeout), and the answer is reused for a few seconds. Once it's older than that,
+# requests still get each node's last known status right away while one probe refreshes it in the
+# background, so a dead or hanging fork can't hold up the status bar. Only a node that was never
+# probed is waited for, and for at most CONNECTION_STATUS_FIRST_WAIT seconds.
+CONNECTION_STATUS_TIMEOUT = connection_status_timeout
+CONNECTION_STATUS_TTL = 5
+CONNECTION_STATUS_FIRST_WAIT = 0.8
+
+connection_status_cache = {"key": None, "time": 0, "connections": None, "refresh": None}
+connection_status_last = {} # node -> its last status
+connection_status_lock = threading.Lock()
+
+async def getConnectionStatus(prefix, ssl_directory, host, port):
+	client = AsyncFullNodeClient(ssl_directory, host, port)
+	try:
+		api_resp = await asyncio.wait_for(client.getBlockchainState(), CONNECTION_STATUS_TIMEOUT)
+	except asyncio.TimeoutError:
+		api_resp = {}
+
+	if api_resp.get("blockchain_state", -1) == -1:
+		return {"currency": prefix, "status": "not_connected"}
+	if api_resp["blockchain_state"]["sync"]["synced"]:
+		return {"currency": prefix, "status": "connected"}
+	return {"currency": prefix, "status": "not_synced"}
+
+async def probeConnectionStatus(node):
+	# each node's status is kept as soon as it's known, so a slow fork doesn't hide the others
+	status = await getConnectionStatus(*node)
+	with connection_status_lock:
+		connection_status_last[node] = status
+	return status
+
+async def refreshConnectionStatuses(nodes):
+	try:
+		connections = list(await asyncio.gather(*[probeConnectionStatus(node) for node in nodes]))
+		with connection_status_lock:
+			connection_status_cache.update({"key": nodes, "time": time.time(), "connections": connections})
+		return connections
+	finally:
+		with connection_status_lock:
+			if connection_status_cache["refresh"] is not None and connection_status_cache["refresh"][0] == nodes:
+				connection_status_cache["refresh"] = None
+
+def lastConnectionStatuses(nodes):
+	with connection_status_lock:
+		return [connection_status_last.get(node, {"currency": node[0], "status": "not_connected"}) for node in nodes]
+
 class ConnectionStatus(Resource):
 	def get(self):
 		conn = engine.connect()
 
 		s = currencies.select()
 		result = conn.execute(s)
-		res = []
-
-		for row in result:
-			prefix = row[0]
-			client = FullNodeClient(
-				row[9], # ssl_directory
-				row[7], # host
-				row[8] # port
-			)
-
-			api_resp = client.getBlockchainState()
-			if api_resp.get("blockchain_state", -1) == -1:
-				res.append({"currency": prefix, "status": "not_connected"})
-			else:
-				if api_resp["blockchain_state"]["sync"]["synced"]:
-					res.append({"currency": prefix, "status": "connected"})
-				else:
-					res.append({"currency": prefix, "status": "not_synced"})
+		nodes = tuple((row.address_prefix, row.ssl_directory, row.host, row.port) for row in result)
 
 		conn.close()
-		return {'connections': res}
 
+		with connection_status_lock:
+			if connection_status_cache["key"] == nodes and time.time() - connection_status_cache["time"] <= CONNECTION_STATUS_TTL:
+				return {'connections': connection_status_cache["connections"]}
+			refresh = connection_status_cache["refresh"]
+			if refresh is None or refresh[0] != nodes:
+				refresh = (nodes, event_loop.submit(refreshConnectionStatuses(nodes)))
+				connection_status_cache["refresh"] = refresh
+			first = any(node not in connection_status_last for node in nodes)
+
+		if first:
+			try:
+				return {'connections': refresh[1].result(CONNECTION_STATUS_FIRST_WAIT)}
+			except Exception:
+				# timed out or failed; the probe keeps running and updates the cache when it's done
+				pass
+		return {'connections': lastConnectionStatuses(nodes)}
+
+
+def parseTradeListArgs():
+	# all optional; without limit every matching trade is returned
+	parser = reqparse.RequestParser()
+	parser.add_argument('cursor', type=str, location='args')
+	parser.add_argument('limit', type=int, location='args')
+	parser.add_argument('step', type=int, location='args')
+	parser.add_argument('is_buyer', type=inputs.boolean, location='args')
+	parser.add_argument('address_prefix', type=str, location='args')
+	return parser.parse_args()
+
+def paginateTrades(s, table, args):
+	if args['cursor'] is not None:
+		s = s.where(table.c.id > args['cursor'])
+	if args['step'] is not None:
+		s = s.where(table.c.step == args['step'])
+	if args['is_buyer'] is not None:
+		s = s.where(table.c.is_buyer == args['is_buyer'])
+	s = s.order_by(table.c.id)
+	if args['limit'] is not None:
+		s = s.limit(max(args['limit'], 0) + 1)
+	return s
+
+def nextCursor(rows, args):
+	# paginateTrades fetches one row more than the limit to know if there's a next page
+	if args['limit'] is None or len(rows) <= max(args['limit'], 0):
+		return rows, None
+	rows = rows[:max(args['limit'], 0)]
+	return rows, (rows[-1].id if len(rows) > 0 else None)
 
 class Trades(Resource):
 	def get(self):
+		args = parseTradeListArgs()
 		conn = engine.connect()
 
-		s = trades.select()
-		result = conn.execute(s)
+		s, tc1, tc2 = selectTradesWithCurrencies()
+		if args['address_prefix'] is not None:
+			s = s.where(or_(tc1.c.address_prefix == args['address_prefix'], tc2.c.address_prefix == args['address_prefix']))
+		s = paginateTrades(s, trades, args)
+		rows, next_cursor = nextCursor(conn.execute(s).all(), args)
 		res = []
 
-		for row in result:
-			stmt = trade_currencies.select().where(trade_currencies.c.id == row[1])
-			trade_currency_one = conn.execute(stmt).all()[0]
-			stmt = trade_currencies.select().where(trade_currencies.c.id == row[2])
-			trade_currency_two = conn.execute(stmt).all()[0]
-
-			res.append(tradesRowToJson(row, tradeCurrencyRowToJson(trade_currency_one), tradeCurrencyRowToJson(trade_currency_two)))
+		for row in rows:
+			res.append(tradesRowToJson(row, tradeCurrencyColumnsToJson(row, 'tc1_'), tradeCurrencyColumnsToJson(row, 'tc2_')))
 
 		conn.close()
-		return {'trades': res}
+		return {'trades': res, 'next_cursor': next_cursor}
 
 
 
+class TradesImport(Resource):
+	def post(self):
+		# body: JSON Lines, see bulk_trades.py; read line by line so memory doesn't grow with the input
+		return importTrades(request.stream)
+
+
+class TradesExport(Resource):
+	def get(self):
+		return Response(stream_with_context(exportTrades()), mimetype="application/x-ndjson")
+
+
+class Metrics(Resource):
+	def get(self):
+		# trades running in worker processes keep their node, database and batcher metrics there
+		others = shard_pool.collectMetrics() if shard_pool is not None else ()
+		return Response(metrics.render(others), mimetype="text/plain; version=0.0.4")
+
+
 class Currency(Resource):
 	def put(self, address_prefix):
 		parser = reqparse.RequestParser()
@@ -113,14 +227,7 @@ class Currency(Resource):
 
 		conn = engine.connect()
 
-		s = currencies.select().where(currencies.c.address_prefix == address_prefix)
-		result = conn.execute(s)
-		st = None
-		if len(result.all()) == 0:
-			st = currencies.insert()
-		else:
-			st = currencies.update().where(currencies.c.address_prefix == address_prefix)
-		st = st.values(
+		st = upsert(currencies, dict(
 			address_prefix = address_prefix,
 			name = args['name'],
 			photo_url = args['photo_url'],
@@ -131,7 +238,7 @@ class Currency(Resource):
 			host = args['host'],
 			port = args['port'],
 			ssl_directory = args['ssl_directory']
-		)
+		))
 		conn.execute(st)
 
 		conn.close()
@@ -146,17 +253,119 @@ class Currency(Resource):
 		conn.close()
 		return {'success': True}
 
-trade_threads_ids = []
-trade_threads_messages = []
-trade_threads_addresses = []
-trade_threads_files = []
-trade_threads_commands = []
+def precacheTradeContracts(secret_hash, trade_currencies_data):
+	for trade_currency in trade_currencies_data:
+		precacheContract(secret_hash, trade_currency)
+
+trade_registry = TradeRegistry()
+# trades that ran to the end are saved with this step, after 2, so they're never started again
+DONE_STEP = 3
+# seconds between coin record lookups while the full node can't be reached
+COIN_RECORD_RETRY_DELAY = 10
+# set in the web server when trades run in worker processes (see trade_shards.py)
+shard_pool = None
+
+async def runTrade(trade_id, code):
+	trade_state = trade_registry.get(trade_id)
+	trade_state.status = RUNNING
+	# from now on the trade reads the values posted for it
+	eth_trade_posted_early.pop(trade_id, None)
+	failed = True
+	try:
+		await code(trade_id)
+		failed = False
+	finally:
+		trade_registry.finish(trade_id, failed)
+		eth_trade_responses.pop(trade_id, None)
+
+def startTrade(trade_id, code, log_filename):
+	# starts the trade on the event loop unless it's already running; returns its TradeState
+	return _startTrade(trade_id, code, log_filename)[0]
+
+def _startTrade(trade_id, code, log_filename):
+	# returns (TradeState, created)
+	if shard_pool is not None:
+		trade_state, created = trade_registry.getOrCreate(trade_id, trade_shards.MirrorLog, code.__name__)
+		if created:
+			shard_pool.start(trade_id, code.__name__, log_filename)
+		return trade_state, created
+
+	trade_state, created = trade_registry.getOrCreate(trade_id, lambda: getTradeLog(log_filename), code.__name__)
+	if created:
+		event_loop.submit(runTrade(trade_id, code))
+	return trade_state, created
+
+def collectActiveTrades():
+	counts = {}
+	for trade_state in trade_registry.all():
+		if trade_state.status == RUNNING:
+			key = (trade_state.code, str(trade_state.step))
+			counts[key] = counts.get(key, 0) + 1
+	return list(counts.items())
+
+metrics.collector("yakuswap_active_trades", "Running trades by trade code and step", "gauge", ["code", "step"], collectActiveTrades)
+
+LONG_POLL_MAX_TIMEOUT = 60
+SSE_KEEPALIVE_INTERVAL = 15
+
+def tradeStatusJson(trade_state, version, include_command):
+	ret = {
+		"version": version,
+		"status": trade_state.status,
+		"message": trade_state.message,
+		"address": trade_state.address
+	}
+	if include_command:
+		ret["command"] = trade_state.command
+	return ret
+
+def longPollTradeStatus(trade_state, include_command):
+	# answers as soon as the status differs from the client's ?version=, or after ?timeout= seconds
+	parser = reqparse.RequestParser()
+	parser.add_argument('version', type=int, location='args', default=-1)
+	parser.add_argument('timeout', type=float, location='args', default=30)
+	args = parser.parse_args()
+
+	timeout = max(0, min(args['timeout'], LONG_POLL_MAX_TIMEOUT))
+	version = trade_state.waitForChange(args['version'], timeout)
+	return tradeStatusJson(trade_state, version, include_command)
+
+def streamTradeStatus(trade_state, include_command):
+	# Server-Sent Events: one event per status change, until the trade is over
+	try:
+		last_version = int(request.headers.get("Last-Event-ID", -1))
+	except ValueError:
+		last_version = -1
+
+	def events(version):
+		while True:
+			# a finished trade doesn't change anymore: its last status is sent if the client hasn't seen it yet, then the stream ends
+			done = trade_state.status in (FINISHED, FAILED)
+			new_version = trade_state.waitForChange(version, 0 if done else SSE_KEEPALIVE_INTERVAL)
+			if new_version != version:
+				version = new_version
+				yield f"id: {version}\ndata: {json.dumps(tradeStatusJson(trade_state, version, include_command))}\n\n"
+			elif done:
+				return
+			else:
+				yield ": keep-alive\n\n"
+
+	return Response(stream_with_context(events(last_version)), mimetype="text/event-stream", headers={"Cache-Control": "no-cache"})
+
+async def fetchContractCoinRecord(trade_state, full_node_client, *args):
+	# like AsyncFullNodeClient.getContractCoinRecord, but keeps asking while the node can't be reached,
+	# so False always means there's no such coin
+	coin_record = await full_node_client.getContractCoinRecord(*args)
+	while coin_record is None:
+		trade_state.log.write(f"Could not get coin records from the full node, trying again in {COIN_RECORD_RETRY_DELAY} seconds\n")
+		await asyncio.sleep(COIN_RECORD_RETRY_DELAY)
+		coin_record = await full_node_client.getContractCoinRecord(*args)
+	return coin_record
 
 # checkFunc should return True if the trade is still ok
-def tradeWaitForContract(trade_index, trade, trade_currency, currency, issue_contract, wait = False, other_trade_currency = False, other_currency = False, checkFunc = False):
-	global trade_threads_ids, trade_threads_messages, trade_threads_addresses, trade_threads_files
+async def tradeWaitForContract(trade_state, trade, trade_currency, currency, issue_contract, wait = False, other_trade_currency = False, other_currency = False, checkFunc = False):
 
-	program = getContractProgram(
+	programPuzzleHash = await event_loop.inExecutor(getContractPuzzleHash,
 		trade.secret_hash,
 		trade_currency.total_amount,
 		trade_currency.fee,
@@ -164,37 +373,36 @@ def tradeWaitForContract(trade_index, trade, trade_currency, currency, issue_con
 		trade_currency.to_address,
 		trade_currency.max_block_height
 	)
-	programPuzzleHash = programToPuzzleHash(program)
 	programAddress = getAddressFromPuzzleHash(programPuzzleHash, currency.address_prefix)
-	trade_threads_files[trade_index].write(f"Waiting for contract with puzzlehash {programPuzzleHash} and address {programAddress} to be confirmed\n")
-	trade_threads_files[trade_index].flush()
+	trade_state.log.write(f"Waiting for contract with puzzlehash {programPuzzleHash} and address {programAddress} to be confirmed\n")
 
-	full_node_client = FullNodeClient(
+	full_node_client = AsyncFullNodeClient(
 		currency.ssl_directory,
 		currency.host,
 		currency.port,
-		trade_threads_files[trade_index]
+		trade_state.log
 	)
+	height_watcher = getHeightWatcher(currency.ssl_directory, currency.host, currency.port)
 
 	amount_to_send = trade_currency.total_amount - trade_currency.fee
 	amount_to_send = amount_to_send / currency.units_per_coin
 	fee = trade_currency.fee / currency.units_per_coin
 	
 	if issue_contract:
-		trade_threads_messages[trade_index] = f"Please send {amount_to_send:.12f} {currency.name} with a fee of {fee:.12f} {currency.name} to the address found below. Double-check the address before confirming the transaction - if it's wrong, your coins will be lost."
-		trade_threads_addresses[trade_index] = programAddress
+		trade_state.message = f"Please send {amount_to_send:.12f} {currency.name} with a fee of {fee:.12f} {currency.name} to the address found below. Double-check the address before confirming the transaction - if it's wrong, your coins will be lost."
+		trade_state.address = programAddress
 	else:
-		trade_threads_messages[trade_index] = f"Waiting for the other human to send {amount_to_send:.12f} {currency.name} with a fee of {fee:.12f} {currency.name} to the address found below..."
-		trade_threads_addresses[trade_index] = programAddress
+		trade_state.message = f"Waiting for the other human to send {amount_to_send:.12f} {currency.name} with a fee of {fee:.12f} {currency.name} to the address found below..."
+		trade_state.address = programAddress
 
 	if wait:
-		time.sleep(120)
+		await asyncio.sleep(120)
 
-	height = full_node_client.getBlockchainHeight()
+	height = await height_watcher.getHeight()
 
 	shouldCancel = False
 	if other_trade_currency != False and other_currency != False:
-		other_program = getContractProgram(
+		otherProgramPuzzleHash = await event_loop.inExecutor(getContractPuzzleHash,
 			trade.secret_hash,
 			other_trade_currency.total_amount,
 			other_trade_currency.fee,
@@ -202,175 +410,154 @@ def tradeWaitForContract(trade_index, trade, trade_currency, currency, issue_con
 			other_trade_currency.to_address,
 			other_trade_currency.max_block_height
 		)
-		otherProgramPuzzleHash = programToPuzzleHash(other_program)
 
-		other_full_node_client = FullNodeClient(
+		other_full_node_client = AsyncFullNodeClient(
 			other_currency.ssl_directory,
 			other_currency.host,
 			other_currency.port,
-			trade_threads_files[trade_index]
+			trade_state.log
 		)
+		other_height_watcher = getHeightWatcher(other_currency.ssl_directory, other_currency.host, other_currency.port)
 
-		other_coin_record = other_full_node_client.getContractCoinRecord(otherProgramPuzzleHash.hex(), height - 1000 - other_trade_currency.max_block_height)
+		other_coin_record = await fetchContractCoinRecord(trade_state, other_full_node_client, otherProgramPuzzleHash.hex(), height - 1000 - other_trade_currency.max_block_height)
 		if other_coin_record == False:
 			shouldCancel = True
 		else:
 			other_coin_block_index = other_coin_record['confirmed_block_index']
 	
-		trade_threads_files[trade_index].write(f"Other coin record: {other_coin_record}\nShould cancel? {shouldCancel}\n")
-		trade_threads_files[trade_index].flush()
+		trade_state.log.write(f"Other coin record: {other_coin_record}\nShould cancel? {shouldCancel}\n")
 
-	contract_coin_record = full_node_client.getContractCoinRecord(programPuzzleHash.hex(), height - 1000 - trade_currency.max_block_height)
+	contract_coin_record = await fetchContractCoinRecord(trade_state, full_node_client, programPuzzleHash.hex(), height - 1000 - trade_currency.max_block_height, False, trade_currency.total_amount - trade_currency.fee)
 	while contract_coin_record == False and shouldCancel == False:
-		time.sleep(60)
-		height = full_node_client.getBlockchainHeight()
+		height = await height_watcher.waitForNewHeight(height, 60)
 		if other_trade_currency != False:
-			other_height = other_full_node_client.getBlockchainHeight()
+			other_height = await other_height_watcher.getHeight()
 			if other_height - other_coin_block_index >= other_trade_currency.max_block_height * 3 // 4 - ceil(trade_currency.min_confirmation_height * trade_currency.max_block_height / other_trade_currency.max_block_height):
 				shouldCancel = True
 		if checkFunc != False and not checkFunc():
 			shouldCancel = True
 		if not shouldCancel:
-			contract_coin_record = full_node_client.getContractCoinRecord(programPuzzleHash.hex(), height - 1000 - trade_currency.max_block_height)
+			contract_coin_record = await fetchContractCoinRecord(trade_state, full_node_client, programPuzzleHash.hex(), height - 1000 - trade_currency.max_block_height, False, trade_currency.total_amount - trade_currency.fee)
 
 
 	if shouldCancel == False and contract_coin_record["coin"]["amount"] != trade_currency.total_amount - trade_currency.fee:
-		trade_threads_files[trade_index].write(f"Trickster detected!\n")
-		trade_threads_files[trade_index].flush()
+		trade_state.log.write(f"Trickster detected!\n")
 		shouldCancel = True
 
-	trade_threads_files[trade_index].write(f"Contract coin record: {contract_coin_record}\n")
-	trade_threads_files[trade_index].flush()
+	trade_state.log.write(f"Contract coin record: {contract_coin_record}\n")
 	if shouldCancel:
-		trade_threads_files[trade_index].write(f"Should cancel!\n")
-		trade_threads_files[trade_index].flush()
-		trade_threads_messages[trade_index] = "Cancelling trade..."
-		trade_threads_addresses[trade_index] = None
+		trade_state.log.write(f"Should cancel!\n")
+		trade_state.message = "Cancelling trade..."
+		trade_state.address = None
 	else:
 		confirmed_block_index = contract_coin_record['confirmed_block_index']
-		trade_threads_messages[trade_index] = "Waiting for transaction confirmation..."
-		trade_threads_addresses[trade_index] = None
+		trade_state.message = "Waiting for transaction confirmation..."
+		trade_state.address = None
 
-		height = full_node_client.getBlockchainHeight()
+		height = await height_watcher.getHeight()
 		while confirmed_block_index + trade_currency.min_confirmation_height > height:
 			delta = height - confirmed_block_index
-			trade_threads_messages[trade_index] = f"Waiting for transaction confirmation ({delta} / {trade_currency.min_confirmation_height})"
-			trade_threads_addresses[trade_index] = None
-			time.sleep(10)
-			height = full_node_client.getBlockchainHeight()
+			trade_state.message = f"Waiting for transaction confirmation ({delta} / {trade_currency.min_confirmation_height})"
+			trade_state.address = None
+			height = await height_watcher.waitForNewHeight(height)
 
-		trade_threads_messages[trade_index] = "Commencing to next step..."
-		trade_threads_addresses[trade_index] = None
+		trade_state.message = "Commencing to next step..."
+		trade_state.address = None
 
-	time.sleep(5)
+	await asyncio.sleep(5)
 	return shouldCancel, contract_coin_record
 
-def lookForSolutionInBlockchain(trade_index, trade, trade_currency, currency, coin_record, other_trade_currency = False, other_currency = False):
-	global trade_threads_ids, trade_threads_messages, trade_threads_addresses, trade_threads_files
+async def lookForSolutionInBlockchain(trade_state, trade, trade_currency, currency, coin_record, other_trade_currency = False, other_currency = False):
 
-	program = getContractProgram(
+	programPuzzleHash = (await event_loop.inExecutor(getContractPuzzleHash,
 		trade.secret_hash,
 		trade_currency.total_amount,
 		trade_currency.fee,
 		trade_currency.from_address,
 		trade_currency.to_address,
 		trade_currency.max_block_height
-	)
-	programPuzzleHash = programToPuzzleHash(program).hex()
+	)).hex()
 
-	otherProgram = False
 	otherProgramPuzzleHash = False
 	if other_currency != False:
-		otherProgram = getContractProgram(
+		otherProgramPuzzleHash = (await event_loop.inExecutor(getContractPuzzleHash,
 			trade.secret_hash,
 			other_trade_currency.total_amount,
 			other_trade_currency.fee,
 			other_trade_currency.from_address,
 			other_trade_currency.to_address,
 			other_trade_currency.max_block_height
-		)
-		otherProgramPuzzleHash = programToPuzzleHash(otherProgram).hex()
+		)).hex()
 
-	trade_threads_files[trade_index].write(f"Loking for solution of contract with puzzlehash {programPuzzleHash}\nKeeping an eye on {otherProgramPuzzleHash}\n")
-	trade_threads_files[trade_index].flush()
+	trade_state.log.write(f"Loking for solution of contract with puzzlehash {programPuzzleHash}\nKeeping an eye on {otherProgramPuzzleHash}\n")
 
-	full_node_client = FullNodeClient(
+	full_node_client = AsyncFullNodeClient(
 		currency.ssl_directory,
 		currency.host,
 		currency.port,
-		trade_threads_files[trade_index]
+		trade_state.log
 	)
+	height_watcher = getHeightWatcher(currency.ssl_directory, currency.host, currency.port)
 	other_full_node_client = False
+	other_height_watcher = False
 	if other_currency != False:
-		other_full_node_client = FullNodeClient(
+		other_full_node_client = AsyncFullNodeClient(
 			other_currency.ssl_directory,
 			other_currency.host,
 			other_currency.port,
-			trade_threads_files[trade_index]
+			trade_state.log
 		)
+		other_height_watcher = getHeightWatcher(other_currency.ssl_directory, other_currency.host, other_currency.port)
 
 	if coin_record == False:
-		trade_threads_messages[trade_index] = "Getting contract coin record..."
-		height = full_node_client.getBlockchainHeight()
-		coin_record = full_node_client.getContractCoinRecord(programPuzzleHash, height - 1000 - trade_currency.max_block_height, True)
+		trade_state.message = "Getting contract coin record..."
+		height = await height_watcher.getHeight()
+		coin_record = await fetchContractCoinRecord(trade_state, full_node_client, programPuzzleHash, height - 1000 - trade_currency.max_block_height, True)
 
-	trade_threads_files[trade_index].write(f"Coin record: {coin_record}\n")
-	trade_threads_files[trade_index].flush()
+	trade_state.log.write(f"Coin record: {coin_record}\n")
 
 	if coin_record == False:
-		trade_threads_messages[trade_index] = "Something really strange happened..."
-		trade_threads_files[trade_index].write(f"coin_record is still false?!")
-		trade_threads_files[trade_index].flush()
+		trade_state.message = "Something really strange happened..."
+		trade_state.log.write(f"coin_record is still false?!")
 		return False
 
-	trade_threads_messages[trade_index] = "Getting contract solution..."
+	trade_state.message = "Getting contract solution..."
 	spent_block_index = coin_record["spent_block_index"]
 
 	other_height = False
 	other_coin_record = False
 	if other_full_node_client != False:
-		other_height = other_full_node_client.getBlockchainHeight()
-		other_coin_record = other_full_node_client.getContractCoinRecord(otherProgramPuzzleHash, other_height - 1000 - other_trade_currency.max_block_height, True)
+		other_height = await other_height_watcher.getHeight()
+		other_coin_record = await fetchContractCoinRecord(trade_state, other_full_node_client, otherProgramPuzzleHash, other_height - 1000 - other_trade_currency.max_block_height, True)
 
+	height = await height_watcher.getHeight()
 	while spent_block_index == 0:
-		time.sleep(15)
-		height = full_node_client.getBlockchainHeight()
-		coin_record = full_node_client.getContractCoinRecord(programPuzzleHash, height - 1000 - trade_currency.max_block_height, True)
+		height = await height_watcher.waitForNewHeight(height, 60)
+		coin_record = await fetchContractCoinRecord(trade_state, full_node_client, programPuzzleHash, height - 1000 - trade_currency.max_block_height, True)
 		spent_block_index = coin_record["spent_block_index"]
 		if other_full_node_client != False:
-			other_height = other_full_node_client.getBlockchainHeight()
+			other_height = await other_height_watcher.getHeight()
 			if other_height - other_coin_record['confirmed_block_index'] >= other_trade_currency.max_block_height * 3 // 4:
-				trade_threads_files[trade_index].write(f"Other currency time ran out. Exiting...")
-				trade_threads_files[trade_index].flush()
+				trade_state.log.write(f"Other currency time ran out. Exiting...")
 				return False
 		if height - coin_record['confirmed_block_index'] >= trade_currency.max_block_height * 3 // 4:
-			trade_threads_files[trade_index].write(f"Main currency time ran out. Exiting...")
-			trade_threads_files[trade_index].flush()
+			trade_state.log.write(f"Main currency time ran out. Exiting...")
 			return False
 
 	coin = coin_record["coin"]
 	coin_id = std_hash(bytes.fromhex(coin["parent_coin_info"][2:]) + bytes.fromhex(coin["puzzle_hash"][2:]) + int_to_bytes(coin["amount"])).hex()
-	trade_threads_files[trade_index].write(f"Coin id: {coin_id}\nSpent block index: {spent_block_index}\n")
-	trade_threads_files[trade_index].flush()
-	sol = full_node_client.getCoinSolution(coin_id, spent_block_index)
+	trade_state.log.write(f"Coin id: {coin_id}\nSpent block index: {spent_block_index}\n")
+	sol = await full_node_client.getCoinSolution(coin_id, spent_block_index)
 	while sol == False:
-		trade_threads_messages[trade_index] = "Getting contract solution (again)..."
-		time.sleep(30)
-		sol = full_node_client.getCoinSolution(coin_id, spent_block_index)
+		trade_state.message = "Getting contract solution (again)..."
+		await asyncio.sleep(30)
+		sol = await full_node_client.getCoinSolution(coin_id, spent_block_index)
 	
-	trade_threads_files[trade_index].write(f"Solution: {sol}\n")
-	trade_threads_files[trade_index].flush()
+	trade_state.log.write(f"Solution: {sol}\n")
 	return sol
 
-def tradeClaimContract(trade_index, trade, trade_currency, currency, solution_program_hex, coin_record, cancel = False):
-	global trade_threads_ids, trade_threads_messages, trade_threads_addresses, trade_threads_files
-
-	if cancel:
-		trade_threads_messages[trade_index] = "Preparing to cancel trade :("
-
-	trade_threads_files[trade_index].write(f"tradeClaimContract - cancel? {cancel}\n")
-	trade_threads_files[trade_index].flush()
-
+def _contractProgramHex(trade, trade_currency):
+	# compiling and serializing the contract is blocking work; see event_loop.inExecutor
 	program = getContractProgram(
 		trade.secret_hash,
 		trade_currency.total_amount,
@@ -379,96 +566,118 @@ def tradeClaimContract(trade_index, trade, trade_currency, currency, solution_pr
 		trade_currency.to_address,
 		trade_currency.max_block_height
 	)
-	programPuzzleHash = programToPuzzleHash(program).hex()
-	trade_threads_files[trade_index].write(f"tradeClaimContract - contract with puzzlehash {programPuzzleHash}\n")
-	trade_threads_files[trade_index].flush()
+	return program.as_bin().hex(), programToPuzzleHash(program).hex()
+
+def _solutionProgramHex(secret):
+	return getSolutionProgram(secret).as_bin().hex()
+
+async def tradeClaimContract(trade_state, trade, trade_currency, currency, solution_program_hex, coin_record, cancel = False):
+
+	if cancel:
+		trade_state.message = "Preparing to cancel trade :("
+
+	trade_state.log.write(f"tradeClaimContract - cancel? {cancel}\n")
+
+	program_hex, programPuzzleHash = await event_loop.inExecutor(_contractProgramHex, trade, trade_currency)
+	trade_state.log.write(f"tradeClaimContract - contract with puzzlehash {programPuzzleHash}\n")
 
-	full_node_client = FullNodeClient(
+	full_node_client = AsyncFullNodeClient(
 		currency.ssl_directory,
 		currency.host,
 		currency.port,
-		trade_threads_files[trade_index]
+		trade_state.log
 	)
+	height_watcher = getHeightWatcher(currency.ssl_directory, currency.host, currency.port)
 
+	# only returns once the transaction was pushed or the contract coin is seen spent, so the
+	# trade can be marked as done afterwards
+	height = await height_watcher.getHeight()
 	if coin_record == False:
-		trade_threads_messages[trade_index] = "Getting contract coin record..."
-		height = full_node_client.getBlockchainHeight()
-		coin_record = full_node_client.getContractCoinRecord(programPuzzleHash, height - 10000 - trade_currency.max_block_height, True)
-	trade_threads_files[trade_index].write(f"Coin record: {coin_record}\n")
-	trade_threads_files[trade_index].flush()
-
-	if coin_record == False:
-		trade_threads_messages[trade_index] = "Contract already claimed"
+		trade_state.message = "Getting contract coin record..."
+		coin_record = await fetchContractCoinRecord(trade_state, full_node_client, programPuzzleHash, height - 10000 - trade_currency.max_block_height, True)
+	while coin_record == False:
+		# both contracts were confirmed before this step, so the node is probably behind
+		trade_state.message = "Could not find the contract coin - looking for it again after the next block..."
+		trade_state.log.write(f"Contract coin not found\n")
+		height = await height_watcher.waitForNewHeight(height, 60)
+		coin_record = await fetchContractCoinRecord(trade_state, full_node_client, programPuzzleHash, height - 10000 - trade_currency.max_block_height, True)
+	trade_state.log.write(f"Coin record: {coin_record}\n")
+
+	# spent, e.g. when a trade that was claimed before a restart is resumed
+	if coin_record["spent_block_index"] != 0:
+		trade_state.message = "Contract already claimed"
 		return
 
-	trade_threads_messages[trade_index] = "Waiting for node to be synced..."
-	height = full_node_client.getBlockchainHeight()
+	trade_state.message = "Waiting for node to be synced..."
+	height = await height_watcher.getHeight()
 	coin = coin_record["coin"]
-	trade_threads_messages[trade_index] = "Pushing transaction..."
-	r = full_node_client.pushTransaction(
-		program.as_bin().hex(),
+	trade_state.message = "Pushing transaction..."
+	r = await full_node_client.pushTransaction(
+		program_hex,
 		solution_program_hex,
 		coin
 	)
 	while r == False:
-		trade_threads_messages[trade_index] = "Pushing transaction again..."
-		r = full_node_client.pushTransaction(
-			program.as_bin().hex(),
+		# the push also fails once the coin is spent, e.g. by an earlier push whose answer was lost
+		coin_record = await fetchContractCoinRecord(trade_state, full_node_client, programPuzzleHash, height - 10000 - trade_currency.max_block_height, True)
+		if coin_record != False and coin_record["spent_block_index"] != 0:
+			trade_state.message = "Contract already claimed"
+			return
+		trade_state.message = "Pushing transaction again..."
+		r = await full_node_client.pushTransaction(
+			program_hex,
 			solution_program_hex,
 			coin
 		)
-		time.sleep(5)
+		await asyncio.sleep(5)
 	if r == "pending":
 		while r == "pending":
-			trade_threads_messages[trade_index] = "The transaction was marked as PENDING - I'll push it every 30 seconds just to be sure"
-			r = full_node_client.pushTransaction(
-				program.as_bin().hex(),
+			trade_state.message = "The transaction was marked as PENDING - I'll push it every 30 seconds just to be sure"
+			r = await full_node_client.pushTransaction(
+				program_hex,
 				solution_program_hex,
 				coin
 			)
-			time.sleep(30)
-		trade_threads_messages[trade_index] = "Done! Check your wallet :)"	
+			await asyncio.sleep(30)
+		trade_state.message = "Done! Check your wallet :)"	
 	else:
-		trade_threads_messages[trade_index] = "Done! Check your wallet :)"	
+		trade_state.message = "Done! Check your wallet :)"	
 
-def shouldCancelTrade(trade_index, trade, trade_currency, currency, coin_record):
-	global trade_threads_ids, trade_threads_messages, trade_threads_addresses, trade_threads_files
+async def shouldCancelTrade(trade_state, trade, trade_currency, currency, coin_record):
 
-	trade_threads_files[trade_index].write(f"Should cancel trade?\n")
-	trade_threads_files[trade_index].flush()
-	program = getContractProgram(
+	trade_state.log.write(f"Should cancel trade?\n")
+	programPuzzleHash = (await event_loop.inExecutor(getContractPuzzleHash,
 		trade.secret_hash,
 		trade_currency.total_amount,
 		trade_currency.fee,
 		trade_currency.from_address,
 		trade_currency.to_address,
 		trade_currency.max_block_height
-	)
-	programPuzzleHash = programToPuzzleHash(program).hex()
-	trade_threads_files[trade_index].write(f"Contract with puzzlehash {programPuzzleHash}\n")
-	trade_threads_files[trade_index].flush()
+	)).hex()
+	trade_state.log.write(f"Contract with puzzlehash {programPuzzleHash}\n")
 
-	full_node_client = FullNodeClient(
+	full_node_client = AsyncFullNodeClient(
 		currency.ssl_directory,
 		currency.host,
 		currency.port,
-		trade_threads_files[trade_index]
+		trade_state.log
 	)
+	height_watcher = getHeightWatcher(currency.ssl_directory, currency.host, currency.port)
 
 	if coin_record == False:
-		trade_threads_messages[trade_index] = "Getting contract coin record..."
-		height = full_node_client.getBlockchainHeight()
-		coin_record = full_node_client.getContractCoinRecord(programPuzzleHash, height - 10000 - trade_currency.max_block_height, True)
+		trade_state.message = "Getting contract coin record..."
+		height = await height_watcher.getHeight()
+		coin_record = await fetchContractCoinRecord(trade_state, full_node_client, programPuzzleHash, height - 10000 - trade_currency.max_block_height, True)
 	
 	if coin_record == False:
-		trade_threads_messages[trade_index] = "Contract already claimed"
+		# tradeClaimContract keeps looking for it
+		trade_state.message = "Could not find the contract coin"
 		return False, False
 
-	trade_threads_files[trade_index].write(f"Coin record: {coin_record}\n")
-	trade_threads_files[trade_index].flush()
-	trade_threads_messages[trade_index] = "Waiting for node to be synced..."
-	height = full_node_client.getBlockchainHeight()
-	trade_threads_messages[trade_index] = "Verifying height..."
+	trade_state.log.write(f"Coin record: {coin_record}\n")
+	trade_state.message = "Waiting for node to be synced..."
+	height = await height_watcher.getHeight()
+	trade_state.message = "Verifying height..."
 	
 	cancel = False
 
@@ -477,53 +686,65 @@ def shouldCancelTrade(trade_index, trade, trade_currency, currency, coin_record)
 
 	return coin_record, cancel
 
-def _dumpTradeCurrency(trade_index, trade_currency_one):
-	global trade_threads_files
-	trade_threads_files[trade_index].write(f"Addres prefix: {trade_currency_one.address_prefix}\n")
-	trade_threads_files[trade_index].write(f"Fee: {trade_currency_one.fee}\n")
-	trade_threads_files[trade_index].write(f"Max block height: {trade_currency_one.max_block_height}\n")
-	trade_threads_files[trade_index].write(f"Min conf time: {trade_currency_one.min_confirmation_height}\n")
-	trade_threads_files[trade_index].write(f"From: {trade_currency_one.from_address}\n")
-	trade_threads_files[trade_index].write(f"To: {trade_currency_one.to_address}\n")
-	trade_threads_files[trade_index].write(f"Total amount: {trade_currency_one.total_amount}\n\n\n")
-	trade_threads_files[trade_index].flush()
-
-def tradeCode(trade_id):
-	global trade_threads_ids, trade_threads_messages, trade_threads_addresses, trade_threads_files
-	trade_index = 0
-	for i, v in enumerate(trade_threads_ids):
-		if v == trade_id:
-			trade_index = i
-
-	trade_threads_files[trade_index].write("ONLY SHARE THE CONTENTS OF THIS FILE WITH TRUSTED PEOPLE\n")
+def _dumpTradeCurrency(trade_state, trade_currency_one):
+	trade_state.log.write(f"Addres prefix: {trade_currency_one.address_prefix}\n")
+	trade_state.log.write(f"Fee: {trade_currency_one.fee}\n")
+	trade_state.log.write(f"Max block height: {trade_currency_one.max_block_height}\n")
+	trade_state.log.write(f"Min conf time: {trade_currency_one.min_confirmation_height}\n")
+	trade_state.log.write(f"From: {trade_currency_one.from_address}\n")
+	trade_state.log.write(f"To: {trade_currency_one.to_address}\n")
+	trade_state.log.write(f"Total amount: {trade_currency_one.total_amount}\n\n\n")
+
+# the trade coroutines run their queries through these on the blocking pool, with a connection per call
+def _loadTrade(table, trade_id):
+	conn = engine.connect()
+	s = table.select().where(table.c.id == trade_id)
+	trade = conn.execute(s).all()[0]
+	conn.close()
+	return trade
 
+def _loadTradeCurrency(trade_currency_id):
 	conn = engine.connect()
+	s = trade_currencies.select().where(trade_currencies.c.id == trade_currency_id)
+	trade_currency = conn.execute(s).all()[0]
+	s = currencies.select().where(currencies.c.address_prefix == trade_currency.address_prefix)
+	currency = conn.execute(s).all()[0]
+	conn.close()
+	return trade_currency, currency
 
-	s = trades.select().where(trades.c.id == trade_id)
+def _setTradeStep(table, trade_id, step):
+	conn = engine.connect()
+	s = table.update().where(table.c.id == trade_id).values(step = step)
+	conn.execute(s)
+	s = table.select().where(table.c.id == trade_id)
 	trade = conn.execute(s).all()[0]
-	trade_threads_files[trade_index].write(f"Trade\n\n")
-	trade_threads_files[trade_index].write(f"Trade id: {trade_id}\n")
-	trade_threads_files[trade_index].write(f"Secret hash: {trade.secret_hash}\n")
-	trade_threads_files[trade_index].write(f"Is Buyer?: {trade.is_buyer}\n")
-	trade_threads_files[trade_index].write(f"Secret: {trade.secret}\n")
-	trade_threads_files[trade_index].write(f"Step: {trade.step}\n\n\n")
-	trade_threads_files[trade_index].flush()
-
-	s = trade_currencies.select().where(trade_currencies.c.id == trade.trade_currency_one)
-	trade_currency_one = conn.execute(s).all()[0]
-	trade_threads_files[trade_index].write(f"Trade currency one\n\n")
-	_dumpTradeCurrency(trade_index, trade_currency_one)
-
-	s = currencies.select().where(currencies.c.address_prefix == trade_currency_one.address_prefix)
-	currency_one = conn.execute(s).all()[0]
-
-	s = trade_currencies.select().where(trade_currencies.c.id == trade.trade_currency_two)
-	trade_currency_two = conn.execute(s).all()[0]
-	trade_threads_files[trade_index].write(f"Trade currency two\n\n")
-	_dumpTradeCurrency(trade_index, trade_currency_two)
-
-	s = currencies.select().where(currencies.c.address_prefix == trade_currency_two.address_prefix)
-	currency_two = conn.execute(s).all()[0]
+	conn.close()
+	return trade
+
+async def tradeCode(trade_id):
+	trade_state = trade_registry.get(trade_id)
+
+	trade = await event_loop.inExecutor(_loadTrade, trades, trade_id)
+	trade_state.step = trade.step
+	if trade.step == DONE_STEP:
+		trade_state.message = "Done! Check your wallet :)"
+		return
+
+	trade_state.log.write("ONLY SHARE THE CONTENTS OF THIS FILE WITH TRUSTED PEOPLE\n")
+	trade_state.log.write(f"Trade\n\n")
+	trade_state.log.write(f"Trade id: {trade_id}\n")
+	trade_state.log.write(f"Secret hash: {trade.secret_hash}\n")
+	trade_state.log.write(f"Is Buyer?: {trade.is_buyer}\n")
+	trade_state.log.write(f"Secret: {trade.secret}\n")
+	trade_state.log.write(f"Step: {trade.step}\n\n\n")
+
+	trade_currency_one, currency_one = await event_loop.inExecutor(_loadTradeCurrency, trade.trade_currency_one)
+	trade_state.log.write(f"Trade currency one\n\n")
+	_dumpTradeCurrency(trade_state, trade_currency_one)
+
+	trade_currency_two, currency_two = await event_loop.inExecutor(_loadTradeCurrency, trade.trade_currency_two)
+	trade_state.log.write(f"Trade currency two\n\n")
+	_dumpTradeCurrency(trade_state, trade_currency_two)
 	
 	coin_record_one = False
 	coin_record_two = False
@@ -532,86 +753,60 @@ def tradeCode(trade_id):
 	shouldCancel = False
 
 	if trade.step == 0:
-		shouldCancel, coin_record_one = tradeWaitForContract(trade_index, trade, trade_currency_one, currency_one, trade.is_buyer, True)
+		shouldCancel, coin_record_one = await tradeWaitForContract(trade_state, trade, trade_currency_one, currency_one, trade.is_buyer, True)
 
-		s = trades.update().where(trades.c.id == trade_id).values(step = 1)
-		conn.execute(s)
-		s = trades.select().where(trades.c.id == trade_id)
-		trade = conn.execute(s).all()[0]
+		trade = await event_loop.inExecutor(_setTradeStep, trades, trade_id, 1)
+		trade_state.step = trade.step
 		coming_from_step_0 = True
 
 	if trade.step == 1:
-		shouldCancel, coin_record_two = tradeWaitForContract(trade_index, trade, trade_currency_two, currency_two, not trade.is_buyer, coming_from_step_0, trade_currency_one, currency_one)
+		shouldCancel, coin_record_two = await tradeWaitForContract(trade_state, trade, trade_currency_two, currency_two, not trade.is_buyer, coming_from_step_0, trade_currency_one, currency_one)
 
-		s = trades.update().where(trades.c.id == trade_id).values(step = 2)
-		conn.execute(s)
-		s = trades.select().where(trades.c.id == trade_id)
-		trade = conn.execute(s).all()[0]
+		trade = await event_loop.inExecutor(_setTradeStep, trades, trade_id, 2)
+		trade_state.step = trade.step
 
 	if trade.step == 2:
-		trade_threads_messages[trade_index] = "Starting last step..."
-		trade_threads_addresses[trade_index] = None
+		trade_state.message = "Starting last step..."
+		trade_state.address = None
 
 		cancelTrade = shouldCancel
 		if not cancelTrade:
 			if trade.is_buyer:
-				coin_record_two, cancelTrade = shouldCancelTrade(trade_index, trade, trade_currency_two, currency_two, coin_record_two)
+				coin_record_two, cancelTrade = await shouldCancelTrade(trade_state, trade, trade_currency_two, currency_two, coin_record_two)
 			else:
-				coin_record_one, cancelTrade = shouldCancelTrade(trade_index, trade, trade_currency_one, currency_one, coin_record_one)
+				coin_record_one, cancelTrade = await shouldCancelTrade(trade_state, trade, trade_currency_one, currency_one, coin_record_one)
 
-		trade_threads_files[trade_index].write(f"Cancel trade: {cancelTrade}\n")
-		trade_threads_files[trade_index].flush()
+		trade_state.log.write(f"Cancel trade: {cancelTrade}\n")
 		if cancelTrade:
-			solution_program = getSolutionProgram("CANCEL-" + str(random.SystemRandom().getrandbits(128))).as_bin().hex()
+			solution_program = await event_loop.inExecutor(_solutionProgramHex, "CANCEL-" + str(random.SystemRandom().getrandbits(128)))
 			if trade.is_buyer:
-				tradeClaimContract(trade_index, trade, trade_currency_one, currency_one, solution_program, coin_record_one, True)
+				await tradeClaimContract(trade_state, trade, trade_currency_one, currency_one, solution_program, coin_record_one, True)
 			else:
-				tradeClaimContract(trade_index, trade, trade_currency_two, currency_two, solution_program, coin_record_two, True)
+				await tradeClaimContract(trade_state, trade, trade_currency_two, currency_two, solution_program, coin_record_two, True)
 		else:
 			if trade.is_buyer:
-				solution_program = getSolutionProgram(trade.secret).as_bin().hex()
-				tradeClaimContract(trade_index, trade, trade_currency_two, currency_two, solution_program, coin_record_two)
+				solution_program = await event_loop.inExecutor(_solutionProgramHex, trade.secret)
+				await tradeClaimContract(trade_state, trade, trade_currency_two, currency_two, solution_program, coin_record_two)
 			else:
-				solution_program = lookForSolutionInBlockchain(trade_index, trade, trade_currency_two, currency_two, coin_record_two, trade_currency_one, currency_one)
+				solution_program = await lookForSolutionInBlockchain(trade_state, trade, trade_currency_two, currency_two, coin_record_two, trade_currency_one, currency_one)
 				if solution_program == False:
-					tradeClaimContract(trade_index, trade, trade_currency_two, currency_two, solution_program, coin_record_two, True)
+					await tradeClaimContract(trade_state, trade, trade_currency_two, currency_two, solution_program, coin_record_two, True)
 				else:
-					tradeClaimContract(trade_index, trade, trade_currency_one, currency_one, solution_program, coin_record_one)
+					await tradeClaimContract(trade_state, trade, trade_currency_one, currency_one, solution_program, coin_record_one)
 
-	conn.close()
+		trade = await event_loop.inExecutor(_setTradeStep, trades, trade_id, DONE_STEP)
+		trade_state.step = trade.step
 
 class Trade(Resource):
 	def get(self, trade_id):
-		global trade_threads_ids, trade_threads_messages, trade_threads_addresses, trade_threads_files, trade_threads_commands
-		if not trade_id in trade_threads_ids:
-			t = threading.Thread(target=tradeCode, args=(trade_id, ))
-			trade_threads_ids.append(trade_id)
-			trade_threads_messages.append("Starting thread...")
-			trade_threads_addresses.append(None)
-			trade_threads_files.append(open(f"{trade_id}-log.txt", "a+"))
-			trade_threads_commands.append(None)
-			t.start()
-
-		index = 0
-		for i, v in enumerate(trade_threads_ids):
-			if v == trade_id:
-				index = i
+		trade_state = startTrade(trade_id, tradeCode, f"{trade_id}-log.txt")
 		return {
-			"message": trade_threads_messages[index],
-			"address": trade_threads_addresses[index]
+			"message": trade_state.message,
+			"address": trade_state.address
 		}
 
-	def addTradeCurrency(self, engine, data):
-		conn = engine.connect()
-
-		s = trade_currencies.select().where(trade_currencies.c.id == data['id'])
-		result = conn.execute(s)
-		st = None
-		if len(result.all()) == 0:
-			st = trade_currencies.insert()
-		else:
-			st = trade_currencies.update().where(trade_currencies.c.id == data['id'])
-		st = st.values(
+	def addTradeCurrency(self, conn, data):
+		st = upsert(trade_currencies, dict(
 			id = data['id'],
 			address_prefix = data['address_prefix'],
 			fee = data['fee'],
@@ -620,11 +815,9 @@ class Trade(Resource):
 			from_address = data['from_address'],
 			to_address = data['to_address'],
 			total_amount = data['total_amount']
-		)
+		))
 		conn.execute(st)
 
-		conn.close()
-
 	def put(self, trade_id):
 		parser = reqparse.RequestParser()
 		parser.add_argument('trade_currency_one', type=dict, required=True)
@@ -637,30 +830,23 @@ class Trade(Resource):
 
 		args = parser.parse_args(strict=True)
 
-		self.addTradeCurrency(engine, args['trade_currency_one'])
-		self.addTradeCurrency(engine, args['trade_currency_two'])
-
-		conn = engine.connect()
-
-		s = trades.select().where(trades.c.id == trade_id)
-		result = conn.execute(s)
-		st = None
-		if len(result.all()) == 0:
-			st = trades.insert()
-		else:
-			st = trades.update().where(trades.c.id == trade_id)
-		st = st.values(
-			id = trade_id,
-			trade_currency_one = args['trade_currency_one']['id'],
-			trade_currency_two = args['trade_currency_two']['id'],
-			secret_hash = args['secret_hash'],
-			is_buyer = args['is_buyer'],
-			secret = args['secret'],
-			step = args['step'],
-		)
-		conn.execute(st)
-
-		conn.close()
+		# the trade and both of its currencies are written in one transaction
+		with engine.begin() as conn:
+			self.addTradeCurrency(conn, args['trade_currency_one'])
+			self.addTradeCurrency(conn, args['trade_currency_two'])
+
+			st = upsert(trades, dict(
+				id = trade_id,
+				trade_currency_one = args['trade_currency_one']['id'],
+				trade_currency_two = args['trade_currency_two']['id'],
+				secret_hash = args['secret_hash'],
+				is_buyer = args['is_buyer'],
+				secret = args['secret'],
+				step = args['step'],
+			))
+			conn.execute(st)
+
+		event_loop.runInBackground(precacheTradeContracts, args['secret_hash'], [args['trade_currency_one'], args['trade_currency_two']])
 		return {'success': True}
 
 	def delete(self, trade_id):
@@ -672,68 +858,107 @@ class Trade(Resource):
 		conn.close()
 		return {'success': True}
 
+class TradeStatus(Resource):
+	def get(self, trade_id):
+		return longPollTradeStatus(startTrade(trade_id, tradeCode, f"{trade_id}-log.txt"), False)
+
+class TradeEvents(Resource):
+	def get(self, trade_id):
+		return streamTradeStatus(startTrade(trade_id, tradeCode, f"{trade_id}-log.txt"), False)
+
 class EthTrades(Resource):
 	def get(self):
+		args = parseTradeListArgs()
 		conn = engine.connect()
 
-		s = eth_trades.select()
-		result = conn.execute(s)
+		s, tc = selectEthTradesWithCurrencies()
+		if args['address_prefix'] is not None:
+			s = s.where(tc.c.address_prefix == args['address_prefix'])
+		s = paginateTrades(s, eth_trades, args)
+		rows, next_cursor = nextCursor(conn.execute(s).all(), args)
 		res = []
 
-		for row in result:
-			stmt = trade_currencies.select().where(trade_currencies.c.id == row[1])
-			trade_currency = conn.execute(stmt).all()[0]
-
-			res.append(ethTradesRowToJson(row, tradeCurrencyRowToJson(trade_currency)))
+		for row in rows:
+			res.append(ethTradesRowToJson(row, tradeCurrencyColumnsToJson(row, 'tc_')))
 
 		conn.close()
-		return {'trades': res}
+		return {'trades': res, 'next_cursor': next_cursor}
+
+# Values posted by the browser for an ETH trade. Only used from the event loop thread:
+# EthTrade.post hands new values over with event_loop.call, which wakes the waiting trade coroutine.
+class EthTradeResponses():
+	def __init__(self):
+		self.values = {}
+		self.updated = asyncio.Event()
+
+	def update(self, data):
+		self.values.update(data)
+		self.updated.set()
+		self.updated = asyncio.Event()
+
+	async def waitForUpdate(self):
+		await self.updated.wait()
+
+	async def waitFor(self, predicate):
+		while not predicate(self.values):
+			await self.waitForUpdate()
+
+# Values the browser posts for a trade that hasn't started yet, e.g. while a shard worker is still
+# replaying its trades, are kept for it for up to ETH_POSTED_RESPONSES_TTL seconds.
+ETH_POSTED_RESPONSES_TTL = 600
 
 eth_trade_responses = {}
+eth_trade_posted_early = OrderedDict() # trade id -> when values were first posted for it before it started
 
-def getResponse(trade_id, key, retry=True):
+def getTradeResponses(trade_id):
 	global eth_trade_responses
-	if eth_trade_responses.get(trade_id, -1) == -1:
-		eth_trade_responses[trade_id] = {}
-
-	val = eth_trade_responses[trade_id].get(key, -1)
-	while retry and val == -1:
-		time.sleep(1)
-		val = eth_trade_responses[trade_id].get(key, -1)
+	responses = eth_trade_responses.get(trade_id, None)
+	if responses is None:
+		responses = EthTradeResponses()
+		eth_trade_responses[trade_id] = responses
+	return responses
+
+def _postResponses(trade_id, data):
+	# runs on the event loop, like the trades that read the values
+	now = time.time()
+	while len(eth_trade_posted_early) > 0 and now - next(iter(eth_trade_posted_early.values())) > ETH_POSTED_RESPONSES_TTL:
+		early_trade_id, posted_at = eth_trade_posted_early.popitem(last=False)
+		eth_trade_responses.pop(early_trade_id, None)
+	# values for a trade that's over would never be read
+	if trade_registry.hasEnded(trade_id):
+		return
+	if trade_registry.get(trade_id) is None and trade_id not in eth_trade_posted_early:
+		eth_trade_posted_early[trade_id] = now
+	getTradeResponses(trade_id).update(data)
 
-	if val == -1:
-		return False
-	return val
+async def getResponse(trade_id, key, retry=True):
+	responses = getTradeResponses(trade_id)
+	if retry:
+		await responses.waitFor(lambda values: key in values)
+	return responses.values.get(key, False)
 
-def ethTradeCode(trade_id):
-	global trade_threads_ids, trade_threads_messages, trade_threads_addresses, trade_threads_files, eth_trade_responses
+async def ethTradeCode(trade_id):
 	global ETH_MAX_BLOCK_HEIGHT, ETH_REQUIRED_CONFIRMATIONS
-	trade_index = 0
-	for i, v in enumerate(trade_threads_ids):
-		if v == trade_id:
-			trade_index = i
+	trade_state = trade_registry.get(trade_id)
+	responses = getTradeResponses(trade_id)
 
-	trade_threads_files[trade_index].write("ONLY SHARE THE CONTENTS OF THIS FILE WITH TRUSTED PEOPLE\n")
-
-	conn = engine.connect()
+	trade = await event_loop.inExecutor(_loadTrade, eth_trades, trade_id)
+	trade_state.step = trade.step
+	if trade.step == DONE_STEP:
+		trade_state.message = "Done :)"
+		return
 
-	s = eth_trades.select().where(eth_trades.c.id == trade_id)
-	trade = conn.execute(s).all()[0]
-	trade_threads_files[trade_index].write(f"Trade\n\n")
-	trade_threads_files[trade_index].write(f"Trade id: {trade_id}\n")
-	trade_threads_files[trade_index].write(f"Secret hash: {trade.secret_hash}\n")
-	trade_threads_files[trade_index].write(f"Is Buyer?: {trade.is_buyer}\n")
-	trade_threads_files[trade_index].write(f"Secret: {trade.secret}\n")
-	trade_threads_files[trade_index].write(f"Step: {trade.step}\n\n\n")
-	trade_threads_files[trade_index].flush()
-
-	s = trade_currencies.select().where(trade_currencies.c.id == trade.trade_currency)
-	trade_currency = conn.execute(s).all()[0]
-	trade_threads_files[trade_index].write(f"Trade currency\n\n")
-	_dumpTradeCurrency(trade_index, trade_currency)
+	trade_state.log.write("ONLY SHARE THE CONTENTS OF THIS FILE WITH TRUSTED PEOPLE\n")
+	trade_state.log.write(f"Trade\n\n")
+	trade_state.log.write(f"Trade id: {trade_id}\n")
+	trade_state.log.write(f"Secret hash: {trade.secret_hash}\n")
+	trade_state.log.write(f"Is Buyer?: {trade.is_buyer}\n")
+	trade_state.log.write(f"Secret: {trade.secret}\n")
+	trade_state.log.write(f"Step: {trade.step}\n\n\n")
 
-	s = currencies.select().where(currencies.c.address_prefix == trade_currency.address_prefix)
-	currency = conn.execute(s).all()[0]
+	trade_currency, currency = await event_loop.inExecutor(_loadTradeCurrency, trade.trade_currency)
+	trade_state.log.write(f"Trade currency\n\n")
+	_dumpTradeCurrency(trade_state, trade_currency)
 
 	coin_record = False
 	coming_from_step_0 = False
@@ -752,152 +977,123 @@ def ethTradeCode(trade_id):
 		"amount": trade[4]
 	}
 	if trade.step == 0:
-		trade_threads_addresses[trade_index] = None
-		trade_threads_files[trade_index].write(f"Swap data: {json.dumps(swap_data)}\n\n")
-		trade_threads_files[trade_index].flush()
+		trade_state.address = None
+		trade_state.log.write(f"Swap data: {json.dumps(swap_data)}\n\n")
 
 		if trade.is_buyer:
-			trade_threads_messages[trade_index] = f"Press the button below to create the swap on the Ethereum blockchain\nMake sure you're connected to the following network: {trade[9]}"
-			trade_threads_commands[trade_index] = {"code": "CREATE_SWAP", "args": swap_data}
-
-			token_approval_tx_sent = getResponse(trade_id, "token_approval_tx_sent")
-			trade_threads_messages[trade_index] = "Confirming token approval..."
-			trade_threads_commands[trade_index] = None
-			token_approval_tx_confirmed = getResponse(trade_id, "token_approval_tx_confirmed")
-			trade_threads_messages[trade_index] = "Please approve the 2nd transaction"
-			created = getResponse(trade_id, "createSwap_tx_sent")
-			trade_threads_messages[trade_index] = "Waiting for 2nd transaction to be confirmed..."
-			created = getResponse(trade_id, "swap_created")
-
-		trade_threads_messages[trade_index] = f"Waiting for swap to be confirmed on the Ethereum blockchain...\nMake sure you're connected to the following network: {trade[9]}"
-		trade_threads_commands[trade_index] = {"code": "WAIT_FOR_SWAP", "args": swap_data}
+			trade_state.message = f"Press the button below to create the swap on the Ethereum blockchain\nMake sure you're connected to the following network: {trade[9]}"
+			trade_state.command = {"code": "CREATE_SWAP", "args": swap_data}
+
+			token_approval_tx_sent = await getResponse(trade_id, "token_approval_tx_sent")
+			trade_state.message = "Confirming token approval..."
+			trade_state.command = None
+			token_approval_tx_confirmed = await getResponse(trade_id, "token_approval_tx_confirmed")
+			trade_state.message = "Please approve the 2nd transaction"
+			created = await getResponse(trade_id, "createSwap_tx_sent")
+			trade_state.message = "Waiting for 2nd transaction to be confirmed..."
+			created = await getResponse(trade_id, "swap_created")
+
+		trade_state.message = f"Waiting for swap to be confirmed on the Ethereum blockchain...\nMake sure you're connected to the following network: {trade[9]}"
+		trade_state.command = {"code": "WAIT_FOR_SWAP", "args": swap_data}
 		
-		swap_id = getResponse(trade_id, "swap_id")
-		confirmations = getResponse(trade_id, "confirmations")
+		swap_id = await getResponse(trade_id, "swap_id")
+		confirmations = await getResponse(trade_id, "confirmations")
 
 		while confirmations < ETH_REQUIRED_CONFIRMATIONS:
-			trade_threads_messages[trade_index] = f"Confirming swap creation ({confirmations}/{ETH_REQUIRED_CONFIRMATIONS})"
-			confirmations = getResponse(trade_id, "confirmations")
-			time.sleep(5)
+			trade_state.message = f"Confirming swap creation ({confirmations}/{ETH_REQUIRED_CONFIRMATIONS})"
+			await responses.waitForUpdate()
+			confirmations = responses.values["confirmations"]
 
-		trade_threads_messages[trade_index] = f"Commencing to next step..."
-		trade_threads_commands[trade_index] = None
+		trade_state.message = f"Commencing to next step..."
+		trade_state.command = None
 
-		shouldCancel = getResponse(trade_id, "should_cancel", False)
+		shouldCancel = await getResponse(trade_id, "should_cancel", False)
 
-		s = eth_trades.update().where(eth_trades.c.id == trade_id).values(step = 1)
-		conn.execute(s)
-		s = eth_trades.select().where(eth_trades.c.id == trade_id)
-		trade = conn.execute(s).all()[0]
+		trade = await event_loop.inExecutor(_setTradeStep, eth_trades, trade_id, 1)
+		trade_state.step = trade.step
 
 		coming_from_step_0 = True
 
 	if trade.step == 1:
-		shouldCancel = shouldCancel or getResponse(trade_id, "should_cancel", False)
+		shouldCancel = shouldCancel or await getResponse(trade_id, "should_cancel", False)
 		if not shouldCancel:
-			eth_trade_responses[trade_id]['confirmations'] = -2
-			trade_threads_messages[trade_index] = f"Getting ETH transaction confirmations..."
-			trade_threads_commands[trade_index] = {"code": "WAIT_FOR_SWAP", "args": swap_data}
-			while eth_trade_responses[trade_id]['confirmations'] == -2:
-				time.sleep(1)
+			responses.values['confirmations'] = -2
+			trade_state.message = f"Getting ETH transaction confirmations..."
+			trade_state.command = {"code": "WAIT_FOR_SWAP", "args": swap_data}
+			await responses.waitFor(lambda values: values['confirmations'] != -2)
 
-			trade_threads_commands[trade_index] = None
+			trade_state.command = None
 
 			def checkFunc():
-				global eth_trade_responses
-				return eth_trade_responses[trade_id]["confirmations"] < ETH_MAX_BLOCK_HEIGHT * 3 // 4
-			shouldCancel, coin_record = tradeWaitForContract(trade_index, trade, trade_currency, currency, not trade.is_buyer, False, False, False, checkFunc)
+				return responses.values["confirmations"] < ETH_MAX_BLOCK_HEIGHT * 3 // 4
+			shouldCancel, coin_record = await tradeWaitForContract(trade_state, trade, trade_currency, currency, not trade.is_buyer, False, False, False, checkFunc)
 
-		s = eth_trades.update().where(eth_trades.c.id == trade_id).values(step = 2)
-		conn.execute(s)
-		s = eth_trades.select().where(eth_trades.c.id == trade_id)
-		trade = conn.execute(s).all()[0]
+		trade = await event_loop.inExecutor(_setTradeStep, eth_trades, trade_id, 2)
+		trade_state.step = trade.step
 
 	if trade.step == 2:
-		trade_threads_messages[trade_index] = "Starting last step..."
-		trade_threads_addresses[trade_index] = None
+		trade_state.message = "Starting last step..."
+		trade_state.address = None
 
-		cancelTrade = shouldCancel or getResponse(trade_id, "should_cancel", False)
+		cancelTrade = shouldCancel or await getResponse(trade_id, "should_cancel", False)
 		if not cancelTrade:
-			coin_record, cancelTrade = shouldCancelTrade(trade_index, trade, trade_currency, currency, coin_record)
-			eth_trade_responses[trade_id]['confirmations'] = -2
-			trade_threads_messages[trade_index] = f"Verifying ETH height..."
-			trade_threads_commands[trade_index] = {"code": "WAIT_FOR_SWAP", "args": swap_data}
-			while eth_trade_responses[trade_id]["confirmations"] == -2:
-				time.sleep(1)
-
-			trade_threads_commands[trade_index] = None
-			cancelTrade = cancelTrade or (eth_trade_responses[trade_id]['confirmations'] > ETH_MAX_BLOCK_HEIGHT * 3 // 4)
-
-		trade_threads_files[trade_index].write(f"Cancel trade: {cancelTrade}\n")
-		trade_threads_files[trade_index].flush()
+			coin_record, cancelTrade = await shouldCancelTrade(trade_state, trade, trade_currency, currency, coin_record)
+			responses.values['confirmations'] = -2
+			trade_state.message = f"Verifying ETH height..."
+			trade_state.command = {"code": "WAIT_FOR_SWAP", "args": swap_data}
+			await responses.waitFor(lambda values: values['confirmations'] != -2)
+
+			trade_state.command = None
+			cancelTrade = cancelTrade or (responses.values['confirmations'] > ETH_MAX_BLOCK_HEIGHT * 3 // 4)
+
+		trade_state.log.write(f"Cancel trade: {cancelTrade}\n")
 		if cancelTrade:
 			cancelStr = "CANCEL-" + str(random.SystemRandom().getrandbits(128))
 			if not trade.is_buyer:
-				solution_program = getSolutionProgram(cancelStr).as_bin().hex()
-				tradeClaimContract(trade_index, trade, trade_currency, currency, solution_program, coin_record, True)
+				solution_program = await event_loop.inExecutor(_solutionProgramHex, cancelStr)
+				await tradeClaimContract(trade_state, trade, trade_currency, currency, solution_program, coin_record, True)
 			else:
-				trade_threads_messages[trade_index] = "Cancel trade - waiting for the swap to expire..."
-				trade_threads_commands[trade_index] = None
-				while eth_trade_responses[trade_id]["confirmations"] < ETH_MAX_BLOCK_HEIGHT:
-					trade_threads_messages[trade_index] = f"{ETH_MAX_BLOCK_HEIGHT - eth_trade_responses[trade_id]['confirmations']} blocks left before you can cancel the swap..."
-					trade_threads_commands[trade_index] = {"code": "WAIT_FOR_SWAP", "args": swap_data}
-				trade_threads_messages[trade_index] = "Press the button below to cancel the swap :("
-				trade_threads_commands[trade_index] = {"code": "CANCEL_SWAP", "args": swap_data}
-				swap_completed = getResponse(trade_id, "swap_completed")
+				trade_state.message = "Cancel trade - waiting for the swap to expire..."
+				trade_state.command = None
+				while responses.values["confirmations"] < ETH_MAX_BLOCK_HEIGHT:
+					trade_state.message = f"{ETH_MAX_BLOCK_HEIGHT - responses.values['confirmations']} blocks left before you can cancel the swap..."
+					trade_state.command = {"code": "WAIT_FOR_SWAP", "args": swap_data}
+					await responses.waitForUpdate()
+				trade_state.message = "Press the button below to cancel the swap :("
+				trade_state.command = {"code": "CANCEL_SWAP", "args": swap_data}
+				swap_completed = await getResponse(trade_id, "swap_completed")
 		else:
 			if not trade.is_buyer:
-				trade_threads_messages[trade_index] = "Searching the Chia blockchan for a solution..."
-				trade_threads_commands[trade_index] = None
-				solution_program = lookForSolutionInBlockchain(trade_index, trade, trade_currency, currency, coin_record)
-				secret = getSecretFromSolutionProgram(solution_program)
-				trade_threads_messages[trade_index] = "Press the button below to claim your ETH"
+				trade_state.message = "Searching the Chia blockchan for a solution..."
+				trade_state.command = None
+				solution_program = await lookForSolutionInBlockchain(trade_state, trade, trade_currency, currency, coin_record)
+				secret = await event_loop.inExecutor(getSecretFromSolutionProgram, solution_program)
+				trade_state.message = "Press the button below to claim your ETH"
 				swap_data["secret"] = secret
-				trade_threads_commands[trade_index] = {"code": "COMPLETE_SWAP", "args": swap_data}
-				swap_completed = getResponse(trade_id, "swap_completed")
+				trade_state.command = {"code": "COMPLETE_SWAP", "args": swap_data}
+				swap_completed = await getResponse(trade_id, "swap_completed")
 			else:
-				trade_threads_messages[trade_index] = "Preparing to claim XCH..."
-				trade_threads_commands[trade_index] = None
-				solution_program = getSolutionProgram(trade.secret).as_bin().hex()
-				tradeClaimContract(trade_index, trade, trade_currency, currency, solution_program, coin_record)
+				trade_state.message = "Preparing to claim XCH..."
+				trade_state.command = None
+				solution_program = await event_loop.inExecutor(_solutionProgramHex, trade.secret)
+				await tradeClaimContract(trade_state, trade, trade_currency, currency, solution_program, coin_record)
 				
-		trade_threads_messages[trade_index] = "Done :)"
-		trade_threads_commands[trade_index] = None
-	conn.close()
+		trade = await event_loop.inExecutor(_setTradeStep, eth_trades, trade_id, DONE_STEP)
+		trade_state.step = trade.step
+		trade_state.message = "Done :)"
+		trade_state.command = None
 
 class EthTrade(Resource):
 	def get(self, trade_id):
-		global trade_threads_ids, etrade_threads_messages, trade_threads_addresses, trade_threads_commands, trade_threads_files
-		if not trade_id in trade_threads_ids:
-			t = threading.Thread(target=ethTradeCode, args=(trade_id, ))
-			trade_threads_ids.append(trade_id)
-			trade_threads_messages.append("Starting thread...")
-			trade_threads_addresses.append(None)
-			trade_threads_commands.append(None)
-			trade_threads_files.append(open(f"{trade_id}-ETH-log.txt", "a+"))
-			t.start()
-
-		index = 0
-		for i, v in enumerate(trade_threads_ids):
-			if v == trade_id:
-				index = i
+		trade_state = startTrade(trade_id, ethTradeCode, f"{trade_id}-ETH-log.txt")
 		return {
-			"message": trade_threads_messages[index],
-			"address": trade_threads_addresses[index],
-			"command": trade_threads_commands[index]
+			"message": trade_state.message,
+			"address": trade_state.address,
+			"command": trade_state.command
 		}
 
-	def addTradeCurrency(self, engine, data):
-		conn = engine.connect()
-
-		s = trade_currencies.select().where(trade_currencies.c.id == data['id'])
-		result = conn.execute(s)
-		st = None
-		if len(result.all()) == 0:
-			st = trade_currencies.insert()
-		else:
-			st = trade_currencies.update().where(trade_currencies.c.id == data['id'])
-		st = st.values(
+	def addTradeCurrency(self, conn, data):
+		st = upsert(trade_currencies, dict(
 			id = data['id'],
 			address_prefix = data['address_prefix'],
 			fee = data['fee'],
@@ -906,23 +1102,19 @@ class EthTrade(Resource):
 			from_address = data['from_address'],
 			to_address = data['to_address'],
 			total_amount = data['total_amount']
-		)
+		))
 		conn.execute(st)
 
-		conn.close()
-
 	def post(self, trade_id):
-		global eth_trade_responses
 		parser = reqparse.RequestParser()
 		parser.add_argument('data', type=dict, required=True)
 
 		args = parser.parse_args(strict=True)
 
-		if eth_trade_responses.get(trade_id, -1) == -1:
-			eth_trade_responses[trade_id] = {}
-
-		for key, value in args['data'].items():
-			eth_trade_responses[trade_id][key] = value
+		if shard_pool is not None:
+			shard_pool.post(trade_id, args['data'])
+		else:
+			event_loop.call(_postResponses, trade_id, args['data'])
 
 	def put(self, trade_id):
 		parser = reqparse.RequestParser()
@@ -940,33 +1132,26 @@ class EthTrade(Resource):
 
 		args = parser.parse_args(strict=True)
 
-		self.addTradeCurrency(engine, args['trade_currency'])
-
-		conn = engine.connect()
-
-		s = eth_trades.select().where(eth_trades.c.id == trade_id)
-		result = conn.execute(s)
-		st = None
-		if len(result.all()) == 0:
-			st = eth_trades.insert()
-		else:
-			st = eth_trades.update().where(eth_trades.c.id == trade_id)
-		st = st.values(
-			id = trade_id,
-			trade_currency = args['trade_currency']['id'],
-			eth_from_address = args['eth_from_address'],
-			eth_to_address = args['eth_to_address'],
-			total_gwei = args['total_gwei'],
-			secret_hash = args['secret_hash'],
-			is_buyer = args['is_buyer'],
-			secret = args['secret'],
-			step = args['step'],
-			network = args['network'],
-			token = args['token']
-		)
-		conn.execute(st)
-
-		conn.close()
+		# the trade and its currency are written in one transaction
+		with engine.begin() as conn:
+			self.addTradeCurrency(conn, args['trade_currency'])
+
+			st = upsert(eth_trades, dict(
+				id = trade_id,
+				trade_currency = args['trade_currency']['id'],
+				eth_from_address = args['eth_from_address'],
+				eth_to_address = args['eth_to_address'],
+				total_gwei = args['total_gwei'],
+				secret_hash = args['secret_hash'],
+				is_buyer = args['is_buyer'],
+				secret = args['secret'],
+				step = args['step'],
+				network = args['network'],
+				token = args['token']
+			))
+			conn.execute(st)
+
+		event_loop.runInBackground(precacheTradeContracts, args['secret_hash'], [args['trade_currency']])
 		return {'success': True}
 
 	def delete(self, trade_id):
@@ -979,25 +1164,129 @@ class EthTrade(Resource):
 		return {'success': True}
 
 
+class EthTradeStatus(Resource):
+	def get(self, trade_id):
+		return longPollTradeStatus(startTrade(trade_id, ethTradeCode, f"{trade_id}-ETH-log.txt"), True)
+
+class EthTradeEvents(Resource):
+	def get(self, trade_id):
+		return streamTradeStatus(startTrade(trade_id, ethTradeCode, f"{trade_id}-ETH-log.txt"), True)
+
+
 class EthNetworks(Resource):
 	def get(self):
 		return json.loads(getNetworksString())
 
 
 api.add_resource(PingService, '/api/ping')
+api.add_resource(Metrics, '/api/metrics')
 api.add_resource(ConnectionStatus, '/api/connection-status')
 api.add_resource(Currencies, '/api/currencies')
 api.add_resource(Trades, '/api/trades')
+api.add_resource(TradesImport, '/api/trades/import')
+api.add_resource(TradesExport, '/api/trades/export')
 api.add_resource(Currency, '/api/currency/<string:address_prefix>')
 api.add_resource(Trade, '/api/trade/<string:trade_id>')
+api.add_resource(TradeStatus, '/api/trade/<string:trade_id>/status')
+api.add_resource(TradeEvents, '/api/trade/<string:trade_id>/events')
 api.add_resource(EthTrades, '/api/eth/trades')
 api.add_resource(EthNetworks, '/api/eth/networks')
 api.add_resource(EthTrade, '/api/eth/trade/<string:trade_id>')
+api.add_resource(EthTradeStatus, '/api/eth/trade/<string:trade_id>/status')
+api.add_resource(EthTradeEvents, '/api/eth/trade/<string:trade_id>/events')
 
 @app.route('/', defaults={'path': 'index.html'})
 @app.route('/<path:path>')
 def get_resource(path):
 	return send_from_directory('html', path)
 
+# how long resumeTrades waits for a node to answer while ranking the trades on it
+RESUME_PROBE_TIMEOUT = 30
+
+def getResumableTrades():
+	# (step, trade_id, code, log_filename, contracts) for every trade that isn't done, where contracts
+	# lists (puzzle hash, max_block_height, currency) for each of the trade's contracts
+	conn = engine.connect()
+	res = []
+	currencies_by_prefix = dict((row.address_prefix, row) for row in conn.execute(currencies.select()))
+
+	def contract(row, prefix):
+		puzzle_hash = getContractPuzzleHash(
+			row.secret_hash,
+			getattr(row, prefix + "total_amount"),
+			getattr(row, prefix + "fee"),
+			getattr(row, prefix + "from_address"),
+			getattr(row, prefix + "to_address"),
+			getattr(row, prefix + "max_block_height")
+		)
+		return puzzle_hash.hex(), getattr(row, prefix + "max_block_height"), currencies_by_prefix.get(getattr(row, prefix + "address_prefix"), None)
+
+	s, tc1, tc2 = selectTradesWithCurrencies()
+	for row in conn.execute(s.where(trades.c.step < DONE_STEP)):
+		# without a secret hash there's no contract to claim or cancel
+		contracts = [contract(row, "tc1_"), contract(row, "tc2_")] if row.secret_hash is not None else []
+		res.append((row.step, row.id, tradeCode, f"{row.id}-log.txt", contracts))
+
+	s, tc = selectEthTradesWithCurrencies()
+	for row in conn.execute(s.where(eth_trades.c.step < DONE_STEP)):
+		contracts = [contract(row, "tc_")] if row.secret_hash is not None else []
+		res.append((row.step, row.id, ethTradeCode, f"{row.id}-ETH-log.txt", contracts))
+
+	conn.close()
+	return res
+
+async def rankResumableTrade(step, contracts):
+	# the priority a trade is resumed with (lower values first), or None if none of its contracts has
+	# an unspent coin, i.e. there's nothing to claim or cancel: it was never funded, or it's over.
+	# Trades are ranked by the blocks left before their first unspent contract expires; if a node
+	# can't tell, they go after those, later steps and shorter max_block_heights first.
+	fallback = (1, 2 - step, min([max_block_height for puzzle_hash, max_block_height, currency in contracts] or [0]))
+	blocks_left = []
+	for puzzle_hash, max_block_height, currency in contracts:
+		if currency is None:
+			return fallback
+		full_node_client = AsyncFullNodeClient(currency.ssl_directory, currency.host, currency.port)
+		height_watcher = getHeightWatcher(currency.ssl_directory, currency.host, currency.port)
+		try:
+			height = await asyncio.wait_for(height_watcher.getHeight(), RESUME_PROBE_TIMEOUT)
+		except asyncio.TimeoutError:
+			return fallback
+		coin_record = await full_node_client.getContractCoinRecord(puzzle_hash, height - 10000 - max_block_height, True)
+		if coin_record is None:
+			return fallback
+		if coin_record != False and coin_record["spent_block_index"] == 0:
+			blocks_left.append(coin_record["confirmed_block_index"] + max_block_height - height)
+	if len(blocks_left) == 0:
+		return None
+	return (0, min(blocks_left))
+
+async def resumeTrades():
+	scheduler = ResumeScheduler(trade_registry)
+	resumable = await event_loop.inExecutor(getResumableTrades)
+	priorities = await asyncio.gather(*[rankResumableTrade(step, contracts) for step, trade_id, code, log_filename, contracts in resumable])
+	skipped = 0
+	for priority, (step, trade_id, code, log_filename, contracts) in zip(priorities, resumable):
+		if priority is None:
+			# still started when the UI asks for it
+			skipped += 1
+			continue
+		scheduler.add(priority, trade_id, lambda trade_id=trade_id, code=code, log_filename=log_filename: _startTrade(trade_id, code, log_filename))
+	if skipped > 0:
+		print(f"Not resuming {skipped} unfinished trades without an unspent contract coin")
+	await scheduler.run()
+
 if __name__ == '__main__':
+	if trade_shards.SHARD_WORKER_ARG in sys.argv:
+		codes = {"tradeCode": tradeCode, "ethTradeCode": ethTradeCode}
+		trade_shards.runWorker(sys.argv[sys.argv.index(trade_shards.SHARD_WORKER_ARG) + 1:], trade_registry, startTrade, codes, _postResponses)
+		sys.exit(0)
+
+	if startup_profile.enabled:
+		startup_profile.report()
+	# with debug on, the reloader runs this file twice; only its child process serves requests
+	serving = not debug or os.environ.get('WERKZEUG_RUN_MAIN') == 'true'
+	if trade_shard_count > 0 and serving:
+		shard_pool = trade_shards.ShardPool(trade_shard_count, trade_registry, trade_shards.workerCommand(__file__))
+	if auto_resume_enabled and serving:
+		event_loop.submit(resumeTrades())
 	app.run(host='127.0.0.1', port=4143, debug=debug)
\ No newline at end of file
@@ -0,0 +1,167 @@
+import bisect
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+# Minimal Prometheus text-format metrics, served at /api/metrics. Counters and histograms are
+# updated inline (a dict lookup and an add under a lock); anything that already keeps its own
+# numbers, like the contract caches, registers a collector that's only called on scrape.
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+# for things that take minutes to hours, like a trade step waiting for confirmations
+LONG_BUCKETS = (1, 10, 30, 60, 300, 600, 1800, 3600, 4 * 3600, 12 * 3600, 24 * 3600, 72 * 3600)
+
+metrics = []
+metrics_lock = threading.Lock()
+
+def _escape(value):
+	return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+def _formatLabels(names, values, extra=""):
+	labels = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+	if extra != "":
+		labels.append(extra)
+	if len(labels) == 0:
+		return ""
+	return "{" + ",".join(labels) + "}"
+
+def _formatValue(value):
+	if value == float("inf"):
+		return "+Inf"
+	if isinstance(value, float) and value.is_integer():
+		return str(int(value))
+	return str(value)
+
+
+class Counter():
+	def __init__(self, name, description, labels=()):
+		self.name = name
+		self.description = description
+		self.labels = tuple(labels)
+		self.values = {}
+		self.lock = threading.Lock()
+
+	def inc(self, *label_values, amount=1):
+		with self.lock:
+			self.values[label_values] = self.values.get(label_values, 0) + amount
+
+	def render(self):
+		lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} counter"]
+		with self.lock:
+			for label_values, value in self.values.items():
+				lines.append(f"{self.name}{_formatLabels(self.labels, label_values)} {_formatValue(value)}")
+		return lines
+
+
+class Histogram():
+	def __init__(self, name, description, labels=(), buckets=DEFAULT_BUCKETS):
+		self.name = name
+		self.description = description
+		self.labels = tuple(labels)
+		self.buckets = tuple(sorted(buckets))
+		self.values = {} # label values -> [per-bucket counts (last one is +Inf), sum, count]
+		self.lock = threading.Lock()
+
+	def observe(self, value, *label_values):
+		index = bisect.bisect_left(self.buckets, value)
+		with self.lock:
+			entry = self.values.get(label_values, None)
+			if entry is None:
+				entry = [[0] * (len(self.buckets) + 1), 0, 0]
+				self.values[label_values] = entry
+			entry[0][index] += 1
+			entry[1] += value
+			entry[2] += 1
+
+	@contextmanager
+	def time(self, *label_values):
+		start = time.perf_counter()
+		try:
+			yield
+		finally:
+			self.observe(time.perf_counter() - start, *label_values)
+
+	def render(self):
+		lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} histogram"]
+		with self.lock:
+			for label_values, (counts, total, count) in self.values.items():
+				cumulative = 0
+				for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+					cumulative += bucket_count
+					le = f'le="{_formatValue(bound)}"'
+					lines.append(f"{self.name}_bucket{_formatLabels(self.labels, label_values, le)} {cumulative}")
+				lines.append(f"{self.name}_sum{_formatLabels(self.labels, label_values)} {_formatValue(total)}")
+				lines.append(f"{self.name}_count{_formatLabels(self.labels, label_values)} {count}")
+		return lines
+
+
+class Collector():
+	# collect() returns [(label values, value), ...] and is only called when metrics are scraped
+	def __init__(self, name, description, metric_type, labels, collect):
+		self.name = name
+		self.description = description
+		self.metric_type = metric_type
+		self.labels = tuple(labels)
+		self.collect = collect
+
+	def render(self):
+		lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} {self.metric_type}"]
+		try:
+			for label_values, value in self.collect():
+				lines.append(f"{self.name}{_formatLabels(self.labels, label_values)} {_formatValue(value)}")
+		except Exception as e:
+			lines.append(f"# {self.name} could not be collected: {_escape(e)}")
+		return lines
+
+
+def _register(metric):
+	with metrics_lock:
+		metrics.append(metric)
+	return metric
+
+def counter(name, description, labels=()):
+	return _register(Counter(name, description, labels))
+
+def histogram(name, description, labels=(), buckets=DEFAULT_BUCKETS):
+	return _register(Histogram(name, description, labels, buckets))
+
+def collector(name, description, metric_type, labels, collect):
+	return _register(Collector(name, description, metric_type, labels, collect))
+
+def families():
+	# [(HELP and TYPE lines, sample lines)] per metric, e.g. to be rendered by another process
+	with metrics_lock:
+		registered = list(metrics)
+	ret = []
+	for metric in registered:
+		lines = metric.render()
+		ret.append((lines[:2], lines[2:]))
+	return ret
+
+def familyName(family):
+	# from "# HELP <name> <description>"
+	return family[0][0].split(" ", 3)[2]
+
+def _withLabel(line, label):
+	if line.startswith("#"):
+		return line
+	end = 0
+	while end < len(line) and line[end] not in "{ ":
+		end += 1
+	if line[end:end + 1] == "{":
+		return line[:end + 1] + label + "," + line[end + 1:]
+	return line[:end] + "{" + label + "}" + line[end:]
+
+def render(others=()):
+	# others are [(label, families())] from other processes; their samples get that extra label,
+	# e.g. shard="0", and are listed with this process's samples of the same metric
+	merged = OrderedDict()
+	for header, samples in families():
+		merged[tuple(header)] = list(samples)
+	for label, other in others:
+		for header, samples in other:
+			merged.setdefault(tuple(header), []).extend(_withLabel(line, label) for line in samples)
+	lines = []
+	for header, samples in merged.items():
+		lines += list(header) + samples
+	return "\n".join(lines) + "\n"
@@ -0,0 +1,37 @@
+import sqlite3
+from sqlalchemy.exc import SQLAlchemyError
+from config import puzzle_cache_enabled
+from db import engine, puzzles
+
+# Curried contract programs survive restarts in data.db's puzzles table, so resuming trades doesn't
+# need the clvm compiler. Rows are keyed by a hash of contract.clvm plus the curry arguments, so
+# editing the contract simply stops matching the old rows. db.py's migrations create the table.
+
+
+def getPuzzle(puzzle_id):
+	if not puzzle_cache_enabled:
+		return None
+	try:
+		with engine.connect() as conn:
+			s = puzzles.select().where(puzzles.c.id == puzzle_id)
+			row = conn.execute(s).first()
+	except (SQLAlchemyError, sqlite3.Error, OSError) as e:
+		print(f"Could not read from the puzzle cache: {e}")
+		return None
+	if row is None:
+		return None
+	return bytes.fromhex(row.program), bytes.fromhex(row.puzzle_hash)
+
+def putPuzzle(puzzle_id, program, puzzle_hash):
+	if not puzzle_cache_enabled:
+		return
+	try:
+		with engine.begin() as conn:
+			ins = puzzles.insert().prefix_with("OR IGNORE").values(
+				id = puzzle_id,
+				program = program.hex(),
+				puzzle_hash = puzzle_hash.hex()
+			)
+			conn.execute(ins)
+	except (SQLAlchemyError, sqlite3.Error, OSError) as e:
+		print(f"Could not write to the puzzle cache: {e}")
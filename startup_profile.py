@@ -0,0 +1,54 @@
+import builtins
+import sys
+import time
+from contextlib import contextmanager
+
+# `python main.py --profile-startup` prints how long each top-level import and init phase took
+# before the server starts listening. Nothing is recorded unless install() was called.
+enabled = False
+started_at = time.perf_counter()
+imports = []
+phases = []
+
+original_import = builtins.__import__
+import_depth = 0
+
+def timedImport(name, globals=None, locals=None, fromlist=(), level=0):
+	global import_depth
+	# only time modules that actually get loaded, and only the outermost import
+	if import_depth > 0 or level > 0 or name in sys.modules:
+		return original_import(name, globals, locals, fromlist, level)
+	import_depth += 1
+	start = time.perf_counter()
+	try:
+		return original_import(name, globals, locals, fromlist, level)
+	finally:
+		import_depth -= 1
+		imports.append((name, time.perf_counter() - start))
+
+def install():
+	global enabled, started_at
+	enabled = True
+	started_at = time.perf_counter()
+	builtins.__import__ = timedImport
+
+@contextmanager
+def phase(name):
+	start = time.perf_counter()
+	try:
+		yield
+	finally:
+		if enabled:
+			phases.append((name, time.perf_counter() - start))
+
+def report(file=sys.stderr):
+	builtins.__import__ = original_import
+	total = time.perf_counter() - started_at
+	print("Startup profile", file=file)
+	print("  imports:", file=file)
+	for name, seconds in sorted(imports, key=lambda x: x[1], reverse=True):
+		print(f"    {seconds * 1000:9.1f} ms  {name}", file=file)
+	print("  init (included in the imports above):", file=file)
+	for name, seconds in phases:
+		print(f"    {seconds * 1000:9.1f} ms  {name}", file=file)
+	print(f"  total: {total * 1000:.1f} ms", file=file)
@@ -0,0 +1,165 @@
+import atexit
+import os
+import queue
+import threading
+import time
+from collections import OrderedDict
+
+# Trade logs ({trade_id}-log.txt) are written by one background thread. Trades and full node
+# clients only put records on a queue, the writer groups whatever arrived within LOG_FLUSH_INTERVAL
+# into a single write + flush per file, and keeps at most LOG_MAX_OPEN_FILES handles open.
+LOG_FLUSH_INTERVAL = 0.5
+LOG_MAX_OPEN_FILES = 64
+# a log is rotated to {name}.1 (and older ones shifted up to {name}.{LOG_BACKUP_COUNT}) once it grows
+# past LOG_MAX_BYTES or has been written to for longer than LOG_MAX_AGE seconds
+LOG_MAX_BYTES = 10 * 1024 * 1024
+LOG_MAX_AGE = 24 * 60 * 60
+LOG_BACKUP_COUNT = 3
+
+class LogRecord():
+	__slots__ = ("path", "text")
+
+	def __init__(self, path, text):
+		self.path = path
+		self.text = text
+
+# put on the queue instead of a LogRecord to close a log's handle
+class CloseRecord():
+	__slots__ = ("path",)
+
+	def __init__(self, path):
+		self.path = path
+
+
+class LogWriter():
+	def __init__(self, flush_interval=LOG_FLUSH_INTERVAL, max_open_files=LOG_MAX_OPEN_FILES, max_bytes=LOG_MAX_BYTES, max_age=LOG_MAX_AGE, backup_count=LOG_BACKUP_COUNT):
+		self.flush_interval = flush_interval
+		self.max_open_files = max_open_files
+		self.max_bytes = max_bytes
+		self.max_age = max_age
+		self.backup_count = backup_count
+		self.queue = queue.SimpleQueue()
+		self.files = OrderedDict() # path -> open file, least recently used first
+		self.started_at = {} # path -> time of the first write since the last rotation
+		self.stopped = threading.Event()
+		self.thread = threading.Thread(target=self._run, daemon=True)
+		self.thread.start()
+
+	def put(self, record):
+		self.queue.put(record)
+
+	def _open(self, path):
+		f = self.files.pop(path, None)
+		if f is None:
+			if len(self.files) >= self.max_open_files:
+				_, oldest = self.files.popitem(last=False)
+				oldest.close()
+			f = open(path, "a+")
+		self.files[path] = f
+		return f
+
+	def _close(self, path):
+		f = self.files.pop(path, None)
+		if f is not None:
+			f.close()
+		self.started_at.pop(path, None)
+
+	def _shouldRotate(self, path, f):
+		size = f.tell()
+		if size == 0:
+			return False
+		if size >= self.max_bytes:
+			return True
+		return self.max_age is not None and time.time() - self.started_at.get(path, time.time()) >= self.max_age
+
+	def _rotate(self, path):
+		self._close(path)
+		for i in range(self.backup_count - 1, 0, -1):
+			if os.path.exists(f"{path}.{i}"):
+				os.replace(f"{path}.{i}", f"{path}.{i + 1}")
+		if self.backup_count > 0:
+			os.replace(path, f"{path}.1")
+		else:
+			os.remove(path)
+
+	def _writeBatch(self, records):
+		# one write per file, in the order the records arrived
+		texts = OrderedDict()
+		for record in records:
+			if isinstance(record, CloseRecord):
+				if record.path in texts:
+					self._write(record.path, "".join(texts.pop(record.path)))
+				self._close(record.path)
+			else:
+				texts.setdefault(record.path, []).append(record.text)
+		for path, parts in texts.items():
+			self._write(path, "".join(parts))
+
+	def _write(self, path, text):
+		try:
+			f = self._open(path)
+			if self._shouldRotate(path, f):
+				self._rotate(path)
+				f = self._open(path)
+			self.started_at.setdefault(path, time.time())
+			f.write(text)
+			f.flush()
+		except Exception as e:
+			print(f"Could not write to {path}: {e}")
+
+	def _drain(self):
+		records = []
+		try:
+			while True:
+				records.append(self.queue.get_nowait())
+		except queue.Empty:
+			pass
+		return records
+
+	def _run(self):
+		while not self.stopped.is_set():
+			try:
+				first = self.queue.get(timeout=1)
+			except queue.Empty:
+				continue
+			self.stopped.wait(self.flush_interval)
+			self._writeBatch([first] + self._drain())
+
+	def stop(self):
+		# writes everything still queued; called at exit
+		self.stopped.set()
+		self.thread.join(timeout=5)
+		self._writeBatch(self._drain())
+		for path in list(self.files):
+			self._close(path)
+
+
+class TradeLog():
+	# file-like enough for the trade code and FullNodeClient: write() queues, flush() is a no-op
+	def __init__(self, path, writer):
+		self.path = path
+		self.writer = writer
+
+	def write(self, text):
+		self.writer.put(LogRecord(self.path, text))
+
+	def flush(self):
+		pass
+
+	def close(self):
+		self.writer.put(CloseRecord(self.path))
+
+
+writer = None
+writer_lock = threading.Lock()
+
+def getLogWriter():
+	global writer
+	with writer_lock:
+		if writer is None:
+			writer = LogWriter()
+			atexit.register(writer.stop)
+		return writer
+
+def getTradeLog(path):
+	return TradeLog(path, getLogWriter())
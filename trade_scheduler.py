@@ -0,0 +1,87 @@
+import asyncio
+import itertools
+import time
+import metrics
+
+# After a restart, unfinished trades are started again without waiting for the UI to ask for them.
+# Each resumed trade begins with a burst of full node requests (heights, coin records), so at most
+# RESUME_CONCURRENCY trades may be in their first RESUME_WARMUP seconds at once, and new ones are
+# started no faster than one every RESUME_INTERVAL seconds. At most RESUME_MAX_RUNNING resumed trades
+# run at once; the rest wait, in priority order, for one of them to end (or for the UI to ask for them).
+RESUME_CONCURRENCY = 8
+RESUME_WARMUP = 5
+RESUME_INTERVAL = 0.25
+RESUME_MAX_RUNNING = 500
+# a resumed trade stops counting against RESUME_MAX_RUNNING after this many seconds even if it's
+# still running, e.g. an ETH trade waiting for the browser, so it can't keep the others waiting forever
+RESUME_MAX_HOLD = 3600
+
+resumed_trades = metrics.counter("yakuswap_resumed_trades_total", "Unfinished trades started again after a restart")
+resume_failures = metrics.counter("yakuswap_resume_failures_total", "Unfinished trades that could not be started again after a restart")
+
+class ResumeScheduler():
+	def __init__(self, registry, concurrency=RESUME_CONCURRENCY, warmup=RESUME_WARMUP, interval=RESUME_INTERVAL, max_running=RESUME_MAX_RUNNING, max_hold=RESUME_MAX_HOLD):
+		# registry is the TradeRegistry the started trades are in; it tells when they finish
+		self.registry = registry
+		self.concurrency = concurrency
+		self.warmup = warmup
+		self.interval = interval
+		self.max_hold = max_hold
+		self.queue = asyncio.PriorityQueue()
+		self.order = itertools.count()
+		self.last_start = 0
+		self.rate_lock = asyncio.Lock()
+		self.running = asyncio.Semaphore(max(1, max_running))
+		self.started = 0
+
+	def add(self, priority, trade_id, start):
+		# lower priority values go first; start() is called with no arguments to launch the trade
+		# and returns (TradeState, created), like TradeRegistry.getOrCreate
+		self.queue.put_nowait((priority, next(self.order), trade_id, start))
+
+	async def _waitForTurn(self):
+		async with self.rate_lock:
+			delay = self.last_start + self.interval - time.monotonic()
+			if delay > 0:
+				await asyncio.sleep(delay)
+			self.last_start = time.monotonic()
+
+	def _holdUntilFinished(self, trade_id):
+		# gives the trade's slot back when it finishes, or after max_hold seconds
+		loop = asyncio.get_running_loop()
+		released = []
+		def release():
+			if not released:
+				released.append(True)
+				timer.cancel()
+				self.running.release()
+		timer = loop.call_later(self.max_hold, release)
+		# the registry may finish the trade on another thread, e.g. a shard's reader thread
+		self.registry.whenFinished(trade_id, lambda state: loop.call_soon_threadsafe(release))
+
+	async def _worker(self):
+		while not self.queue.empty():
+			priority, order, trade_id, start = self.queue.get_nowait()
+			await self.running.acquire()
+			await self._waitForTurn()
+			try:
+				state, created = start()
+			except Exception as e:
+				self.running.release()
+				resume_failures.inc()
+				print(f"Could not resume trade {trade_id}: {e}")
+				continue
+			if not created:
+				# already started by a request from the UI, or already over
+				self.running.release()
+				continue
+			self.started += 1
+			resumed_trades.inc()
+			self._holdUntilFinished(trade_id)
+			await asyncio.sleep(self.warmup)
+
+	async def run(self):
+		# returns the number of trades it started
+		workers = [asyncio.ensure_future(self._worker()) for _ in range(max(1, self.concurrency))]
+		await asyncio.gather(*workers)
+		return self.started
@@ -0,0 +1,258 @@
+import atexit
+import itertools
+import os
+import secrets
+import subprocess
+import sys
+import threading
+import time
+import zlib
+from multiprocessing.connection import Listener, Client
+import event_loop
+import metrics
+from trade_state import FINISHED, FAILED
+
+# With a number N > 0 in .trade_shards, trades run in N worker processes instead of on the web
+# server's own event loop, so contract building and hashing in many trades isn't serialized by a
+# single GIL. A trade id always maps to the same worker. Workers are main.py started again with
+# SHARD_WORKER_ARG; they report every change to a trade's status fields, and the web server keeps
+# a mirrored TradeState per trade, so status requests and event streams are answered locally.
+# /api/metrics asks every worker for its metrics too (node requests, queries, coin record batches)
+# and lists them with a shard label, except the trade metrics the mirrored states already give.
+SHARD_WORKER_ARG = "--trade-shard-worker"
+SHARD_AUTHKEY_ENV = "YAKUSWAP_SHARD_AUTHKEY"
+# a worker that exits is started again after SHARD_RESTART_DELAY seconds, doubled for every exit in a
+# row up to SHARD_RESTART_MAX_DELAY; a worker that ran for SHARD_STABLE_TIME seconds starts over at 1
+SHARD_RESTART_DELAY = 1
+SHARD_RESTART_MAX_DELAY = 60
+SHARD_STABLE_TIME = 60
+# seconds /api/metrics waits for the workers' metrics
+SHARD_METRICS_TIMEOUT = 2
+MIRRORED_METRICS = ("yakuswap_trade_step_duration_seconds", "yakuswap_active_trades")
+
+def shardFor(trade_id, count):
+	# stable across processes and restarts, unlike hash()
+	return zlib.crc32(trade_id.encode()) % count
+
+def workerCommand(main_file):
+	# a pyinstaller build is its own interpreter and script
+	if getattr(sys, "frozen", False):
+		return [sys.executable]
+	return [sys.executable, os.path.abspath(main_file)]
+
+
+class MirrorLog():
+	# mirrored trade states don't write anything; the worker running the trade keeps its log
+	def write(self, text):
+		pass
+
+	def flush(self):
+		pass
+
+	def close(self):
+		pass
+
+
+class ShardPool():
+	def __init__(self, count, registry, command):
+		self.count = count
+		self.registry = registry
+		self.command = command
+		self.authkey = secrets.token_bytes(32)
+		self.listener = Listener(("127.0.0.1", 0), authkey=self.authkey)
+		self.lock = threading.Lock()
+		# held while sending to a worker, so messages arrive in order; never taken by _read
+		self.send_locks = [threading.Lock() for _ in range(count)]
+		self.connections = [None] * count
+		self.processes = [None] * count
+		self.assigned = [{} for _ in range(count)] # trade id -> (code name, log filename), until it finishes
+		self.pending = [[] for _ in range(count)] # messages sent while the worker wasn't connected
+		self.stopping = False
+		self.metrics_changed = threading.Condition()
+		self.metrics_requests = itertools.count()
+		self.metrics_replies = {} # request id -> {shard index: metric families}
+		threading.Thread(target=self._accept, daemon=True).start()
+		for index in range(count):
+			threading.Thread(target=self._supervise, args=(index,), daemon=True).start()
+		atexit.register(self.stop)
+
+	def _supervise(self, index):
+		host, port = self.listener.address
+		env = dict(os.environ)
+		env[SHARD_AUTHKEY_ENV] = self.authkey.hex()
+		delay = SHARD_RESTART_DELAY
+		while not self.stopping:
+			started_at = time.time()
+			process = subprocess.Popen(self.command + [SHARD_WORKER_ARG, f"{host}:{port}", str(index)], env=env)
+			self.processes[index] = process
+			process.wait()
+			if self.stopping:
+				break
+			if time.time() - started_at >= SHARD_STABLE_TIME:
+				delay = SHARD_RESTART_DELAY
+			print(f"Trade shard {index} exited with code {process.returncode}, starting it again in {delay}s")
+			time.sleep(delay)
+			delay = min(delay * 2, SHARD_RESTART_MAX_DELAY)
+
+	def _accept(self):
+		while not self.stopping:
+			try:
+				conn = self.listener.accept()
+				index = conn.recv()
+			except Exception as e:
+				if not self.stopping:
+					print(f"Trade shard could not connect: {e}")
+				continue
+			# the backlog is sent while _read already takes the worker's updates, or both sides
+			# could block on full socket buffers
+			threading.Thread(target=self._read, args=(index, conn), daemon=True).start()
+			threading.Thread(target=self._replay, args=(index, conn), daemon=True).start()
+
+	def _replay(self, index, conn):
+		with self.send_locks[index]:
+			with self.lock:
+				self.connections[index] = conn
+				# after a worker restart its unfinished trades are started again, like on a server restart
+				messages = [("start", trade_id, code_name, log_filename) for trade_id, (code_name, log_filename) in self.assigned[index].items()]
+				messages += self.pending[index]
+				self.pending[index] = []
+			for i, message in enumerate(messages):
+				try:
+					conn.send(message)
+				except OSError:
+					# the worker is already gone; its starts are sent again from self.assigned
+					with self.lock:
+						self.pending[index] = [m for m in messages[i:] if m[0] != "start"] + self.pending[index]
+					return
+
+	def _read(self, index, conn):
+		while True:
+			try:
+				message = conn.recv()
+			except (EOFError, OSError):
+				break
+			if message[0] is None:
+				self._metricsReply(index, *message[1:])
+			else:
+				self._update(index, *message)
+
+		with self.lock:
+			if self.connections[index] is conn:
+				self.connections[index] = None
+		conn.close()
+
+	def _update(self, index, trade_id, fields):
+		state = self.registry.get(trade_id)
+		if state is None:
+			return
+		status = fields.pop("status", None)
+		for name, value in fields.items():
+			setattr(state, name, value)
+		if status in (FINISHED, FAILED):
+			self.registry.finish(trade_id, status == FAILED)
+			with self.lock:
+				self.assigned[index].pop(trade_id, None)
+		elif status is not None:
+			state.status = status
+
+	def _send(self, index, message, keep=True):
+		# returns whether it was sent; if not and keep is set, it's sent once the worker (re)connects
+		with self.send_locks[index]:
+			with self.lock:
+				conn = self.connections[index]
+				if conn is None:
+					if keep:
+						self.pending[index].append(message)
+					return False
+			try:
+				conn.send(message)
+				return True
+			except OSError:
+				if keep:
+					with self.lock:
+						self.pending[index].append(message)
+				return False
+
+	def _metricsReply(self, index, request_id, families):
+		with self.metrics_changed:
+			if request_id in self.metrics_replies:
+				self.metrics_replies[request_id][index] = families
+				self.metrics_changed.notify_all()
+
+	def collectMetrics(self, timeout=SHARD_METRICS_TIMEOUT):
+		# [('shard="<index>"', metric families)] for metrics.render, from the workers that answer in time
+		with self.metrics_changed:
+			request_id = next(self.metrics_requests)
+			replies = self.metrics_replies[request_id] = {}
+		sent = sum(1 for index in range(self.count) if self._send(index, ("metrics", request_id), False))
+		with self.metrics_changed:
+			self.metrics_changed.wait_for(lambda: len(replies) >= sent, timeout)
+			del self.metrics_replies[request_id]
+			return [(f'shard="{index}"', families) for index, families in sorted(replies.items())]
+
+	def start(self, trade_id, code_name, log_filename):
+		index = shardFor(trade_id, self.count)
+		with self.lock:
+			self.assigned[index][trade_id] = (code_name, log_filename)
+		self._send(index, ("start", trade_id, code_name, log_filename))
+
+	def post(self, trade_id, data):
+		# values posted by the browser for an ETH trade
+		self._send(shardFor(trade_id, self.count), ("post", trade_id, data))
+
+	def stop(self):
+		# closing the connections makes the workers exit
+		self.stopping = True
+		with self.lock:
+			connections = [conn for conn in self.connections if conn is not None]
+		for conn in connections:
+			conn.close()
+		self.listener.close()
+		for process in self.processes:
+			if process is not None:
+				try:
+					process.wait(timeout=5)
+				except subprocess.TimeoutExpired:
+					process.kill()
+
+
+def runWorker(args, registry, startTrade, codes, postResponses):
+	# runs in the worker process until the web server goes away; args are what follows SHARD_WORKER_ARG
+	address, index = args[0], int(args[1])
+	host, port = address.rsplit(":", 1)
+	conn = Client((host, int(port)), authkey=bytes.fromhex(os.environ[SHARD_AUTHKEY_ENV]))
+	send_lock = threading.Lock()
+
+	def send(trade_id, fields):
+		try:
+			conn.send((trade_id, fields))
+		except OSError:
+			pass
+
+	def forward(state, name, value):
+		with send_lock:
+			send(state.trade_id, {name: value})
+
+	registry.listener = forward
+	conn.send(index)
+	while True:
+		try:
+			message = conn.recv()
+		except (EOFError, OSError):
+			break
+		if message[0] == "start":
+			_, trade_id, code_name, log_filename = message
+			state = startTrade(trade_id, codes[code_name], log_filename)
+			# under send_lock, so that no update sent after this snapshot is older than it
+			with send_lock:
+				send(trade_id, {name: getattr(state, name) for name in ("step", "message", "address", "command", "status")})
+		elif message[0] == "post":
+			_, trade_id, data = message
+			event_loop.call(postResponses, trade_id, data)
+		elif message[0] == "metrics":
+			families = [family for family in metrics.families() if metrics.familyName(family) not in MIRRORED_METRICS]
+			with send_lock:
+				try:
+					conn.send((None, message[1], families))
+				except OSError:
+					pass
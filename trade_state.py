@@ -0,0 +1,154 @@
+import threading
+import time
+import metrics
+from collections import deque, OrderedDict
+
+STARTING = "starting"
+RUNNING = "running"
+FINISHED = "finished"
+FAILED = "failed"
+
+# finished trades keep answering status requests for this long before they're dropped
+FINISHED_TRADE_TTL = 600
+# after that only their final status and message are kept, for at most this many trades, so a
+# status request for an evicted trade doesn't start it all over again
+FINISHED_MARKERS = 10000
+
+# changes to these fields bump TradeState.version and wake status streams
+WATCHED_FIELDS = ("status", "message", "address", "command")
+# changes to these are reported to TradeRegistry.listener, e.g. to mirror a trade running in another process
+LISTENED_FIELDS = WATCHED_FIELDS + ("step",)
+
+step_duration = metrics.histogram("yakuswap_trade_step_duration_seconds", "Time trades spent in each step", ["code", "step"], metrics.LONG_BUCKETS)
+
+class TradeState():
+	__slots__ = ("trade_id", "code", "status", "step", "step_started_at", "message", "address", "command", "log", "finished_at", "version", "changed", "listener")
+
+	def __init__(self, trade_id, log, code="", listener=None):
+		object.__setattr__(self, "listener", listener)
+		object.__setattr__(self, "version", 0)
+		object.__setattr__(self, "changed", threading.Condition())
+		object.__setattr__(self, "step", None)
+		self.trade_id = trade_id
+		self.code = code
+		self.status = STARTING
+		self.step_started_at = None
+		self.message = "Starting thread..."
+		self.address = None
+		self.command = None
+		self.log = log
+		self.finished_at = None
+
+	def _endStep(self):
+		if self.step is not None and self.step_started_at is not None:
+			step_duration.observe(time.time() - self.step_started_at, self.code, str(self.step))
+
+	def __setattr__(self, name, value):
+		old_value = getattr(self, name, None)
+		if name == "step" and value != self.step:
+			self._endStep()
+			object.__setattr__(self, "step_started_at", time.time())
+		if name in WATCHED_FIELDS and getattr(self, name, None) != value:
+			with self.changed:
+				object.__setattr__(self, name, value)
+				object.__setattr__(self, "version", self.version + 1)
+				self.changed.notify_all()
+		else:
+			object.__setattr__(self, name, value)
+		if self.listener is not None and name in LISTENED_FIELDS and old_value != value:
+			self.listener(self, name, value)
+
+	def waitForChange(self, version, timeout):
+		# returns the current version once it differs from version, or after timeout seconds
+		with self.changed:
+			self.changed.wait_for(lambda: self.version != version, timeout)
+			return self.version
+
+
+class TradeRegistry():
+	def __init__(self, finished_ttl=FINISHED_TRADE_TTL, listener=None, max_markers=FINISHED_MARKERS):
+		self.finished_ttl = finished_ttl
+		self.max_markers = max_markers
+		# listener(state, name, value) is called on the changing thread after a field in LISTENED_FIELDS changes
+		self.listener = listener
+		self.trades = {}
+		self.finished = deque()
+		self.markers = OrderedDict() # trade id -> (status, message) of evicted trades, oldest first
+		self.finish_callbacks = {} # trade id -> callbacks waiting for it to finish, see whenFinished
+		self.lock = threading.Lock()
+
+	def _evictFinished(self):
+		# called with self.lock held; self.finished is ordered by finish time
+		now = time.time()
+		while len(self.finished) > 0 and now - self.finished[0].finished_at > self.finished_ttl:
+			state = self.finished.popleft()
+			if self.trades.get(state.trade_id, None) is state:
+				del self.trades[state.trade_id]
+				self.markers[state.trade_id] = (state.status, state.message)
+				self.markers.move_to_end(state.trade_id)
+				if len(self.markers) > self.max_markers:
+					self.markers.popitem(last=False)
+
+	def _finishedState(self, trade_id, code):
+		# a stand-in for an evicted trade; it isn't registered, so it's never run or finished again
+		status, message = self.markers[trade_id]
+		state = TradeState(trade_id, None, code)
+		state.status = status
+		state.message = message
+		state.finished_at = time.time()
+		return state
+
+	def getOrCreate(self, trade_id, openLog, code=""):
+		# returns (state, created); openLog is only called for new trades
+		with self.lock:
+			self._evictFinished()
+			state = self.trades.get(trade_id, None)
+			if state is not None:
+				return state, False
+			if trade_id in self.markers:
+				return self._finishedState(trade_id, code), False
+			state = TradeState(trade_id, openLog(), code, self.listener)
+			self.trades[trade_id] = state
+			return state, True
+
+	def get(self, trade_id):
+		with self.lock:
+			return self.trades.get(trade_id, None)
+
+	def hasEnded(self, trade_id):
+		# True once the trade finished or failed, also after it was evicted
+		with self.lock:
+			state = self.trades.get(trade_id, None)
+			if state is not None:
+				return state.finished_at is not None
+			return trade_id in self.markers
+
+	def finish(self, trade_id, failed=False):
+		with self.lock:
+			state = self.trades.get(trade_id, None)
+			if state is None or state.finished_at is not None:
+				return
+			state.status = FAILED if failed else FINISHED
+			state._endStep()
+			state.finished_at = time.time()
+			state.command = None
+			state.log.close()
+			self.finished.append(state)
+			callbacks = self.finish_callbacks.pop(trade_id, ())
+		for callback in callbacks:
+			callback(state)
+
+	def whenFinished(self, trade_id, callback):
+		# callback(state) is called once the trade finishes or fails, on the thread that finishes it,
+		# or right away if it isn't running (with None if it was never registered)
+		with self.lock:
+			state = self.trades.get(trade_id, None)
+			if state is not None and state.finished_at is None:
+				self.finish_callbacks.setdefault(trade_id, []).append(callback)
+				return
+		callback(state)
+
+	def all(self):
+		with self.lock:
+			self._evictFinished()
+			return list(self.trades.values())
@@ -1,14 +1,16 @@
 """
 This is an implementation of `sha256_treehash`, used to calculate
-puzzle hashes in clvm.
+puzzle hashes in clvm. All hashing goes through `TreeHasher`.
 
 This implementation goes to great pains to be non-recursive so we don't
 have to worry about blowing out the python stack.
 """
 
+import hashlib
 import io
+import threading
 
-from typing import Optional, Set, Any, BinaryIO
+from typing import Dict, Any, BinaryIO, Tuple
 
 from clvm import CLVMObject
 
@@ -72,48 +74,85 @@ def std_hash(b):
     """
     The standard hash used in many places.
     """
-    return bytes32(blspy.Util.hash256(bytes(b)))
+    return bytes32(hashlib.sha256(bytes(b)).digest())
 
 
-def sha256_treehash(sexp: CLVMObject, precalculated: Optional[Set[bytes32]] = None) -> bytes32: # sexp:    
+class TreeHasher:
     """
-    Hash values in `precalculated` are presumed to have been hashed already.
+    Computes the tree hash of a clvm object. Pairs that were passed to
+    `remember` (and all pairs below them) are looked up by identity instead of
+    being hashed again. Remembering the contract template means hashing a newly
+    curried contract only walks the curry wrapper and its arguments.
+
+    Atom hashes are also cached by their bytes, up to `max_atoms` of them.
     """
 
-    if precalculated is None:
-        precalculated = set()
-
-    def handle_sexp(sexp_stack, op_stack, precalculated: Set[bytes32]) -> None:
-        sexp = sexp_stack.pop()
-        if sexp.pair:
-            p0, p1 = sexp.pair
-            sexp_stack.append(p0)
-            sexp_stack.append(p1)
-            op_stack.append(handle_pair)
-            op_stack.append(handle_sexp)
-            op_stack.append(roll)
-            op_stack.append(handle_sexp)
-        else:
-            if sexp.atom in precalculated:
-                r = sexp.atom
+    def __init__(self, max_atoms: int = 4096):
+        self.max_atoms = max_atoms
+        # id(pair) -> (pair, hash); the pair is kept so its id can't be reused by another object
+        self.known: Dict[int, Tuple[Any, bytes]] = {}
+        self.atoms: Dict[bytes, bytes] = {}
+        self.lock = threading.Lock()
+
+    def _hash_atom(self, atom: bytes) -> bytes:
+        r = self.atoms.get(atom)
+        if r is None:
+            r = hashlib.sha256(b"\1" + atom).digest()
+            if len(self.atoms) < self.max_atoms:
+                self.atoms[atom] = r
+        return r
+
+    def _walk(self, sexp: CLVMObject, record: bool) -> bytes:
+        # post-order walk without recursion; None on the stack means "combine the last two hashes"
+        known = self.known
+        values = []
+        pairs = []
+        todo = [sexp]
+        while todo:
+            node = todo.pop()
+            if node is None:
+                right = values.pop()
+                left = values.pop()
+                r = hashlib.sha256(b"\2" + left + right).digest()
+                values.append(r)
+                if record:
+                    pair = pairs.pop()
+                    known[id(pair)] = (pair, r)
+                continue
+            entry = known.get(id(node))
+            if entry is not None and entry[0] is node:
+                values.append(entry[1])
+                continue
+            pair = node.pair
+            if pair is not None:
+                if record:
+                    pairs.append(node)
+                todo.append(None)
+                todo.append(pair[1])
+                todo.append(pair[0])
             else:
-                r = std_hash(b"\1" + sexp.atom)
-            sexp_stack.append(r)
-
-    def handle_pair(sexp_stack, op_stack, precalculated) -> None:
-        p0 = sexp_stack.pop()
-        p1 = sexp_stack.pop()
-        sexp_stack.append(std_hash(b"\2" + p0 + p1))
-
-    def roll(sexp_stack, op_stack, precalculated) -> None:
-        p0 = sexp_stack.pop()
-        p1 = sexp_stack.pop()
-        sexp_stack.append(p0)
-        sexp_stack.append(p1)
-
-    sexp_stack = [sexp]
-    op_stack = [handle_sexp]
-    while len(op_stack) > 0:
-        op = op_stack.pop()
-        op(sexp_stack, op_stack, precalculated)
-    return bytes32(sexp_stack[0])
+                values.append(self._hash_atom(node.atom))
+        return values[0]
+
+    def remember(self, sexp: CLVMObject) -> bytes32:
+        """
+        Hashes `sexp` and keeps the hash of every pair in it for later calls.
+        The tree must not be modified afterwards.
+        """
+        with self.lock:
+            return bytes32(self._walk(sexp, True))
+
+    def forget(self) -> None:
+        with self.lock:
+            self.known = {}
+            self.atoms = {}
+
+    def hash(self, sexp: CLVMObject) -> bytes32:
+        return bytes32(self._walk(sexp, False))
+
+
+tree_hasher = TreeHasher()
+
+
+def sha256_treehash(sexp: CLVMObject) -> bytes32:
+    return tree_hasher.hash(sexp)
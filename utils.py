@@ -14,6 +14,20 @@ def currencyRowToJson(row):
 	}
 
 
+def tradeCurrencyColumnsToJson(row, prefix):
+	# same as tradeCurrencyRowToJson, for trade_currencies columns joined into a trade row and labeled {prefix}{column}
+	return {
+		'id': row[f'{prefix}id'],
+		'address_prefix': row[f'{prefix}address_prefix'],
+		'fee': row[f'{prefix}fee'],
+		'max_block_height': row[f'{prefix}max_block_height'],
+		'min_confirmation_height':row[f'{prefix}min_confirmation_height'],
+		'from_address': row[f'{prefix}from_address'],
+		'to_address': row[f'{prefix}to_address'],
+		'total_amount': row[f'{prefix}total_amount']
+	}
+
+
 def tradeCurrencyRowToJson(row):
 	return {
 		'id': row['id'],